@@ -0,0 +1,169 @@
+# This file is part of nightly-reporting-jobs.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Checkpoint the sections of a nightly report to local storage.
+
+A report restarted after a failure (``restartPolicy: OnFailure``) reuses the
+result of every section that completed, so it only repeats the queries from
+the first incomplete section on, and does not post the same night twice.
+"""
+
+__all__ = [
+    "KEEP_DAYS",
+    "SectionCheckpoint",
+]
+import hashlib
+import json
+import logging
+import os
+import shutil
+from datetime import date, timedelta
+
+logging.basicConfig(
+    format="{levelname} {asctime} {name} - {message}",
+    style="{",
+)
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.DEBUG)
+
+# Checkpoints of older nights are deleted.
+KEEP_DAYS = 7
+
+
+def _write(path, text):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class SectionCheckpoint:
+    """Section results of one instrument and night.
+
+    Parameters
+    ----------
+    root : `str` or `None`
+        Directory to keep checkpoints in. If `None`, nothing is kept and
+        every section is computed.
+    instrument : `str`
+        The instrument name.
+    day_obs : `str`
+        day_obs in the format of YYYY-MM-DD.
+    """
+
+    def __init__(self, root, instrument, day_obs):
+        self.directory = None
+        if root is not None:
+            self.directory = os.path.join(root, instrument, day_obs)
+            os.makedirs(self.directory, exist_ok=True)
+            self._prune(os.path.join(root, instrument), day_obs)
+
+    @staticmethod
+    def _prune(instrument_dir, day_obs):
+        oldest = (date.fromisoformat(day_obs) - timedelta(days=KEEP_DAYS)).isoformat()
+        for name in os.listdir(instrument_dir):
+            if name < oldest:
+                shutil.rmtree(os.path.join(instrument_dir, name), ignore_errors=True)
+
+    def _path(self, name, inputs):
+        key = hashlib.sha256(
+            json.dumps(inputs, sort_keys=True, default=str).encode()
+        ).hexdigest()[:16]
+        return os.path.join(self.directory, f"{name}-{key}.json")
+
+    def section(self, name, inputs, compute, encode=None, decode=None):
+        """Return the result of a section, computing it only if needed.
+
+        Parameters
+        ----------
+        name : `str`
+            Name of the section, unique within the report.
+        inputs : `list`
+            JSON-serializable values the result depends on besides the
+            instrument and night; a change in them invalidates the result.
+        compute : callable
+            Called without arguments to compute the result.
+        encode, decode : callable, optional
+            Convert the result to and from JSON-serializable values.
+
+        Returns
+        -------
+        result
+            The result of ``compute``. Tuples come back from a checkpoint
+            as lists unless ``decode`` converts them.
+        """
+        if self.directory is None:
+            return compute()
+        path = self._path(name, inputs)
+        if os.path.exists(path):
+            with open(path) as f:
+                value = json.load(f)
+            _log.info(f"Using checkpointed {name}")
+            return decode(value) if decode else value
+        result = compute()
+        _write(path, json.dumps(encode(result) if encode else result))
+        return result
+
+    def posted(self):
+        """Return whether this night's report was already posted."""
+        return self.directory is not None and os.path.exists(
+            os.path.join(self.directory, "posted")
+        )
+
+    def mark_posted(self):
+        """Record that this night's report was posted."""
+        if self.directory is not None:
+            _write(os.path.join(self.directory, "posted"), "")
+
+    def posted_sections(self):
+        """Return the sections of a progressive report already posted.
+
+        Returns
+        -------
+        sections : `dict` [`str`, `str` or `None`]
+            The Slack timestamp of each posted section's message, if known.
+        """
+        if self.directory is None:
+            return {}
+        path = os.path.join(self.directory, "posted_sections.json")
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def mark_section_posted(self, section, ts=None):
+        """Record that one section of a progressive report was posted.
+
+        Parameters
+        ----------
+        section : `str`
+        ts : `str`, optional
+            The Slack timestamp of the message, to thread the next sections.
+        """
+        if self.directory is not None:
+            sections = self.posted_sections()
+            sections[section] = ts
+            _write(
+                os.path.join(self.directory, "posted_sections.json"),
+                json.dumps(sections),
+            )
@@ -0,0 +1,245 @@
+# This file is part of nightly-reporting-jobs.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Per-night, per-detector outcome counts kept across nights.
+
+Each night appends one ``(detectors, columns)`` block of counts to a flat
+binary file, so a night is written in constant time and queries over the
+last nights read only those rows, however long the history::
+
+    python detector_health.py --instrument LSSTCam --nights 30 /health
+"""
+
+__all__ = [
+    "COLUMNS",
+    "DETECTOR_COUNTS",
+    "DetectorHealth",
+]
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+
+from night_summary import LOKI_FAILURES
+
+logging.basicConfig(
+    format="{levelname} {asctime} {name} - {message}",
+    style="{",
+)
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.DEBUG)
+
+# Science detectors of the instruments tracked per detector.
+DETECTOR_COUNTS = {"LSSTCam": 189}
+
+# ``expected``: survey visits with a nextVisit event, for every detector.
+# ``preprocessed``: successful preprocessing in Loki.
+# ``sfm_outputs``: ApPipe single frame outputs.
+# Then the (group, detector) reporting each Loki failure category.
+COLUMNS = ("expected", "preprocessed", "sfm_outputs") + tuple(LOKI_FAILURES)
+
+
+class DetectorHealth:
+    """The per-detector history of one instrument.
+
+    Parameters
+    ----------
+    root : `str`
+        Directory of the histories; created if needed.
+    instrument : `str`
+        The instrument name.
+    detectors : `int`, optional
+        Number of detectors, for a new history; `DETECTOR_COUNTS` by
+        default.
+    """
+
+    def __init__(self, root, instrument, detectors=None):
+        self.directory = os.path.join(root, instrument)
+        os.makedirs(self.directory, exist_ok=True)
+        meta_path = os.path.join(self.directory, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        else:
+            meta = {
+                "detectors": detectors or DETECTOR_COUNTS[instrument],
+                "columns": list(COLUMNS),
+            }
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
+        self.detectors = meta["detectors"]
+        self.columns = tuple(meta["columns"])
+        self._row_size = self.detectors * len(self.columns)
+        self._nights_path = os.path.join(self.directory, "nights.bin")
+        self._counts_path = os.path.join(self.directory, "counts.bin")
+        self._repair()
+
+    def _repair(self):
+        """Drop counts written after the last recorded night."""
+        n = len(self.nights())
+        expected = n * self._row_size * 4
+        if os.path.exists(self._counts_path) and os.path.getsize(self._counts_path) > expected:
+            with open(self._counts_path, "r+b") as f:
+                f.truncate(expected)
+
+    def nights(self):
+        """Return the day_obs of every row, as YYYYMMDD integers."""
+        if not os.path.exists(self._nights_path):
+            return np.empty(0, dtype=np.int32)
+        return np.fromfile(self._nights_path, dtype=np.int32)
+
+    def _counts(self, mode="r"):
+        n = len(self.nights())
+        if n == 0:
+            return np.empty((0, self.detectors, len(self.columns)), dtype=np.int32)
+        return np.memmap(
+            self._counts_path,
+            dtype=np.int32,
+            mode=mode,
+            shape=(n, self.detectors, len(self.columns)),
+        )
+
+    def append(self, day_obs, counts):
+        """Record one night, replacing it if already recorded.
+
+        Parameters
+        ----------
+        day_obs : `str`
+            day_obs in the format of YYYY-MM-DD.
+        counts : `dict` [`str`, sequence [`int`]]
+            Per-detector counts by column; missing columns are zero.
+        """
+        unknown = set(counts) - set(self.columns)
+        if unknown:
+            raise ValueError(f"Unknown detector health columns: {sorted(unknown)}")
+        row = np.zeros((self.detectors, len(self.columns)), dtype=np.int32)
+        for column, values in counts.items():
+            row[:, self.columns.index(column)] = values
+        night = int(day_obs.replace("-", ""))
+        existing = np.flatnonzero(self.nights() == night)
+        if len(existing):
+            data = self._counts("r+")
+            data[existing[-1]] = row
+            data.flush()
+            return
+        # Counts first, so that an interrupted append leaves no night
+        # without counts.
+        with open(self._counts_path, "ab") as f:
+            row.tofile(f)
+        with open(self._nights_path, "ab") as f:
+            np.array([night], dtype=np.int32).tofile(f)
+
+    def window(self, nights=30, before=None):
+        """Return the counts of the last nights.
+
+        Parameters
+        ----------
+        nights : `int`, optional
+            Number of recorded nights to return at most.
+        before : `str`, optional
+            Only nights before this day_obs, in the format of YYYY-MM-DD.
+
+        Returns
+        -------
+        day_obs : `numpy.ndarray`
+            The nights, as YYYYMMDD integers, in recorded order.
+        counts : `numpy.ndarray`
+            Counts of shape ``(nights, detectors, columns)``.
+        """
+        all_nights = self.nights()
+        rows = np.arange(len(all_nights))
+        if before is not None:
+            rows = rows[all_nights < int(before.replace("-", ""))]
+        rows = rows[-nights:]
+        return all_nights[rows], np.asarray(self._counts()[rows])
+
+    def rates(self, column, nights=30, before=None):
+        """Return the rate of a column per expected processing, per detector.
+
+        Parameters
+        ----------
+        column : `str`
+            One of ``columns``.
+        nights, before
+            Passed to `window`.
+
+        Returns
+        -------
+        rates : `numpy.ndarray`
+            One rate per detector; NaN where nothing was expected.
+        """
+        _, counts = self.window(nights, before)
+        totals = counts.sum(axis=0, dtype=np.int64)
+        expected = totals[:, self.columns.index("expected")]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(
+                expected > 0, totals[:, self.columns.index(column)] / expected, np.nan
+            )
+
+    def inactive_detectors(self, nights=7, before=None, threshold=0.01):
+        """Infer the detectors that are not read out.
+
+        Parameters
+        ----------
+        nights, before
+            Passed to `window`.
+        threshold : `float`, optional
+            Detectors preprocessed for less than this fraction of the
+            expected visits are inactive.
+
+        Returns
+        -------
+        detectors : `list` [`int`] or `None`
+            `None` if the window has no preprocessing to infer from.
+        """
+        rates = self.rates("preprocessed", nights, before)
+        if not np.nansum(rates) > 0:
+            return None
+        return np.flatnonzero(~(rates >= threshold)).tolist()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("root", help="Root directory of the histories.")
+    parser.add_argument("--instrument", default=os.getenv("INSTRUMENT") or "LSSTCam")
+    parser.add_argument("--nights", type=int, default=30)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    health = DetectorHealth(args.root, args.instrument)
+    day_obs, _ = health.window(args.nights)
+    if len(day_obs) == 0:
+        raise SystemExit(f"No history for {args.instrument}")
+    print(f"{len(day_obs)} nights from {day_obs[0]} to {day_obs[-1]}")
+    inactive = health.inactive_detectors(args.nights)
+    print(f"Inactive detectors: {inactive}")
+    for column in health.columns[3:]:
+        rates = health.rates(column, args.nights)
+        if inactive:
+            rates[inactive] = np.nan
+        worst = [d for d in np.argsort(-np.nan_to_num(rates)) if rates[d] > 0]
+        if worst:
+            print(
+                f"{column}: "
+                + ", ".join(f"{d} ({rates[d]:.1%})" for d in worst[: args.top])
+            )
@@ -0,0 +1,149 @@
+# This file is part of nightly-reporting-jobs.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Reconcile the sources of a night group by group.
+
+The ledger has one row per groupId seen in the nextVisit events or the
+exposure records of the survey, with what every source says about it.
+The sources are joined on the group index, and the mismatches are
+flagged with column operations over the whole table.
+"""
+
+__all__ = [
+    "LEDGER_FLAGS",
+    "build_ledger",
+    "ledger_frame",
+    "ledger_to_dict",
+]
+import pandas
+
+# Flag columns and how they read in the report.
+LEDGER_FLAGS = {
+    "next_visit_without_raw": "nextVisit without raw",
+    "raw_without_next_visit": "raw without nextVisit",
+    "canceled_but_processed": "canceled but processed",
+    "partial_coverage": "partial detector coverage",
+}
+
+
+def _counts(values):
+    return pandas.Series(list(values), dtype=object).value_counts().astype("int64")
+
+
+def build_ledger(
+    next_visits,
+    canceled=(),
+    exposures=(),
+    raws=None,
+    preprocessed=None,
+    loki_failures=None,
+    detectors=None,
+):
+    """Join the sources of a night by group and flag their mismatches.
+
+    Parameters
+    ----------
+    next_visits : iterable [`str`]
+        groupId of each nextVisit event of the survey.
+    canceled : iterable [`str`], optional
+        groupId of the canceled events.
+    exposures : iterable [`str`], optional
+        Group of each exposure record of the survey.
+    raws, preprocessed, loki_failures : `dict` [`str`, `int`], optional
+        Raw datasets, successful preprocessing and (group, detector)
+        reporting a known failure in Loki, by group. A column is left
+        out, and the flags that need it ignore it, if not given.
+    detectors : `int`, optional
+        Detectors expected to be read out and preprocessed for a visit;
+        ``partial_coverage`` is not flagged without it.
+
+    Returns
+    -------
+    ledger : `pandas.DataFrame`
+        Indexed by sorted ``group``, with a count column per source, the
+        boolean ``canceled``, and a boolean column per `LEDGER_FLAGS`:
+
+        ``next_visit_without_raw``
+            A nextVisit not canceled, with no exposure.
+        ``raw_without_next_visit``
+            An exposure with no nextVisit, or a canceled one.
+        ``canceled_but_processed``
+            A canceled nextVisit that was preprocessed or failed anyway.
+        ``partial_coverage``
+            Fewer raws than ``detectors`` per exposure, or a nextVisit
+            preprocessed for some but fewer than ``detectors``.
+    """
+    columns = {"next_visits": _counts(next_visits), "exposures": _counts(exposures)}
+    for name, counts in (
+        ("raws", raws),
+        ("preprocessed", preprocessed),
+        ("loki_failures", loki_failures),
+    ):
+        if counts is not None:
+            columns[name] = pandas.Series(counts, dtype="int64")
+    ledger = pandas.concat(columns, axis=1, join="outer", sort=True)
+    # The other sources can name groups of other surveys, which are not ours
+    # to reconcile.
+    ledger = ledger[ledger["next_visits"].notna() | ledger["exposures"].notna()]
+    ledger = ledger.fillna(0).astype("int64")
+    ledger.index.name = "group"
+    ledger.insert(1, "canceled", ledger.index.isin(list(canceled)))
+
+    live = (ledger["next_visits"] > 0) & ~ledger["canceled"]
+    exposed = ledger["exposures"] > 0
+    processed = pandas.Series(False, index=ledger.index)
+    for name in ("preprocessed", "loki_failures"):
+        if name in ledger:
+            processed |= ledger[name] > 0
+    partial = pandas.Series(False, index=ledger.index)
+    if detectors is not None:
+        if "raws" in ledger:
+            partial |= exposed & (ledger["raws"] < ledger["exposures"] * detectors)
+        if "preprocessed" in ledger:
+            partial |= live & ledger["preprocessed"].between(1, detectors - 1)
+    ledger["next_visit_without_raw"] = live & ~exposed
+    ledger["raw_without_next_visit"] = exposed & ~live
+    ledger["canceled_but_processed"] = ledger["canceled"] & processed
+    ledger["partial_coverage"] = partial
+    return ledger
+
+
+def ledger_to_dict(ledger):
+    """Convert a ledger to JSON-serializable columns.
+
+    Parameters
+    ----------
+    ledger : `pandas.DataFrame`
+        As returned by `build_ledger`.
+
+    Returns
+    -------
+    columns : `dict` [`str`, `list`]
+        ``group`` and every column of the ledger.
+    """
+    columns = {"group": ledger.index.tolist()}
+    columns.update({name: ledger[name].tolist() for name in ledger.columns})
+    return columns
+
+
+def ledger_frame(columns):
+    """Convert columns from `ledger_to_dict` back to a ledger."""
+    return pandas.DataFrame(columns).set_index("group")
@@ -0,0 +1,298 @@
+# This file is part of nightly-reporting-jobs.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Shared concurrency limits for the services the report queries.
+
+Each backend (Loki, the Butler registry and datastore, the EFD) has one
+`AdaptiveLimiter` shared by every caller in the process. Its limit grows
+by one per limit's worth of fast, successful calls made while it is
+saturated, and halves, at most once per round trip, on errors or slow
+calls (AIMD).
+"""
+
+__all__ = [
+    "BACKENDS",
+    "AdaptiveLimiter",
+    "get_limiter",
+    "limiter_stats",
+    "log_limiter_stats",
+]
+import asyncio
+import contextlib
+import logging
+import math
+import threading
+import time
+
+logging.basicConfig(
+    format="{levelname} {asctime} {name} - {message}",
+    style="{",
+)
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.DEBUG)
+
+# Starting limit, bounds, and the latency in seconds above which a call
+# counts as congestion.
+BACKENDS = {
+    "loki": dict(initial=2, min_limit=1, max_limit=8, target_latency=120.0),
+    "butler": dict(initial=4, min_limit=1, max_limit=16, target_latency=30.0),
+    "efd": dict(initial=2, min_limit=1, max_limit=4, target_latency=30.0),
+}
+
+
+class _Slot:
+    """Handle given to the caller holding a slot."""
+
+    def __init__(self):
+        self.error = False
+
+    def fail(self):
+        """Count this call as an error without raising."""
+        self.error = True
+
+
+class AdaptiveLimiter:
+    """Limit the number of concurrent calls to one backend.
+
+    Parameters
+    ----------
+    name : `str`
+        Backend name, used in the trace output.
+    initial : `int`
+        Starting limit.
+    min_limit, max_limit : `int`
+        Bounds of the limit.
+    target_latency : `float`
+        Calls slower than this, in seconds, decrease the limit.
+    backoff : `float`
+        Factor applied to the limit on a decrease.
+    """
+
+    def __init__(
+        self, name, initial=4, min_limit=1, max_limit=16, target_latency=30.0, backoff=0.5
+    ):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self._limit = float(initial)
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        self._max_waiting = 0
+        self._calls = 0
+        self._errors = 0
+        self._slow = 0
+        self._latency = 0.0
+        self._max_latency = 0.0
+        self._last_decrease = -math.inf
+
+    @property
+    def limit(self):
+        """The current number of concurrent calls allowed."""
+        return max(int(self._limit), self.min_limit)
+
+    def acquire(self, blocking=True):
+        """Take a slot.
+
+        Parameters
+        ----------
+        blocking : `bool`, optional
+            Whether to wait for a slot if none is free.
+
+        Returns
+        -------
+        acquired : `bool`
+        """
+        with self._cond:
+            if self._in_flight >= self.limit:
+                if not blocking:
+                    return False
+                self._waiting += 1
+                self._max_waiting = max(self._max_waiting, self._waiting)
+                _log.debug(f"{self.name}: queued ({self._trace()})")
+                while self._in_flight >= self.limit:
+                    self._cond.wait()
+                self._waiting -= 1
+            self._in_flight += 1
+            return True
+
+    def release(self, latency, error=False):
+        """Return a slot and adjust the limit.
+
+        Parameters
+        ----------
+        latency : `float`
+            Duration of the call in seconds.
+        error : `bool`, optional
+            Whether the call failed.
+        """
+        with self._cond:
+            # Only grow a limit that is actually being used.
+            saturated = self._in_flight >= self.limit or self._waiting > 0
+            self._in_flight -= 1
+            self._calls += 1
+            self._latency += latency
+            self._max_latency = max(self._max_latency, latency)
+            before = self.limit
+            now = time.monotonic()
+            if error or latency > self.target_latency:
+                self._errors += error
+                self._slow += not error
+                # Only back off once per round trip, as the calls in flight
+                # were all sent at the old limit.
+                if now - self._last_decrease > latency:
+                    self._limit = max(self._limit * self.backoff, self.min_limit)
+                    self._last_decrease = now
+            elif saturated:
+                self._limit = min(self._limit + 1 / self._limit, self.max_limit)
+            if self.limit != before:
+                reason = "error" if error else f"{latency:.1f} s"
+                _log.debug(
+                    f"{self.name}: limit {before} -> {self.limit} after {reason} ({self._trace()})"
+                )
+            self._cond.notify_all()
+
+    def _discard(self):
+        """Return a slot that was not used, leaving the limit alone."""
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def _trace(self):
+        return f"limit {self.limit}, in flight {self._in_flight}, queued {self._waiting}"
+
+    @contextlib.contextmanager
+    def slot(self, expected=()):
+        """Hold a slot for the duration of a call.
+
+        Parameters
+        ----------
+        expected : `tuple` [`type`], optional
+            Exception types that are normal answers, not backend errors.
+
+        Yields
+        ------
+        slot : `_Slot`
+            Call ``slot.fail()`` to report an error that was not raised.
+        """
+        self.acquire()
+        slot = _Slot()
+        start = time.monotonic()
+        try:
+            yield slot
+        except expected:
+            raise
+        except Exception:
+            slot.error = True
+            raise
+        finally:
+            self.release(time.monotonic() - start, slot.error)
+
+    @contextlib.asynccontextmanager
+    async def async_slot(self):
+        """Hold a slot for the duration of an awaited call."""
+        if not self.acquire(blocking=False):
+            acquiring = asyncio.ensure_future(asyncio.to_thread(self.acquire))
+            try:
+                await asyncio.shield(acquiring)
+            except asyncio.CancelledError:
+                # The thread still takes the slot; give it back once it has.
+                acquiring.add_done_callback(lambda _: self._discard())
+                raise
+        slot = _Slot()
+        start = time.monotonic()
+        try:
+            yield slot
+        except Exception:
+            slot.error = True
+            raise
+        finally:
+            self.release(time.monotonic() - start, slot.error)
+
+    def call(self, func, *args, **kwargs):
+        """Call ``func`` while holding a slot."""
+        with self.slot():
+            return func(*args, **kwargs)
+
+    def stats(self):
+        """Return the current state and counters.
+
+        Returns
+        -------
+        stats : `dict`
+        """
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "in_flight": self._in_flight,
+                "queued": self._waiting,
+                "max_queued": self._max_waiting,
+                "calls": self._calls,
+                "errors": self._errors,
+                "slow": self._slow,
+                "latency": self._latency,
+                "max_latency": self._max_latency,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name):
+    """Return the process-wide limiter of a backend.
+
+    Parameters
+    ----------
+    name : `str`
+        One of `BACKENDS`; other names get the default settings.
+    """
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = AdaptiveLimiter(name, **BACKENDS.get(name, {}))
+        return _limiters[name]
+
+
+def limiter_stats():
+    """Return the stats of every limiter used so far.
+
+    Returns
+    -------
+    stats : `dict` [`str`, `dict`]
+        `AdaptiveLimiter.stats` by backend name.
+    """
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.stats() for limiter in limiters}
+
+
+def log_limiter_stats():
+    """Log the state of every limiter used so far."""
+    for name, stats in limiter_stats().items():
+        _log.info(
+            f"{name}: "
+            + ", ".join(
+                f"{key} {value:.1f}" if isinstance(value, float) else f"{key} {value}"
+                for key, value in stats.items()
+            )
+        )
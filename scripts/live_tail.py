@@ -0,0 +1,599 @@
+# This file is part of nightly-reporting-jobs.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Keep the nightly report's Loki and EFD counts up to date during the night.
+
+The daemon follows the instrument container's Loki stream and polls the
+nextVisit EFD topics, keeping per-group counters for the categories of
+`night_summary.LOKI_FAILURES`. Memory grows with the number of groups,
+not with the number of log lines. The counters are checkpointed so a
+restarted daemon resumes where it stopped, and the morning report reads
+them instead of rescanning the night::
+
+    INSTRUMENT=LSSTCam LIVE_CHECKPOINT_DIR=/checkpoints python live_tail.py
+"""
+
+__all__ = [
+    "RollingCounters",
+    "load_finished_counters",
+    "run_live_tail",
+]
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import pandas
+from astropy.time import Time
+
+from limiter import get_limiter
+from logql import parse_pipeline
+from matching import get_matcher
+from night_summary import LOKI_FAILURES, PREPROCESSING_SUCCESS, LokiFailure
+import queries
+from queries import get_start_end
+
+logging.basicConfig(
+    format="{levelname} {asctime} {name} - {message}",
+    style="{",
+)
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.DEBUG)
+
+# Tasks whose no-work messages are counted.
+NO_WORK_TASKS = ("associateApdb",)
+# How far back to restart the tail from the last line seen, to catch lines
+# that arrived out of order. Lines in this window are deduplicated.
+OVERLAP = timedelta(seconds=60)
+# How long after the end of a night to wait for its last lines.
+GRACE = timedelta(minutes=10)
+# Seconds to wait before reopening a tail that ended before the night did.
+REOPEN_DELAY = 10.0
+
+
+def _normalize_timestamp(timestamp):
+    """Return an RFC 3339 timestamp with nanoseconds, so that timestamps
+    compare correctly as strings.
+    """
+    timestamp = timestamp.rstrip("Z")
+    seconds, _, fraction = timestamp.partition(".")
+    return f"{seconds}.{fraction[:9]:0<9}Z"
+
+
+def _format_time(t):
+    return _normalize_timestamp(t.strftime("%Y-%m-%dT%H:%M:%S.%f"))
+
+
+class RollingCounters:
+    """Per-group counters of one instrument and night.
+
+    Parameters
+    ----------
+    day_obs : `str`
+        day_obs in the format of YYYY-MM-DD.
+    instrument : `str`
+        The instrument name.
+    """
+
+    def __init__(self, day_obs, instrument):
+        self.day_obs = day_obs
+        self.instrument = instrument
+        start, end = get_start_end(day_obs)
+        self.window = (_format_time(start), _format_time(end))
+        # Latest Loki timestamp seen, and hashes of the lines seen within
+        # OVERLAP of it.
+        self.loki_position = None
+        self.recent = {}
+        self.efd_position = None
+        self.finished = False
+        # group -> survey, for this instrument's nextVisit events.
+        self.visits = {}
+        self.canceled = set()
+        # group -> detector -> successful preprocessing, for this instrument.
+        self.preprocessed = {}
+        self.totals = Counter()
+        self.failures = {key: Counter() for key in LOKI_FAILURES}
+        self.breakdowns = {key: {} for key in LOKI_FAILURES}
+        self.detectors = {key: {} for key in LOKI_FAILURES}
+        self.no_work = Counter()
+        # task -> (exposure, detector) -> dropped quanta.
+        self.dropped = {task: Counter() for task in NO_WORK_TASKS}
+        self._pipelines = {
+            key: parse_pipeline(category.search_string)
+            for key, category in LOKI_FAILURES.items()
+        }
+        self._preprocessing = parse_pipeline(PREPROCESSING_SUCCESS.search_string)
+        self._no_work = {
+            task: (
+                f"Nothing to do for task '{task}",
+                f"Dropping task {task} because no quanta remain (1 had no work to do)",
+            )
+            for task in NO_WORK_TASKS
+        }
+
+    @staticmethod
+    def search_string():
+        """Return a LogQL pipeline keeping only lines that can be counted."""
+        literals = [PREPROCESSING_SUCCESS.match_string] + [
+            category.match_string for category in LOKI_FAILURES.values()
+        ]
+        needles = [parse_pipeline(s).literals[0] for s in literals]
+        for task in NO_WORK_TASKS:
+            needles += [f"Nothing to do for task '{task}", f"Dropping task {task}"]
+        return "|~ `" + "|".join(re.escape(n) for n in needles) + "`"
+
+    def resume_position(self):
+        """Return where to start the Loki tail from."""
+        if self.loki_position is None:
+            return self.window[0][:19] + "Z"
+        position = datetime.fromisoformat(self.loki_position[:19]) - OVERLAP
+        return max(position.strftime("%Y-%m-%dT%H:%M:%SZ"), self.window[0][:19] + "Z")
+
+    def add_loki_line(self, raw):
+        """Count one ``logcli --output=jsonl`` record.
+
+        Parameters
+        ----------
+        raw : `str`
+        """
+        entry = json.loads(raw)
+        timestamp = _normalize_timestamp(entry["timestamp"])
+        if not self.window[0] <= timestamp < self.window[1]:
+            return
+        key = hashlib.blake2b(raw.encode(), digest_size=8).hexdigest()
+        if key in self.recent:
+            return
+        if self.loki_position is None or timestamp > self.loki_position:
+            self.loki_position = timestamp
+            self._prune_recent()
+        if timestamp >= self._overlap_start():
+            self.recent[key] = timestamp
+
+        line = entry["line"]
+        fields = None
+
+        def parse():
+            try:
+                return json.loads(line)
+            except json.JSONDecodeError:
+                return {}
+
+        if self._preprocessing.match(line):
+            fields = parse()
+            if fields.get("instrument") == self.instrument:
+                self.preprocessed.setdefault(fields.get("group"), Counter())[
+                    str(fields.get("detector"))
+                ] += 1
+        for category_key, pipeline in self._pipelines.items():
+            if not pipeline.match(line):
+                continue
+            self.totals[category_key] += 1
+            if fields is None:
+                fields = parse()
+            if fields.get("instrument") != self.instrument:
+                continue
+            group = fields.get("group")
+            self.failures[category_key][group] += 1
+            self.detectors[category_key].setdefault(group, Counter())[
+                str(fields.get("detector"))
+            ] += 1
+            messages = LOKI_FAILURES[category_key].messages
+            if messages:
+                found = get_matcher(messages).search(fields.get("message") or "")
+                breakdown = self.breakdowns[category_key].setdefault(group, Counter())
+                for index in found:
+                    breakdown[messages[index]] += 1
+        for task, (nothing, dropped) in self._no_work.items():
+            if nothing in line:
+                self.no_work[task] += 1
+            elif dropped in line:
+                fields = parse()
+                exposures = fields.get("exposures")
+                exposure = exposures[0] if isinstance(exposures, list) and exposures else None
+                self.dropped[task][(exposure, fields.get("detector"))] += 1
+
+    def _overlap_start(self):
+        position = datetime.fromisoformat(self.loki_position[:19]) - OVERLAP
+        return position.strftime("%Y-%m-%dT%H:%M:%S")
+
+    def _prune_recent(self):
+        start = self._overlap_start()
+        if len(self.recent) > 1000:
+            self.recent = {k: t for k, t in self.recent.items() if t >= start}
+
+    def add_next_visits(self, df, canceled):
+        """Record nextVisit and nextVisitCanceled events.
+
+        Parameters
+        ----------
+        df, canceled : `pandas.DataFrame`
+            Events as returned by the EFD, not indexed by group.
+        """
+        if not df.empty:
+            mine = df[df["instrument"] == self.instrument]
+            self.visits.update(zip(mine["groupId"], mine["survey"]))
+            stamp = float(df["private_efdStamp"].max())
+            self.efd_position = max(self.efd_position or stamp, stamp)
+        if not canceled.empty:
+            self.canceled.update(canceled["groupId"])
+
+    def next_visit_events(self, survey):
+        """Return the events like `queries.get_next_visit_events`.
+
+        Parameters
+        ----------
+        survey : `str`
+            The imaging survey name of interest.
+        """
+        groups = [g for g, s in self.visits.items() if s == survey]
+        df = pandas.DataFrame(
+            {"groupId": groups, "survey": survey, "instrument": self.instrument}
+        ).set_index("groupId")
+        canceled = pandas.DataFrame({"groupId": sorted(self.canceled)})
+        return df, canceled
+
+    def get_failure(self, key, groups):
+        """Return a failure count like the report's Loki query would.
+
+        Parameters
+        ----------
+        key : `str`
+            Key of `night_summary.LOKI_FAILURES`.
+        groups : `list` [`str`]
+            Groups of the survey raws.
+        """
+        groups = set(groups)
+        counts = self.failures[key]
+        failure = LokiFailure(
+            count=sum(n for g, n in counts.items() if g in groups),
+            total=self.totals[key],
+        )
+        messages = LOKI_FAILURES[key].messages
+        if messages and failure.count:
+            breakdown = Counter()
+            for group, counter in self.breakdowns[key].items():
+                if group in groups:
+                    breakdown.update(counter)
+            failure.breakdown = {msg: breakdown[msg] for msg in messages}
+        if LOKI_FAILURES[key].list_groups:
+            failure.groups = [g for g, n in counts.items() if n and g in groups]
+        failure.by_group = {g: n for g, n in counts.items() if n and g in groups}
+        detectors = Counter()
+        for group, counter in self.detectors[key].items():
+            if group in groups:
+                detectors.update(counter)
+        failure.detectors = {
+            d: detectors[d] for d in sorted(detectors, key=int) if d.isdigit()
+        }
+        return failure
+
+    def get_preprocessed(self, groups):
+        """Return successful preprocessing like the report's Loki query would.
+
+        Parameters
+        ----------
+        groups : `list` [`str`]
+            Groups of the survey raws.
+
+        Returns
+        -------
+        detectors : `dict` [`str`, `int`]
+            Preprocessing by detector.
+        by_group : `dict` [`str`, `int`]
+            Preprocessing by group.
+        """
+        detectors = Counter()
+        by_group = {}
+        for group in set(groups) & self.preprocessed.keys():
+            counter = self.preprocessed[group]
+            detectors.update(counter)
+            by_group[group] = sum(counter.values())
+        detectors = {
+            d: detectors[d] for d in sorted(detectors, key=int) if d.isdigit()
+        }
+        return detectors, by_group
+
+    def get_no_work_count(self, task, visit_detector=None):
+        """Return counts like `queries.get_no_work_count_from_loki`."""
+        dropped = self.dropped[task]
+        if visit_detector is None:
+            return self.no_work[task], dropped.total()
+        return self.no_work[task], sum(
+            n for vd, n in dropped.items() if vd in visit_detector
+        )
+
+    def to_json(self):
+        """Serialize the counters and stream positions."""
+        return json.dumps(
+            {
+                "day_obs": self.day_obs,
+                "instrument": self.instrument,
+                "loki_position": self.loki_position,
+                "recent": self.recent,
+                "efd_position": self.efd_position,
+                "finished": self.finished,
+                "visits": self.visits,
+                "canceled": sorted(self.canceled),
+                "preprocessed": self.preprocessed,
+                "totals": self.totals,
+                "failures": self.failures,
+                "breakdowns": self.breakdowns,
+                "detectors": self.detectors,
+                "no_work": self.no_work,
+                "dropped": {
+                    task: [[e, d, n] for (e, d), n in counter.items()]
+                    for task, counter in self.dropped.items()
+                },
+            }
+        )
+
+    @classmethod
+    def from_json(cls, text):
+        """Deserialize counters made by `to_json`."""
+        data = json.loads(text)
+        counters = cls(data["day_obs"], data["instrument"])
+        counters.loki_position = data["loki_position"]
+        counters.recent = data["recent"]
+        counters.efd_position = data["efd_position"]
+        counters.finished = data["finished"]
+        counters.visits = data["visits"]
+        counters.canceled = set(data["canceled"])
+        counters.preprocessed = {
+            g: Counter(c) for g, c in data["preprocessed"].items()
+        }
+        counters.totals = Counter(data["totals"])
+        counters.failures = {k: Counter(v) for k, v in data["failures"].items()}
+        counters.breakdowns = {
+            k: {g: Counter(c) for g, c in v.items()}
+            for k, v in data["breakdowns"].items()
+        }
+        counters.detectors = {
+            k: {g: Counter(c) for g, c in v.items()}
+            for k, v in data["detectors"].items()
+        }
+        counters.no_work = Counter(data["no_work"])
+        counters.dropped = {
+            task: Counter({(e, d): n for e, d, n in entries})
+            for task, entries in data["dropped"].items()
+        }
+        return counters
+
+
+def _checkpoint_path(checkpoint_dir, instrument, day_obs):
+    return os.path.join(checkpoint_dir, f"{instrument}-{day_obs}.json")
+
+
+def _save(counters, path):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(counters.to_json())
+    os.replace(tmp, path)
+
+
+def load_finished_counters(checkpoint_dir, instrument, day_obs):
+    """Return the counters of a night the daemon followed to its end.
+
+    Parameters
+    ----------
+    checkpoint_dir : `str`
+        Directory of the daemon's checkpoints.
+    instrument : `str`
+        The instrument name.
+    day_obs : `str`
+        day_obs in the format of YYYY-MM-DD.
+
+    Returns
+    -------
+    counters : `RollingCounters` or `None`
+        `None` if there is no checkpoint or the night was not finished.
+    """
+    path = _checkpoint_path(checkpoint_dir, instrument, day_obs)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        counters = RollingCounters.from_json(f.read())
+    if not counters.finished:
+        _log.warning(f"Live counters for {instrument} {day_obs} are incomplete.")
+        return None
+    return counters
+
+
+async def _select_next_visits(efd_client, day_obs, since):
+    start, end = get_start_end(day_obs)
+    if since is not None:
+        start = max(start, Time(since, format="unix", scale="utc"))
+    topic = "lsst.sal.ScriptQueue.logevent_nextVisit"
+    async with get_limiter("efd").async_slot():
+        df = await efd_client.select_time_series(topic, ["*"], start.utc, end.utc)
+    async with get_limiter("efd").async_slot():
+        canceled = await efd_client.select_time_series(
+            topic + "Canceled", ["*"], start.utc, end.utc
+        )
+    return df, canceled
+
+
+def run_live_tail(
+    day_obs,
+    instrument,
+    checkpoint_dir,
+    tail=None,
+    efd_client_factory=None,
+    checkpoint_interval=60.0,
+    efd_interval=60.0,
+    backfill=None,
+):
+    """Follow one night until its end, checkpointing along the way.
+
+    Parameters
+    ----------
+    day_obs : `str`
+        day_obs in the format of YYYY-MM-DD.
+    instrument : `str`
+        The instrument name.
+    checkpoint_dir : `str`
+        Directory to keep the checkpoint in.
+    tail : callable, optional
+        Called as ``tail(container_name, search_string, start, until)`` to
+        follow Loki; `queries.tail_loki`, looked up at call time, by
+        default. It is reopened if it returns before the end of the night
+        and `GRACE`.
+    efd_client_factory : callable, optional
+        Returns an `lsst_efd_client.EfdClient`-like object.
+    checkpoint_interval, efd_interval : `float`
+        Seconds between checkpoints and between EFD polls.
+    backfill : callable, optional
+        Called as ``backfill(container_name, search_string, start, end)``
+        to catch up from the last position to the present before each
+        (re)opening of the tail, whose own backfill is limited;
+        `queries.iter_loki_window`, looked up at call time, by default.
+
+    Returns
+    -------
+    counters : `RollingCounters`
+    """
+    if tail is None:
+        tail = queries.tail_loki
+    if backfill is None:
+        backfill = queries.iter_loki_window
+    if efd_client_factory is None:
+        from lsst_efd_client import EfdClient
+
+        def efd_client_factory():
+            return EfdClient("usdf_efd")
+
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    path = _checkpoint_path(checkpoint_dir, instrument, day_obs)
+    if os.path.exists(path):
+        with open(path) as f:
+            counters = RollingCounters.from_json(f.read())
+        _log.info(f"Resuming {instrument} {day_obs} from {counters.loki_position}")
+    else:
+        counters = RollingCounters(day_obs, instrument)
+    if counters.finished:
+        return counters
+
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def poll_efd():
+        df, canceled = asyncio.run(
+            _select_next_visits(efd_client_factory(), day_obs, counters.efd_position)
+        )
+        with lock:
+            counters.add_next_visits(df, canceled)
+
+    def efd_loop():
+        while not stop.wait(efd_interval):
+            try:
+                poll_efd()
+            except Exception:
+                _log.exception("EFD poll failed; retrying.")
+
+    poller = threading.Thread(target=efd_loop, daemon=True)
+    poller.start()
+    last_checkpoint = time.monotonic()
+    _, end = get_start_end(day_obs)
+    until = end.to_datetime(timezone=timezone.utc) + GRACE
+
+    def add(lines):
+        nonlocal last_checkpoint
+        for raw in lines:
+            with lock:
+                counters.add_loki_line(raw)
+                if time.monotonic() - last_checkpoint > checkpoint_interval:
+                    _save(counters, path)
+                    last_checkpoint = time.monotonic()
+
+    try:
+        while True:
+            start = datetime.strptime(
+                counters.resume_position(), "%Y-%m-%dT%H:%M:%SZ"
+            ).replace(tzinfo=timezone.utc)
+            caught_up = min(_now().replace(microsecond=0), until)
+            if start < caught_up:
+                add(
+                    backfill(
+                        instrument.lower(), counters.search_string(), start, caught_up
+                    )
+                )
+            if caught_up >= until:
+                break
+            add(
+                tail(
+                    instrument.lower(),
+                    counters.search_string(),
+                    caught_up.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    until,
+                )
+            )
+            if _now() >= until:
+                break
+            with lock:
+                _save(counters, path)
+                last_checkpoint = time.monotonic()
+            _log.warning(
+                f"Loki tail ended early; reopening from {counters.resume_position()}"
+            )
+            time.sleep(REOPEN_DELAY)
+    finally:
+        stop.set()
+        poller.join()
+        with lock:
+            _save(counters, path)
+    poll_efd()
+    counters.finished = True
+    _save(counters, path)
+    _log.info(f"Finished following {instrument} {day_obs}")
+    return counters
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _current_day_obs():
+    return (_now() - timedelta(hours=12)).strftime("%Y-%m-%d")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--day-obs", help="Follow only this night instead of every night."
+    )
+    args = parser.parse_args()
+
+    instrument = os.getenv("INSTRUMENT") or "LSSTCam"
+    checkpoint_dir = os.getenv("LIVE_CHECKPOINT_DIR")
+    if not checkpoint_dir:
+        raise SystemExit("Must set environment variable LIVE_CHECKPOINT_DIR")
+
+    if args.day_obs:
+        run_live_tail(args.day_obs, instrument, checkpoint_dir)
+    else:
+        while True:
+            run_live_tail(_current_day_obs(), instrument, checkpoint_dir)
@@ -0,0 +1,238 @@
+# This file is part of nightly-reporting-jobs.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Group error messages nobody has a pattern for into templates.
+
+`TemplateMiner` is a streaming variant of Drain (He et al., ICWS 2017):
+messages are routed by length and leading tokens to a small list of
+templates and merged into the most similar one, positions that differ
+becoming ``<*>``. Memory is bounded by ``max_clusters``; the least recently
+matched template is dropped when a new one does not fit.
+"""
+
+__all__ = [
+    "WILDCARD",
+    "TemplateMiner",
+    "mine_loki_errors",
+]
+import json
+import logging
+import re
+from collections import OrderedDict
+
+import queries
+from logql import parse_pipeline
+from night_summary import LOKI_FAILURES, ErrorTemplate
+
+logging.basicConfig(
+    format="{levelname} {asctime} {name} - {message}",
+    style="{",
+)
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.DEBUG)
+
+WILDCARD = "<*>"
+# Tokens with a digit are ids, sizes or paths and never route or match.
+_VARIABLE = re.compile(r"\d")
+
+
+class _Cluster:
+    __slots__ = ("tokens", "count", "examples", "leaf")
+
+    def __init__(self, tokens, leaf):
+        self.tokens = tokens
+        self.count = 0
+        self.examples = []
+        self.leaf = leaf
+
+
+class TemplateMiner:
+    """Incrementally cluster messages into templates.
+
+    Parameters
+    ----------
+    depth : `int`, optional
+        Number of leading tokens used to route a message.
+    similarity : `float`, optional
+        Fraction of tokens a message must share with a template to join it.
+    max_children : `int`, optional
+        Maximum number of distinct tokens at each routing level; further
+        tokens are routed as ``<*>``.
+    max_clusters : `int`, optional
+        Maximum number of templates kept.
+    max_examples : `int`, optional
+        Number of distinct examples kept per template.
+    max_tokens : `int`, optional
+        Messages are truncated to this many tokens.
+    """
+
+    def __init__(
+        self,
+        depth=2,
+        similarity=0.5,
+        max_children=64,
+        max_clusters=1000,
+        max_examples=3,
+        max_tokens=48,
+    ):
+        self.depth = depth
+        self.similarity = similarity
+        self.max_children = max_children
+        self.max_clusters = max_clusters
+        self.max_examples = max_examples
+        self.max_tokens = max_tokens
+        self.lines = 0
+        self.evicted = 0
+        self._root = {}
+        # Clusters in least recently matched order.
+        self._clusters = OrderedDict()
+        self._next_id = 0
+
+    def tokenize(self, message):
+        """Split a message into tokens, masking the variable ones.
+
+        Only the last non-empty line is kept, which for a traceback is the
+        exception.
+        """
+        lines = [line for line in message.splitlines() if line.strip()]
+        if not lines:
+            return []
+        tokens = lines[-1].split()[: self.max_tokens]
+        return [WILDCARD if _VARIABLE.search(t) else t for t in tokens]
+
+    def add(self, message, example=None):
+        """Add one message.
+
+        Parameters
+        ----------
+        message : `str`
+        example : `str`, optional
+            What the message came from, such as its group; a few distinct
+            ones are kept per template.
+        """
+        tokens = self.tokenize(message)
+        if not tokens:
+            return
+        self.lines += 1
+        leaf = self._leaf(tokens)
+        cluster = self._best_match(leaf, tokens)
+        if cluster is None:
+            cluster = _Cluster(tokens, leaf)
+            cluster_id = self._next_id
+            self._next_id += 1
+            leaf[cluster_id] = cluster
+            self._clusters[cluster_id] = cluster
+            if len(self._clusters) > self.max_clusters:
+                self._evict()
+        else:
+            cluster.tokens = [
+                t if t == m else WILDCARD for t, m in zip(cluster.tokens, tokens)
+            ]
+        cluster.count += 1
+        if (
+            example is not None
+            and len(cluster.examples) < self.max_examples
+            and example not in cluster.examples
+        ):
+            cluster.examples.append(example)
+
+    def _leaf(self, tokens):
+        node = self._root.setdefault(len(tokens), {})
+        for token in tokens[: self.depth]:
+            if token not in node:
+                if len(node) >= self.max_children:
+                    token = WILDCARD
+                node = node.setdefault(token, {})
+            else:
+                node = node[token]
+        return node
+
+    def _best_match(self, leaf, tokens):
+        best, best_score = None, (-1.0, -1)
+        for cluster_id, cluster in leaf.items():
+            same = params = 0
+            for t, m in zip(cluster.tokens, tokens):
+                if t == WILDCARD:
+                    params += 1
+                elif t == m:
+                    same += 1
+            score = (same / len(tokens), params)
+            if score > best_score:
+                best, best_score = cluster_id, score
+        if best is None or best_score[0] < self.similarity:
+            return None
+        self._clusters.move_to_end(best)
+        return leaf[best]
+
+    def _evict(self):
+        cluster_id, cluster = self._clusters.popitem(last=False)
+        del cluster.leaf[cluster_id]
+        self.evicted += cluster.count
+
+    def top(self, k):
+        """Return the most frequent templates.
+
+        Parameters
+        ----------
+        k : `int`
+
+        Returns
+        -------
+        templates : `list` [`night_summary.ErrorTemplate`]
+        """
+        clusters = sorted(self._clusters.values(), key=lambda c: -c.count)[:k]
+        return [
+            ErrorTemplate(" ".join(c.tokens), c.count, list(c.examples))
+            for c in clusters
+        ]
+
+
+def mine_loki_errors(day_obs, instrument, groups, miner):
+    """Feed the failures Loki has no known pattern for to a miner.
+
+    Parameters
+    ----------
+    day_obs : `str`
+        day_obs in the format of YYYY-MM-DD.
+    instrument : `str`
+        The instrument name.
+    groups : `list` [`str`]
+        Groups of the survey raws; other failures are ignored.
+    miner : `TemplateMiner`
+    """
+    known = [parse_pipeline(c.search_string) for c in LOKI_FAILURES.values()]
+    groups = set(groups)
+    for raw in queries.iter_loki(
+        day_obs,
+        container_name=instrument.lower(),
+        search_string='|= "Processing failed" | json | level="ERROR"',
+    ):
+        try:
+            line = json.loads(raw)["line"]
+            fields = json.loads(line)
+        except (json.JSONDecodeError, KeyError) as e:
+            _log.error(f"Failed to parse \n{raw}\n JSON decode error: {e}")
+            continue
+        if fields.get("instrument") != instrument or fields.get("group") not in groups:
+            continue
+        if any(pipeline.match(line) for pipeline in known):
+            continue
+        miner.add(fields.get("message") or "", example=fields["group"])
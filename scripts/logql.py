@@ -0,0 +1,178 @@
+# This file is part of nightly-reporting-jobs.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Evaluate the subset of LogQL log pipelines used by the report queries.
+
+Only the stages passed as ``search_string`` to `queries.query_loki` are
+supported: line filters (``|=``, ``!=``, ``|~``, ``!~``), the ``| json``
+parser and label filters on parsed fields (``| level="ERROR"``).
+"""
+
+__all__ = [
+    "LogPipeline",
+    "parse_pipeline",
+]
+import json
+import re
+from dataclasses import dataclass, field
+
+_TOKEN = re.compile(
+    r"""\s*(?:
+        (?P<line_op>\|=|!=|\|~|!~)\s*(?P<line_value>"(?:[^"\\]|\\.)*"|`[^`]*`)
+      | \|\s*json\b
+      | \|\s*(?P<label>\w+)\s*(?P<label_op>=~|!~|!=|==|=)\s*(?P<label_value>"(?:[^"\\]|\\.)*"|`[^`]*`)
+    )""",
+    re.VERBOSE,
+)
+
+
+def _unquote(value):
+    if value.startswith("`"):
+        return value[1:-1]
+    return json.loads(value)
+
+
+@dataclass
+class LogPipeline:
+    """A parsed LogQL log pipeline.
+
+    Attributes
+    ----------
+    line_filters : `list` [`tuple`]
+        ``(operator, value)`` pairs applied to the raw line, in order.
+    label_filters : `list` [`tuple`]
+        ``(label, operator, value)`` triples applied to the parsed JSON line.
+    """
+
+    line_filters: list = field(default_factory=list)
+    label_filters: list = field(default_factory=list)
+
+    def __post_init__(self):
+        self._compiled = [
+            (op, re.compile(value) if op in ("|~", "!~") else value)
+            for op, value in self.line_filters
+        ]
+
+    @property
+    def literals(self):
+        """Substrings that every matching line must contain."""
+        return [value for op, value in self.line_filters if op == "|="]
+
+    def match_line(self, line):
+        """Return whether the raw text of a log line passes the line filters.
+
+        Parameters
+        ----------
+        line : `str`
+            The log line, as stored by Loki.
+        """
+        for op, value in self._compiled:
+            if op == "|=":
+                if value not in line:
+                    return False
+            elif op == "!=":
+                if value in line:
+                    return False
+            elif op == "|~":
+                if not value.search(line):
+                    return False
+            elif value.search(line):
+                return False
+        return True
+
+    def match_labels(self, fields):
+        """Return whether parsed fields pass the label filters.
+
+        Parameters
+        ----------
+        fields : `dict`
+            Fields extracted by the ``json`` stage.
+        """
+        for label, op, value in self.label_filters:
+            actual = fields.get(label)
+            actual = "" if actual is None else str(actual)
+            if op in ("=", "=="):
+                ok = actual == value
+            elif op == "!=":
+                ok = actual != value
+            elif op == "=~":
+                ok = re.fullmatch(value, actual) is not None
+            else:
+                ok = re.fullmatch(value, actual) is None
+            if not ok:
+                return False
+        return True
+
+    def match(self, line):
+        """Return whether a log line passes the whole pipeline.
+
+        Parameters
+        ----------
+        line : `str`
+            The log line, as stored by Loki.
+        """
+        if not self.match_line(line):
+            return False
+        if not self.label_filters:
+            return True
+        try:
+            fields = json.loads(line)
+        except json.JSONDecodeError:
+            return False
+        return isinstance(fields, dict) and self.match_labels(fields)
+
+
+def parse_pipeline(search_string):
+    """Parse the log pipeline part of a LogQL query.
+
+    Parameters
+    ----------
+    search_string : `str`
+        The pipeline following the stream selector, e.g.
+        ``'|= "prep_butler" | json | level="ERROR"'``.
+
+    Returns
+    -------
+    pipeline : `LogPipeline`
+
+    Raises
+    ------
+    ValueError
+        Raised if the string contains an unsupported stage.
+    """
+    pipeline = LogPipeline()
+    pos = 0
+    search_string = search_string.strip()
+    while pos < len(search_string):
+        m = _TOKEN.match(search_string, pos)
+        if not m or m.end() == pos:
+            raise ValueError(f"Unsupported LogQL stage: {search_string[pos:]!r}")
+        if m["line_op"]:
+            pipeline.line_filters.append((m["line_op"], _unquote(m["line_value"])))
+        elif m["label"]:
+            pipeline.label_filters.append(
+                (m["label"], m["label_op"], _unquote(m["label_value"]))
+            )
+        pos = m.end()
+        while pos < len(search_string) and search_string[pos].isspace():
+            pos += 1
+    pipeline.__post_init__()
+    return pipeline
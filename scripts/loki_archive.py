@@ -0,0 +1,391 @@
+# This file is part of nightly-reporting-jobs.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Keep a night of one container's Loki lines in an indexed local archive.
+
+Lines are stored in zlib-compressed blocks, with an inverted index from
+the words of each line and from its ``group``, ``detector``, ``level`` and
+``instrument`` fields to the lines containing them. A query narrows the
+candidates with the index and evaluates the full LogQL pipeline on those
+only. Digits are collapsed in indexed words, which keeps the vocabulary
+small and still lets any ``|=`` substring be looked up::
+
+    python loki_archive.py --day-obs 2025-06-01 --instrument LSSTCam /archive
+
+The night is fetched in time windows, halved until each returns fewer
+lines than `queries.LOKI_LIMIT`, so that the archive is complete.
+
+`queries.query_loki` serves a night from the archive when
+``LOKI_ARCHIVE_DIR`` points to it.
+"""
+
+__all__ = [
+    "INDEXED_FIELDS",
+    "LokiArchive",
+    "archive_path",
+]
+import argparse
+import bisect
+import functools
+import json
+import logging
+import os
+import re
+import shutil
+import zlib
+from array import array
+
+import numpy as np
+
+from logql import parse_pipeline
+
+logging.basicConfig(
+    format="{levelname} {asctime} {name} - {message}",
+    style="{",
+)
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.DEBUG)
+
+INDEXED_FIELDS = ("group", "detector", "level", "instrument")
+_WORD = re.compile(r"\w+")
+_DIGITS = re.compile(r"\d+")
+
+
+def _normalize(word):
+    return _DIGITS.sub("0", word)
+
+
+def archive_path(root, container_name, day_obs):
+    """Return where the archive of a container and night is kept."""
+    return os.path.join(root, container_name, day_obs)
+
+
+class LokiArchive:
+    """A read-only archive of Loki lines.
+
+    Parameters
+    ----------
+    directory : `str`
+        A directory written by `build`.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "terms.json")) as f:
+            meta = json.load(f)
+        self.n_lines = meta["lines"]
+        self.block_size = meta["block_size"]
+        self._terms = meta["terms"]
+        self._term_ids = {term: i for i, term in enumerate(self._terms)}
+        reversed_terms = sorted((t[::-1], i) for i, t in enumerate(self._terms))
+        self._reversed = [t for t, _ in reversed_terms]
+        self._reversed_ids = [i for _, i in reversed_terms]
+        self._fields = {
+            name: {value: i for i, value in enumerate(values)}
+            for name, values in meta["fields"].items()
+        }
+        with np.load(os.path.join(directory, "index.npz")) as index:
+            self._block_offsets = index["block_offsets"]
+            self._term_offsets = index["term_offsets"]
+            self._postings = index["postings"]
+            self._field_offsets = {
+                name: index[f"field_offsets_{name}"] for name in self._fields
+            }
+            self._field_postings = {
+                name: index[f"field_postings_{name}"] for name in self._fields
+            }
+        self._blocks = open(os.path.join(directory, "blocks.bin"), "rb")
+
+    def close(self):
+        self._blocks.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @classmethod
+    def build(cls, directory, records, block_size=256):
+        """Write an archive.
+
+        Parameters
+        ----------
+        directory : `str`
+            Where to write; replaced if it exists.
+        records : iterable [`str`]
+            Lines in the ``logcli --output=jsonl`` format.
+        block_size : `int`, optional
+            Number of lines per compressed block.
+
+        Returns
+        -------
+        archive : `LokiArchive`
+        """
+        tmp = directory.rstrip("/") + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        term_ids = {}
+        occurrences = (array("I"), array("I"))
+        field_ids = {name: {} for name in INDEXED_FIELDS}
+        field_occurrences = {name: (array("I"), array("I")) for name in INDEXED_FIELDS}
+        block_offsets = [0]
+        block = []
+        n = 0
+        with open(os.path.join(tmp, "blocks.bin"), "wb") as out:
+
+            def flush():
+                data = zlib.compress("\n".join(block).encode())
+                out.write(data)
+                block_offsets.append(block_offsets[-1] + len(data))
+                block.clear()
+
+            for raw in records:
+                raw = raw.rstrip("\n")
+                if not raw:
+                    continue
+                line = json.loads(raw)["line"]
+                for word in {_normalize(w) for w in _WORD.findall(line)}:
+                    occurrences[0].append(term_ids.setdefault(word, len(term_ids)))
+                    occurrences[1].append(n)
+                try:
+                    fields = json.loads(line)
+                except json.JSONDecodeError:
+                    fields = None
+                if isinstance(fields, dict):
+                    for name in INDEXED_FIELDS:
+                        value = fields.get(name)
+                        value = "" if value is None else str(value)
+                        ids = field_ids[name]
+                        field_occurrences[name][0].append(ids.setdefault(value, len(ids)))
+                        field_occurrences[name][1].append(n)
+                block.append(raw)
+                n += 1
+                if len(block) == block_size:
+                    flush()
+            if block:
+                flush()
+
+        terms, term_offsets, postings = _invert(term_ids, occurrences)
+        arrays = {
+            "block_offsets": np.array(block_offsets, dtype=np.int64),
+            "term_offsets": term_offsets,
+            "postings": postings,
+        }
+        fields = {}
+        for name in INDEXED_FIELDS:
+            values, offsets, field_postings = _invert(
+                field_ids[name], field_occurrences[name]
+            )
+            fields[name] = values
+            arrays[f"field_offsets_{name}"] = offsets
+            arrays[f"field_postings_{name}"] = field_postings
+        np.savez_compressed(os.path.join(tmp, "index.npz"), **arrays)
+        with open(os.path.join(tmp, "terms.json"), "w") as f:
+            json.dump(
+                {"lines": n, "block_size": block_size, "terms": terms, "fields": fields},
+                f,
+            )
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(os.path.dirname(os.path.abspath(directory)), exist_ok=True)
+        os.replace(tmp, directory)
+        _log.info(f"Archived {n} lines and {len(terms)} words in {directory}")
+        return cls(directory)
+
+    def _term_postings(self, term_id):
+        start, end = self._term_offsets[term_id], self._term_offsets[term_id + 1]
+        return self._postings[start:end]
+
+    def _union(self, term_ids):
+        if not term_ids:
+            return np.empty(0, dtype=np.uint32)
+        if len(term_ids) == 1:
+            return self._term_postings(term_ids[0])
+        return np.unique(np.concatenate([self._term_postings(i) for i in term_ids]))
+
+    @functools.lru_cache(maxsize=1024)
+    def _word_candidates(self, word, left_bounded, right_bounded):
+        """Lines with a word containing ``word`` as the literal requires."""
+        word = _normalize(word)
+        if left_bounded and right_bounded:
+            term_id = self._term_ids.get(word)
+            return self._union([] if term_id is None else [term_id])
+        if right_bounded:
+            # The literal starts inside a word: it is that word's suffix.
+            lo = bisect.bisect_left(self._reversed, word[::-1])
+            hi = bisect.bisect_left(self._reversed, word[::-1] + "\uffff")
+            return self._union(self._reversed_ids[lo:hi])
+        if left_bounded:
+            lo = bisect.bisect_left(self._terms, word)
+            hi = bisect.bisect_left(self._terms, word + "\uffff")
+            return self._union(list(range(lo, hi)))
+        return self._union([i for i, term in enumerate(self._terms) if word in term])
+
+    def _literal_candidates(self, literal):
+        result = None
+        for m in _WORD.finditer(literal):
+            lines = self._word_candidates(
+                m.group(), m.start() > 0, m.end() < len(literal)
+            )
+            result = lines if result is None else np.intersect1d(result, lines)
+        return result
+
+    def _field_candidates(self, name, value):
+        value_id = self._fields[name].get(value)
+        if value_id is None:
+            return np.empty(0, dtype=np.uint32)
+        offsets = self._field_offsets[name]
+        return self._field_postings[name][offsets[value_id] : offsets[value_id + 1]]
+
+    def candidates(self, pipeline):
+        """Return the lines that may match a pipeline.
+
+        Parameters
+        ----------
+        pipeline : `logql.LogPipeline`
+
+        Returns
+        -------
+        lines : `numpy.ndarray` or `None`
+            Sorted line numbers, or `None` if the index does not narrow
+            the pipeline down.
+        """
+        result = None
+        constraints = [(self._literal_candidates, (lit,)) for lit in pipeline.literals]
+        constraints += [
+            (self._field_candidates, (label, value))
+            for label, op, value in pipeline.label_filters
+            if op in ("=", "==") and label in self._fields
+        ]
+        for func, args in constraints:
+            lines = func(*args)
+            if lines is None:
+                continue
+            result = lines if result is None else np.intersect1d(result, lines)
+            if len(result) == 0:
+                break
+        return result
+
+    @functools.lru_cache(maxsize=64)
+    def _block(self, index):
+        start, end = self._block_offsets[index], self._block_offsets[index + 1]
+        self._blocks.seek(start)
+        return zlib.decompress(self._blocks.read(end - start)).decode().split("\n")
+
+    def records(self, lines=None):
+        """Yield stored records.
+
+        Parameters
+        ----------
+        lines : iterable [`int`], optional
+            Sorted line numbers; all lines if not given.
+        """
+        if lines is None:
+            lines = range(self.n_lines)
+        for n in lines:
+            block, offset = divmod(int(n), self.block_size)
+            yield self._block(block)[offset]
+
+    def iter_query(self, search_string):
+        """Yield the records matching a LogQL pipeline.
+
+        Parameters
+        ----------
+        search_string : `str`
+            The pipeline following the stream selector.
+        """
+        pipeline = parse_pipeline(search_string)
+        for raw in self.records(self.candidates(pipeline)):
+            if pipeline.match(json.loads(raw)["line"]):
+                yield raw
+
+    def query(self, search_string, limit=200000):
+        """Return matching records like `queries.query_loki`.
+
+        Parameters
+        ----------
+        search_string : `str`
+            The pipeline following the stream selector.
+        limit : `int`, optional
+            Maximum number of lines returned, as ``logcli --limit``.
+
+        Returns
+        -------
+        results : `str`
+            Newline-terminated ``logcli --output=jsonl`` records.
+        """
+        lines = []
+        for raw in self.iter_query(search_string):
+            lines.append(raw)
+            if len(lines) >= limit:
+                break
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+def _invert(ids, occurrences):
+    """Turn (key id, line) pairs into postings ordered by sorted key."""
+    keys = sorted(ids)
+    rank = np.empty(len(ids), dtype=np.int64)
+    for new, key in enumerate(keys):
+        rank[ids[key]] = new
+    key_ids = rank[np.frombuffer(occurrences[0], dtype=np.uint32)]
+    lines = np.frombuffer(occurrences[1], dtype=np.uint32)
+    order = np.argsort(key_ids, kind="stable")
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(key_ids, minlength=len(keys)), out=offsets[1:])
+    return keys, offsets, lines[order]
+
+
+if __name__ == "__main__":
+    from datetime import timedelta
+
+    from queries import LOKI_LIMIT, get_start_end, query_loki_window
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("root", help="Root directory of the archives.")
+    parser.add_argument("--day-obs", required=True, help="YYYY-MM-DD")
+    parser.add_argument("--instrument", default=os.getenv("INSTRUMENT") or "LSSTCam")
+    args = parser.parse_args()
+
+    container = args.instrument.lower()
+
+    def pages(start, end):
+        """Yield the records of a window, newest first, halving it while
+        Loki returns as many lines as its limit.
+        """
+        results = query_loki_window(container, "", start, end)
+        if results is None:
+            raise SystemExit(f"Failed to query Loki from {start} to {end}")
+        records = results.splitlines()
+        if len(records) < LOKI_LIMIT:
+            _log.debug(f"{len(records)} lines from {start} to {end}")
+            yield from records
+            return
+        if end - start <= timedelta(seconds=1):
+            raise SystemExit(
+                f"Loki has over {LOKI_LIMIT} lines from {start} to {end}; not archiving."
+            )
+        middle = start + timedelta(seconds=(end - start).total_seconds() // 2)
+        yield from pages(middle, end)
+        yield from pages(start, middle)
+
+    start, end = (t.to_datetime() for t in get_start_end(args.day_obs))
+    LokiArchive.build(archive_path(args.root, container, args.day_obs), pages(start, end))
@@ -0,0 +1,193 @@
+# This file is part of nightly-reporting-jobs.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Spill the result of a Loki query to disk in columnar partitions.
+
+On a night when every detector of every visit logs the same error, one
+query returns gigabytes. `LokiPartitions.write` reads the lines as they
+stream in and keeps only the fields the report uses, a chunk at a time,
+with the strings dictionary-encoded. The report then filters and counts
+one partition at a time, so its memory is bounded by the chunk size
+whatever the number of lines.
+
+`queries.iter_loki_frames` spills to ``LOKI_SPILL_DIR`` when it is set.
+"""
+
+__all__ = [
+    "SPILL_CHUNK_LINES",
+    "SPILL_COLUMNS",
+    "LokiPartitions",
+]
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import pandas
+
+logging.basicConfig(
+    format="{levelname} {asctime} {name} - {message}",
+    style="{",
+)
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.DEBUG)
+
+# Lines per partition.
+SPILL_CHUNK_LINES = 20000
+SPILL_COLUMNS = ("instrument", "group", "detector", "exposure", "message")
+_CATEGORIES = ("instrument", "group")
+
+
+class LokiPartitions:
+    """Loki lines of one query, spilled by `write`.
+
+    Parameters
+    ----------
+    directory : `str`
+        A directory written by `write`.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "partitions.json")) as f:
+            meta = json.load(f)
+        self.lines = meta["lines"]
+        self.partitions = meta["partitions"]
+
+    def __len__(self):
+        return self.lines
+
+    @classmethod
+    def write(cls, directory, records, chunk_lines=SPILL_CHUNK_LINES):
+        """Spill records to partitions.
+
+        Parameters
+        ----------
+        directory : `str`
+            Where to write; created, and must not hold partitions already.
+        records : iterable [`str`]
+            Lines in the ``logcli --output=jsonl`` format; only one chunk
+            of them is held in memory at a time.
+        chunk_lines : `int`, optional
+            Number of lines per partition.
+
+        Returns
+        -------
+        partitions : `LokiPartitions`
+        """
+        os.makedirs(directory, exist_ok=True)
+        chunk = {name: [] for name in SPILL_COLUMNS}
+        lines = partitions = 0
+
+        def flush():
+            nonlocal partitions
+            arrays = {
+                "detector": np.array(chunk["detector"], dtype=np.int32),
+                "exposure": np.array(chunk["exposure"], dtype=np.int64),
+            }
+            for name in _CATEGORIES:
+                values, codes = np.unique(
+                    np.array(chunk[name], dtype=str), return_inverse=True
+                )
+                arrays[f"{name}_values"] = values
+                arrays[f"{name}_codes"] = codes.astype(np.int32)
+            encoded = [m.encode() for m in chunk["message"]]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(m) for m in encoded], out=offsets[1:])
+            arrays["message_offsets"] = offsets
+            arrays["message_data"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+            np.savez(os.path.join(directory, f"part-{partitions:05d}.npz"), **arrays)
+            partitions += 1
+            for values in chunk.values():
+                values.clear()
+
+        for raw in records:
+            try:
+                fields = json.loads(json.loads(raw)["line"])
+            except (json.JSONDecodeError, KeyError, TypeError) as e:
+                _log.error(f"Failed to parse \n{raw}\n JSON decode error: {e}")
+                continue
+            if not isinstance(fields, dict):
+                continue
+            exposures = fields.get("exposures")
+            chunk["instrument"].append(str(fields.get("instrument") or ""))
+            chunk["group"].append(str(fields.get("group") or ""))
+            chunk["detector"].append(_int(fields.get("detector")))
+            chunk["exposure"].append(
+                _int(exposures[0]) if isinstance(exposures, list) and exposures else -1
+            )
+            chunk["message"].append(str(fields.get("message") or ""))
+            lines += 1
+            if len(chunk["message"]) == chunk_lines:
+                flush()
+        if chunk["message"]:
+            flush()
+        with open(os.path.join(directory, "partitions.json"), "w") as f:
+            json.dump({"lines": lines, "partitions": partitions}, f)
+        _log.info(f"Spilled {lines} Loki lines to {partitions} partitions")
+        return cls(directory)
+
+    def frames(self, columns=SPILL_COLUMNS):
+        """Yield the partitions one at a time.
+
+        Parameters
+        ----------
+        columns : iterable [`str`], optional
+            The `SPILL_COLUMNS` to read; messages are only decoded if
+            asked for.
+
+        Yields
+        ------
+        frame : `pandas.DataFrame`
+            One partition, with the instrument and group as categoricals,
+            and -1 for a missing detector or exposure.
+        """
+        for i in range(self.partitions):
+            path = os.path.join(self.directory, f"part-{i:05d}.npz")
+            frame = {}
+            with np.load(path, allow_pickle=False) as arrays:
+                for name in columns:
+                    if name in _CATEGORIES:
+                        frame[name] = pandas.Categorical.from_codes(
+                            arrays[f"{name}_codes"], arrays[f"{name}_values"]
+                        )
+                    elif name == "message":
+                        data = arrays["message_data"].tobytes()
+                        offsets = arrays["message_offsets"]
+                        frame[name] = [
+                            data[start:end].decode()
+                            for start, end in zip(offsets[:-1], offsets[1:])
+                        ]
+                    else:
+                        frame[name] = arrays[name]
+            yield pandas.DataFrame(frame, columns=list(columns))
+
+    def remove(self):
+        """Delete the partitions."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
@@ -0,0 +1,345 @@
+# This file is part of nightly-reporting-jobs.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Export the nightly counts and the cost of the job to Prometheus.
+
+The metrics are rendered in the text exposition format, to be written for
+the node exporter's textfile collector or pushed to a Pushgateway.
+"""
+
+__all__ = [
+    "push_metrics",
+    "record_fetched",
+    "render_metrics",
+    "write_metrics",
+]
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+
+import requests
+
+from limiter import limiter_stats
+
+logging.basicConfig(
+    format="{levelname} {asctime} {name} - {message}",
+    style="{",
+)
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.DEBUG)
+
+_fetched = Counter()
+_fetched_lock = threading.Lock()
+
+
+def record_fetched(kind, count):
+    """Count items fetched from a backend.
+
+    Parameters
+    ----------
+    kind : `str`
+        What was fetched, such as ``loki_lines`` or ``butler_refs``.
+    count : `int`
+    """
+    with _fetched_lock:
+        _fetched[kind] += count
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Exposition:
+    def __init__(self):
+        self._families = {}
+
+    def add(self, name, kind, description, value, /, **labels):
+        family = self._families.setdefault(name, (kind, description, []))
+        family[2].append((labels, value))
+
+    def render(self):
+        lines = []
+        for name, (kind, description, samples) in self._families.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                suffix = ""
+                if labels:
+                    suffix = (
+                        "{"
+                        + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                        + "}"
+                    )
+                lines.append(f"{name}{suffix} {float(value)!r}")
+        return "\n".join(lines) + "\n"
+
+
+def _peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def render_metrics(summary, runtime):
+    """Render the metrics of one report.
+
+    Parameters
+    ----------
+    summary : `night_summary.NightSummary`
+        The night's counts.
+    runtime : `float`
+        Seconds the job has run.
+
+    Returns
+    -------
+    text : `str`
+        The metrics in the Prometheus text exposition format.
+    """
+    out = _Exposition()
+    night = dict(instrument=summary.instrument, survey=summary.survey)
+    day_obs = int(summary.day_obs.replace("-", ""))
+    out.add(
+        "prompt_processing_report_day_obs",
+        "gauge",
+        "day_obs of the night reported, as YYYYMMDD.",
+        day_obs,
+        **night,
+    )
+    detector_based = summary.expected_processing is not None
+    for name, description, value in (
+        (
+            "on_sky_exposures",
+            "On-sky science exposures of the night.",
+            summary.on_sky_exposures,
+        ),
+        (
+            "next_visits",
+            "nextVisit events of the survey, not canceled.",
+            summary.next_visits,
+        ),
+        (
+            "next_visits_all",
+            "nextVisit events of the survey.",
+            summary.total_next_visits,
+        ),
+        ("raws", "Raw exposures of the survey.", summary.raws),
+        ("raw_images", "Raw images of the survey.", summary.raw_images),
+        (
+            "raws_without_next_visit",
+            "Raw exposures of the survey with no nextVisit event.",
+            len(summary.groups_without_events),
+        ),
+        (
+            "successful_preprocessing",
+            "Successful preprocessing runs of the survey raws.",
+            summary.successful_preprocessing,
+        ),
+        (
+            "expected_processing",
+            "Expected (exposure, detector) processing.",
+            summary.expected_processing,
+        ),
+        (
+            "missed_processing",
+            "Expected processing without outputs.",
+            summary.missed if detector_based else None,
+        ),
+        (
+            "unspecified_failures",
+            "Missed processing without a known failure.",
+            summary.unspecified if detector_based else None,
+        ),
+    ):
+        if value is not None:
+            out.add(f"prompt_processing_{name}", "gauge", description, value, **night)
+    for category, failure in summary.failures.items():
+        out.add(
+            "prompt_processing_failures",
+            "gauge",
+            "Survey (group, detector) reporting each failure in Loki.",
+            failure.count,
+            category=category,
+            **night,
+        )
+        out.add(
+            "prompt_processing_failure_lines",
+            "gauge",
+            "Loki lines reporting each failure, including raws not received.",
+            failure.total,
+            category=category,
+            **night,
+        )
+    pipeline = summary.pipeline
+    if pipeline is not None:
+        for stage in (
+            "runs",
+            "isr",
+            "single_frame",
+            "ap_pipe",
+            "isr_passed",
+            "calibrate_passed",
+            "ap_pipe_calibrate_passed",
+            "associate_passed",
+            "associate_no_work",
+            "associate_dropped",
+        ):
+            out.add(
+                "prompt_processing_pipeline_outputs",
+                "gauge",
+                "Main pipeline outputs by stage.",
+                getattr(pipeline, stage),
+                stage=stage,
+                **night,
+            )
+        for task, counts in pipeline.recurrent_errors.items():
+            for message, count in counts.items():
+                out.add(
+                    "prompt_processing_recurrent_errors",
+                    "gauge",
+                    "Task errors containing each known message.",
+                    count,
+                    task=task,
+                    message=message,
+                    **night,
+                )
+    job = dict(instrument=summary.instrument)
+    out.add(
+        "nightly_report_runtime_seconds",
+        "gauge",
+        "Wall-clock time of the report job.",
+        runtime,
+        **job,
+    )
+    out.add(
+        "nightly_report_peak_rss_bytes",
+        "gauge",
+        "Peak resident set size of the report job.",
+        _peak_rss_bytes(),
+        **job,
+    )
+    for source, stats in limiter_stats().items():
+        out.add(
+            "nightly_report_query_seconds_total",
+            "counter",
+            "Total time of the queries to each source.",
+            stats["latency"],
+            source=source,
+            **job,
+        )
+        out.add(
+            "nightly_report_query_seconds_max",
+            "gauge",
+            "Slowest query to each source.",
+            stats["max_latency"],
+            source=source,
+            **job,
+        )
+        out.add(
+            "nightly_report_queries_total",
+            "counter",
+            "Queries to each source.",
+            stats["calls"],
+            source=source,
+            **job,
+        )
+        out.add(
+            "nightly_report_query_errors_total",
+            "counter",
+            "Failed queries to each source.",
+            stats["errors"],
+            source=source,
+            **job,
+        )
+    with _fetched_lock:
+        fetched = dict(_fetched)
+    for kind, count in sorted(fetched.items()):
+        out.add(
+            "nightly_report_fetched_total",
+            "counter",
+            "Items fetched from the sources.",
+            count,
+            kind=kind,
+            **job,
+        )
+    out.add(
+        "nightly_report_last_run_timestamp_seconds",
+        "gauge",
+        "When the report job last computed its metrics.",
+        time.time(),
+        **job,
+    )
+    return out.render()
+
+
+def write_metrics(text, path):
+    """Write metrics for the node exporter's textfile collector.
+
+    The file is replaced atomically, so the collector never reads a
+    partial file.
+
+    Parameters
+    ----------
+    text : `str`
+        Metrics from `render_metrics`.
+    path : `str`
+        Destination, ending in ``.prom``.
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def push_metrics(text, url, instrument):
+    """Push metrics to a Prometheus Pushgateway.
+
+    Parameters
+    ----------
+    text : `str`
+        Metrics from `render_metrics`.
+    url : `str`
+        Base URL of the Pushgateway.
+    instrument : `str`
+        The instrument name, part of the grouping key.
+
+    Returns
+    -------
+    pushed : `bool`
+        Whether the gateway accepted the metrics.
+    """
+    try:
+        res = requests.put(
+            f"{url.rstrip('/')}/metrics/job/nightly_report/instrument/{instrument}",
+            data=text.encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4"},
+            timeout=30,
+        )
+    except requests.RequestException as e:
+        _log.error(f"Failed to push metrics: {e}")
+        return False
+    if res.status_code not in (200, 202):
+        _log.error(f"Failed to push metrics: {res.status_code} {res.text}")
+        return False
+    return True
@@ -0,0 +1,543 @@
+# This file is part of nightly-reporting-jobs.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Result model of the nightly Prompt Processing summary.
+
+`prompt_processing_summary.compute_night_summary` queries the Butler, the
+EFD and Loki once and returns a `NightSummary`. It is serialized to JSON
+for other consumers and rendered for Slack here, without any queries.
+"""
+
+__all__ = [
+    "LOKI_FAILURES",
+    "PREPROCESSING_SUCCESS",
+    "REPORT_SECTIONS",
+    "ErrorTemplate",
+    "LokiCategory",
+    "LokiFailure",
+    "NightSummary",
+    "PipelineCounts",
+    "render_section",
+    "render_slack",
+    "render_summary_lines",
+    "summary_path",
+]
+import dataclasses
+import json
+from dataclasses import dataclass, field
+from datetime import date
+
+from ledger import LEDGER_FLAGS
+
+
+@dataclass
+class LokiFailure:
+    """Pods reporting one kind of failure in the instrument container logs.
+
+    Attributes
+    ----------
+    count : `int`
+        Number of (group, detector) among the night's survey raws.
+    total : `int`
+        Number of matching log lines, including raws not received.
+    breakdown : `dict` [`str`, `int`]
+        Number of ``count`` whose message contains each substring.
+    groups : `list` [`str`]
+        Distinct groups of ``count``, if requested.
+    detectors : `dict` [`str`, `int`]
+        Number of ``count`` on each detector.
+    by_group : `dict` [`str`, `int`]
+        Number of ``count`` in each group.
+    """
+
+    count: int = 0
+    total: int = 0
+    breakdown: dict = field(default_factory=dict)
+    groups: list = field(default_factory=list)
+    detectors: dict = field(default_factory=dict)
+    by_group: dict = field(default_factory=dict)
+
+
+@dataclass
+class ErrorTemplate:
+    """Errors of one shape that match no known pattern.
+
+    Attributes
+    ----------
+    template : `str`
+        The message, with the parts that vary replaced by ``<*>``.
+    count : `int`
+        Number of messages.
+    examples : `list` [`str`]
+        A few groups or data IDs they came from.
+    """
+
+    template: str
+    count: int = 0
+    examples: list = field(default_factory=list)
+
+
+@dataclass(frozen=True)
+class LokiCategory:
+    """How to find one kind of failure in the instrument container logs.
+
+    Attributes
+    ----------
+    match_string, match_string2 : `str`
+        LogQL stages, as passed to `queries.get_df_from_loki`.
+    messages : `tuple` [`str`]
+        Substrings to break the failures down by.
+    list_groups : `bool`
+        Whether to record the failed groups.
+    """
+
+    match_string: str
+    match_string2: str = '|= "Processing failed"'
+    messages: tuple = ()
+    list_groups: bool = False
+
+    @property
+    def search_string(self):
+        """The LogQL pipeline of the Loki query."""
+        return f"{self.match_string} {self.match_string2}"
+
+
+_CONNECTION_ERRORS = (
+    "botocore.exceptions.ClientError",
+    "SSL SYSCALL error: EOF detected",
+    "SSL connection has been closed unexpectedly",
+    "server closed the connection unexpectedly",
+)
+
+# Keys are those of `NightSummary.failures`, in the order they are queried.
+LOKI_FAILURES = {
+    "timeout": LokiCategory('|= "Timed out waiting for image"'),
+    "central_butler": LokiCategory('|= "MiddlewareInterface(_get_central_butler()"'),
+    "prep_butler": LokiCategory('|= "prep_butler"', messages=_CONNECTION_ERRORS),
+    "cassandra": LokiCategory(
+        '|= "loadDiaCatalogs" |= "cassandra"',
+        match_string2='| json | level="ERROR"',
+        messages=("cassandra.cluster.NoHostAvailable", "Error from server"),
+    ),
+    "raw_microservice": LokiCategory(
+        '|= "Timed out connecting to raw microservice"',
+        match_string2='| json | level="ERROR"',
+    ),
+    "sidecar": LokiCategory('|= "RuntimeError: Unable to retrieve JSON sidecar"'),
+    "no_good_pipelines": LokiCategory(
+        '|= "NoGoodPipelinesError: No main pipeline graph could be built"',
+        list_groups=True,
+    ),
+    "export": LokiCategory(
+        '|= "export_outputs"',
+        match_string2='|= "Central repo export failed"',
+        messages=_CONNECTION_ERRORS + ("psycopg2.errors.UniqueViolation",),
+    ),
+    "sigterm": LokiCategory(
+        '|= "Signal SIGTERM detected, cleaning up and shutting down."',
+        match_string2="",
+    ),
+}
+
+PREPROCESSING_SUCCESS = LokiCategory(
+    '|= "Preprocessing pipeline successfully run."', match_string2=""
+)
+
+# Sections of a progressively delivered report, in the order they are
+# computed: the headline needs no pipeline outputs, and the errors read the
+# logs of every failed task.
+REPORT_SECTIONS = ("headline", "processing", "associateApdb", "errors")
+
+
+@dataclass
+class PipelineCounts:
+    """Outputs of the main pipeline runs.
+
+    Attributes
+    ----------
+    runs : `int`
+        (exposure, detector) with any ``isr_log``.
+    isr, single_frame, ap_pipe : `int`
+        ``isr_log`` in the ``Isr``, ``SingleFrame`` and ``ApPipe`` outputs.
+    isr_passed : `int`
+        ``calibrateImage_log`` outputs; misses ISR-only attempts.
+    calibrate_passed : `int`
+        ``analyzePreliminarySummaryStats_log`` outputs.
+    ap_pipe_calibrate_passed : `int`
+        ``analyzePreliminarySummaryStats_log`` outputs in ``ApPipe``.
+    associate_passed : `int`
+        ``dia_source_apdb`` outputs.
+    associate_no_work, associate_dropped : `int`
+        associateApdb runs with nothing to do, and dropped for having no
+        work after single frame processing.
+    recurrent_errors : `dict` [`str`, `dict` [`str`, `int`]]
+        Per task, the number of errors containing each known message.
+    """
+
+    runs: int = 0
+    isr: int = 0
+    single_frame: int = 0
+    ap_pipe: int = 0
+    isr_passed: int = 0
+    calibrate_passed: int = 0
+    ap_pipe_calibrate_passed: int = 0
+    associate_passed: int = 0
+    associate_no_work: int = 0
+    associate_dropped: int = 0
+    recurrent_errors: dict = field(default_factory=dict)
+
+
+@dataclass
+class NightSummary:
+    """Everything the nightly report says about one instrument and night.
+
+    Fields after ``groups_without_events`` are left at their defaults when
+    the report stops early: with no survey raws, or no output collection.
+    Detector-based expectations are only computed for instruments in
+    `detector_health.DETECTOR_COUNTS`.
+    """
+
+    day_obs: str
+    instrument: str
+    survey: str
+    on_sky_exposures: int = 0
+    next_visits: int = 0
+    total_next_visits: int = 0
+    raws: int = 0
+    raw_images: int = 0
+    groups_without_events: list = field(default_factory=list)
+    output_collection: str | None = None
+    detectors: int | None = None
+    off_detector: int | None = None
+    successful_preprocessing: int | None = None
+    expected_processing: int | None = None
+    missed: int = 0
+    failures: dict = field(default_factory=dict)
+    pipeline: PipelineCounts | None = None
+    # Templates of the Loki failures and task errors not counted above.
+    unrecognized_errors: list = field(default_factory=list)
+    # Per-detector counts by `detector_health.COLUMNS`.
+    detector_counts: dict = field(default_factory=dict)
+    # Columns of the `ledger.build_ledger` table of the night.
+    ledger: dict = field(default_factory=dict)
+
+    @property
+    def unspecified(self):
+        """Missed processing not explained by a known failure."""
+        counted = sum(
+            self.failures[key].count
+            for key in (
+                "timeout",
+                "central_butler",
+                "prep_butler",
+                "sidecar",
+                "no_good_pipelines",
+            )
+            if key in self.failures
+        )
+        return self.missed - counted
+
+    def to_json(self):
+        """Serialize to a JSON string."""
+        return json.dumps(dataclasses.asdict(self), indent=2)
+
+    @classmethod
+    def from_json(cls, text):
+        """Deserialize from a string made by `to_json`."""
+        data = json.loads(text)
+        data["failures"] = {
+            key: LokiFailure(**value) for key, value in data["failures"].items()
+        }
+        if data["pipeline"] is not None:
+            data["pipeline"] = PipelineCounts(**data["pipeline"])
+        data["unrecognized_errors"] = [
+            ErrorTemplate(**value) for value in data.get("unrecognized_errors", [])
+        ]
+        return cls(**data)
+
+
+def summary_path(root, instrument, day_obs):
+    """Return where the summary of a night is stored under ``root``."""
+    return f"{root.rstrip('/')}/{instrument}/{day_obs}.json"
+
+
+def _failure_lines(summary, key, template, always=False):
+    failure = summary.failures.get(key)
+    if failure is None or not (failure.total if always else failure.count):
+        return []
+    lines = [template.format(count=failure.count, total=failure.total)]
+    lines.extend(
+        f"  - {count}: {msg}." for msg, count in failure.breakdown.items() if count
+    )
+    return lines
+
+
+def _recurrent_lines(task, counts):
+    lines = [f"    - {count} {err}" for err, count in counts.items() if count]
+    if lines:
+        lines.insert(0, f"    Among {task} errors, {sum(counts.values())} were")
+    return lines
+
+
+def _headline_lines(summary):
+    lines = [f"Number of on-sky exposures: {summary.on_sky_exposures:d}"]
+    lines.append(
+        f"Number for {summary.survey}: {summary.next_visits}/{summary.total_next_visits} nextVisit, "
+        f"{summary.raws:d} raws ({summary.raw_images} images)"
+    )
+    if summary.groups_without_events:
+        lines.append(
+            f"{len(summary.groups_without_events)} raws had no nextVisit: "
+            + ",".join(summary.groups_without_events)
+        )
+    return lines
+
+
+def _mismatch_lines(summary):
+    # Raws without a nextVisit are listed in the headline already.
+    counts = []
+    for flag, text in LEDGER_FLAGS.items():
+        n = sum(summary.ledger.get(flag, []))
+        if n and flag != "raw_without_next_visit":
+            counts.append(f"{n} {text}")
+    if not counts:
+        return []
+    return ["Groups with mismatched sources: " + ", ".join(counts)]
+
+
+def _processing_lines(summary):
+    lines = _mismatch_lines(summary)
+    active = None
+    if summary.detectors is not None:
+        active = f"{summary.detectors}-{summary.off_detector} detectors"
+        expected = summary.total_next_visits * (
+            summary.detectors - summary.off_detector
+        )
+        lines.append(
+            f"Number of expected preprocessing: {summary.total_next_visits} nextVisits*({active})={expected}. "
+            f"Successful: {summary.successful_preprocessing}. "
+        )
+    lines += _failure_lines(
+        summary,
+        "timeout",
+        "- {count} unexpected timeout ({total} total including raws not received).",
+        always=True,
+    )
+    lines += _failure_lines(
+        summary,
+        "central_butler",
+        "- {count} failure in instantiating MWI central butler connection ({total} total including raws not received).",
+        always=True,
+    )
+    lines += _failure_lines(
+        summary,
+        "prep_butler",
+        "- {count} failure in prep_butler ({total} total including raws not received).",
+        always=True,
+    )
+    lines += _failure_lines(
+        summary,
+        "cassandra",
+        "- {count} loadDiaCatalogs errors from cassandra ({total} total including raws not received).",
+        always=True,
+    )
+    lines += _failure_lines(
+        summary, "raw_microservice", "- {count} Timed out connecting to raw microservice."
+    )
+    if active is not None:
+        lines.append(
+            f"Number of expected processing: ({summary.raws}-{len(summary.groups_without_events)}) raws*({active})"
+            f"={summary.expected_processing:d}. Missed {summary.missed}"
+        )
+    lines += _failure_lines(
+        summary, "sidecar", "- {count} failure in retrieving json sidecar."
+    )
+    no_good = summary.failures.get("no_good_pipelines")
+    if no_good and no_good.count:
+        lines.append(f"- {no_good.count} NoGoodPipelinesError: {no_good.groups}")
+    if summary.missed > 0:
+        lines.append(f"- {summary.unspecified} unspecified")
+
+    pipeline = summary.pipeline
+    lines.append(
+        "Number of main pipeline runs with outputs: {:d} total, {:d} Isr, {:d} SingleFrame, {:d} ApPipe".format(
+            pipeline.runs, pipeline.isr, pipeline.single_frame, pipeline.ap_pipe
+        )
+    )
+    lines.append(
+        "- isr: {:d} attempts with outputs, {:d} passed not including ISR-only attempts.".format(
+            pipeline.isr + pipeline.single_frame + pipeline.ap_pipe, pipeline.isr_passed
+        )
+    )
+    calibrate_attempts = pipeline.single_frame + pipeline.ap_pipe
+    lines.append(
+        "- calibrateImage: {:d} attempts with outputs, {:d} passed, {:d} failed.".format(
+            calibrate_attempts,
+            pipeline.calibrate_passed,
+            calibrate_attempts - pipeline.calibrate_passed,
+        )
+    )
+    return lines
+
+
+def _associate_lines(pipeline):
+    no_apdb = pipeline.associate_no_work + pipeline.associate_dropped
+    lines = [
+        "- associateApdb: {:d} attempts with outputs, {:d}+{:d}+{:d}={:d} passed, {:d} failed".format(
+            pipeline.ap_pipe,
+            pipeline.associate_passed,
+            pipeline.associate_no_work,
+            pipeline.associate_dropped,
+            pipeline.associate_passed + no_apdb,
+            pipeline.ap_pipe - pipeline.associate_passed - no_apdb,
+        )
+    ]
+    if pipeline.ap_pipe_calibrate_passed:
+        lines.append(
+            f"  - {pipeline.ap_pipe - pipeline.ap_pipe_calibrate_passed} failed at single frame stage"
+        )
+    return lines
+
+
+def _unrecognized_lines(summary):
+    if not summary.unrecognized_errors:
+        return []
+    return ["Most common errors matching no known pattern:"] + [
+        f"- {t.count}: {t.template} (e.g. {', '.join(t.examples)})"
+        for t in summary.unrecognized_errors
+    ]
+
+
+def _closing_lines(summary):
+    lines = [
+        f"<https://usdf-rsp.slac.stanford.edu/times-square/github/lsst-dm/vv-team-notebooks/PREOPS-prompt-error-msgs?day_obs={summary.day_obs}&instrument={summary.instrument}&ts_hide_code=1&survey={summary.survey}|Full Error Log>",
+        f"<https://usdf-rsp.slac.stanford.edu/times-square/github/lsst-sqre/times-square-usdf/prompt-processing/groups?date={summary.day_obs}&instrument={summary.instrument}&survey={summary.survey}&mode=DEBUG&ts_hide_code=1|Timing plots>",
+    ]
+    export = _failure_lines(
+        summary, "export", "- {count} failure in export_outputs."
+    )
+    if export:
+        lines.append(export[0])
+        lines.append("  (Partial export may be incorrectly counted as success)")
+        lines.extend(export[1:])
+    lines += _failure_lines(
+        summary,
+        "sigterm",
+        "- At least {count} had SIGTERM ({total} total including raws not received).",
+        always=True,
+    )
+    return lines
+
+
+def render_summary_lines(summary):
+    """Render the body of the Slack report.
+
+    Parameters
+    ----------
+    summary : `NightSummary`
+
+    Returns
+    -------
+    lines : `list` [`str`]
+    """
+    lines = _headline_lines(summary)
+    if summary.raws == 0:
+        return lines
+    if summary.output_collection is None:
+        lines.append(f"No output collection was found for {summary.day_obs:s}")
+        return lines
+
+    pipeline = summary.pipeline
+    lines += _processing_lines(summary)
+    lines += _recurrent_lines(
+        "calibrateImage", pipeline.recurrent_errors.get("calibrateImage", {})
+    )
+    lines += _associate_lines(pipeline)
+    for task in ("subtractImages", "associateApdb"):
+        lines += _recurrent_lines(task, pipeline.recurrent_errors.get(task, {}))
+    lines += _unrecognized_lines(summary)
+    lines += _closing_lines(summary)
+    return lines
+
+
+def render_section(summary, section):
+    """Render one section of the report, for progressive delivery.
+
+    Each section only reads the fields computed before the stage of the
+    same name of `prompt_processing_summary.compute_night_summary`.
+
+    Parameters
+    ----------
+    summary : `NightSummary`
+    section : `str`
+        One of `REPORT_SECTIONS`.
+
+    Returns
+    -------
+    lines : `list` [`str`]
+        Empty if the section has nothing to report.
+    """
+    if section == "headline":
+        return _headline_lines(summary)
+    if summary.raws == 0:
+        return []
+    if summary.output_collection is None:
+        if section == "processing":
+            return [f"No output collection was found for {summary.day_obs:s}"]
+        return []
+    pipeline = summary.pipeline
+    if section == "processing":
+        return _processing_lines(summary) + _closing_lines(summary)
+    if section == "associateApdb":
+        return _associate_lines(pipeline)
+    if section == "errors":
+        lines = []
+        for task in ("calibrateImage", "subtractImages", "associateApdb"):
+            lines += _recurrent_lines(task, pipeline.recurrent_errors.get(task, {}))
+        return lines + _unrecognized_lines(summary)
+    raise ValueError(f"Unknown report section {section!r}")
+
+
+def render_slack(summary, section=None):
+    """Render the full Slack message of a night.
+
+    Parameters
+    ----------
+    summary : `NightSummary`
+    section : `str`, optional
+        Only render this one of `REPORT_SECTIONS`; the title is part of
+        the ``headline``.
+
+    Returns
+    -------
+    message : `str`
+    """
+    if section is None:
+        lines = render_summary_lines(summary)
+    else:
+        lines = render_section(summary, section)
+        if section != "headline":
+            return "\n".join(lines)
+    day = date.fromisoformat(summary.day_obs)
+    return (
+        f":clamps: *{summary.instrument} {day.strftime('%A %Y-%m-%d')}* :clamps: \n"
+        + "\n".join(lines)
+    )
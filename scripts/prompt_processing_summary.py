@@ -1,29 +1,71 @@
 import asyncio
+import logging
 import sys
 import os
+import time
 import lsst.daf.butler as dafButler
-from dataclasses import dataclass
+from lsst.resources import ResourcePath
+from collections import Counter
+from dataclasses import asdict
 from datetime import date, timedelta
-import requests
 
+from checkpoint import SectionCheckpoint
+from detector_health import DETECTOR_COUNTS, DetectorHealth
+from ledger import build_ledger, ledger_to_dict
+from limiter import get_limiter, log_limiter_stats
+from live_tail import load_finished_counters
+from log_templates import TemplateMiner, mine_loki_errors
+from matching import get_matcher
+from metrics import push_metrics, record_fetched, render_metrics, write_metrics
+from night_summary import (
+    LOKI_FAILURES,
+    PREPROCESSING_SUCCESS,
+    ErrorTemplate,
+    LokiFailure,
+    NightSummary,
+    PipelineCounts,
+    render_slack,
+    render_summary_lines,
+    summary_path,
+)
 from queries import (
     get_next_visit_events,
     get_no_work_count_from_loki,
-    get_df_from_loki,
+    iter_loki_frames,
 )
+from slack_report import SLACK_API_URL, ProgressiveReport, post_webhook
 
 
-def make_summary_message(day_obs, instrument):
-    """Make Prompt Processing summary message for a night
+def compute_night_summary(
+    day_obs, instrument, counters=None, checkpoint=None, health=None, progress=None
+):
+    """Query Prompt Processing results for a night
 
     Parameters
     ----------
     day_obs : `str`
         day_obs in the format of YYYY-MM-DD.
+    instrument : `str`
+        The instrument name.
+    counters : `live_tail.RollingCounters`, optional
+        Counters kept by the live tail daemon over the whole night. If
+        given, they replace the EFD and Loki queries.
+    checkpoint : `checkpoint.SectionCheckpoint`, optional
+        Where to keep the result of each query, so that a rerun after a
+        failure resumes from the first query not done.
+    health : `detector_health.DetectorHealth`, optional
+        History of the previous nights, to infer the inactive detectors
+        from. Without it, or without history, a fixed number is assumed.
+    progress : callable, optional
+        Called as ``progress(section, summary)`` as soon as the fields of
+        each of `night_summary.REPORT_SECTIONS` are computed, so they can
+        be delivered before the slower ones. Not called for the sections
+        after an early return.
+
+    Returns
+    -------
+    summary : `night_summary.NightSummary`
     """
-
-    output_lines = []
-
     day_obs_int = int(day_obs.replace("-", ""))
 
     butler_alias = "embargo"
@@ -33,42 +75,110 @@ def make_summary_message(day_obs, instrument):
         survey = "BLOCK-320"
     else:
         survey = "BLOCK-365"
-    next_visits, canceled_visits = asyncio.run(
-        get_next_visit_events(day_obs, instrument, survey)
+    summary = NightSummary(day_obs=day_obs, instrument=instrument, survey=survey)
+    if checkpoint is None:
+        checkpoint = SectionCheckpoint(None, instrument, day_obs)
+
+    def count(name, butler, dataset_type, collection, **kwargs):
+        return checkpoint.section(
+            name,
+            [dataset_type, collection, kwargs],
+            lambda: count_datasets(butler, dataset_type, collection, **kwargs),
+        )
+
+    def recurrent_errors(task):
+        def compute():
+            miner = TemplateMiner()
+            counts = count_recurrent_pipeline_errors(
+                b,
+                f"visit.science_program='{survey}'AND instrument='{instrument}'",
+                task,
+                miner=miner,
+            )
+            return counts, miner.top(UNRECOGNIZED_TEMPLATES)
+
+        return checkpoint.section(
+            f"recurrent_errors_{task}",
+            [survey, collection],
+            compute,
+            encode=lambda result: [result[0], [asdict(t) for t in result[1]]],
+            decode=lambda value: (value[0], [ErrorTemplate(**t) for t in value[1]]),
+        )
+
+    if counters is not None:
+
+        def next_visit_events():
+            return counters.next_visit_events(survey)
+
+        def get_failure(key):
+            return counters.get_failure(key, groups)
+
+    else:
+
+        def next_visit_events():
+            return asyncio.run(get_next_visit_events(day_obs, instrument, survey))
+
+        def get_failure(key):
+            return checkpoint.section(
+                f"loki_{key}",
+                [groups],
+                lambda: _get_loki_failure(
+                    day_obs, instrument, groups, LOKI_FAILURES[key]
+                ),
+                encode=asdict,
+                decode=lambda value: LokiFailure(**value),
+            )
+
+    def visit_groups():
+        next_visits, canceled_visits = next_visit_events()
+        canceled_list = next_visits.index.intersection(
+            canceled_visits.set_index("groupId").index
+        ).tolist()
+        return next_visits.index.tolist(), canceled_list
+
+    next_visit_groups, canceled_groups = checkpoint.section(
+        "next_visit_groups", [survey], visit_groups
     )
-    total_visit_count = len(next_visits)
-    canceled_list = next_visits.index.intersection(
-        canceled_visits.set_index("groupId").index
-    ).tolist()
-    if canceled_list:
-        next_visits = next_visits.drop(canceled_list)
     butler_nocollection = dafButler.Butler(butler_alias)
-    raw_exposures = butler_nocollection.query_dimension_records(
-        "exposure",
-        instrument=instrument,
-        where=f"day_obs={day_obs_int} AND (exposure.can_see_sky or exposure.can_see_sky=NULL) AND exposure.observation_type='science'",
-        explain=False,
-        limit=None,
-    )
-
-    # Do not send message if there are no on-sky exposures.
-    if len(raw_exposures) == 0:
-        sys.exit(0)
 
-    output_lines.append("Number of on-sky exposures: {:d}".format(len(raw_exposures)))
+    def query_exposures(**kwargs):
+        with get_limiter("butler").slot():
+            records = butler_nocollection.query_dimension_records(
+                "exposure",
+                instrument=instrument,
+                explain=False,
+                limit=None,
+                **kwargs,
+            )
+        record_fetched("butler_records", len(records))
+        return [[r.id, r.group] for r in records]
+
+    summary.on_sky_exposures = checkpoint.section(
+        "on_sky_exposures",
+        [],
+        lambda: len(
+            query_exposures(
+                where=f"day_obs={day_obs_int} AND (exposure.can_see_sky or exposure.can_see_sky=NULL) AND exposure.observation_type='science'",
+            )
+        ),
+    )
+    if summary.on_sky_exposures == 0:
+        return summary
 
-    raw_exposures = butler_nocollection.query_dimension_records(
-        "exposure",
-        instrument=instrument,
-        where=f"day_obs=day_obs_int AND exposure.science_program IN (survey)",
-        bind={"day_obs_int": day_obs_int, "survey": survey},
-        explain=False,
-        limit=None,
+    survey_where = "day_obs=day_obs_int AND exposure.science_program IN (survey)"
+    survey_bind = {"day_obs_int": day_obs_int, "survey": survey}
+    exposures = checkpoint.section(
+        "survey_exposures",
+        [survey],
+        lambda: query_exposures(where=survey_where, bind=survey_bind),
     )
-    groups = [r.group for r in raw_exposures]
-    groups_without_events = set(groups) - set(next_visits.reset_index()["groupId"])
+    groups = [group for _, group in exposures]
+    ledger = build_ledger(next_visit_groups, canceled_groups, groups)
+    summary.ledger = ledger_to_dict(ledger)
+    groups_without_events = ledger.index[ledger["raw_without_next_visit"]]
 
-    raw_counts = count_datasets(
+    summary.raw_images = count(
+        "raw_images",
         butler_nocollection,
         "raw",
         f"{instrument}/raw/all",
@@ -76,41 +186,69 @@ def make_summary_message(day_obs, instrument):
         where=f"day_obs=day_obs_int AND exposure.science_program IN (survey) AND detector < 189",
         bind={"day_obs_int": day_obs_int, "survey": survey},
     )
-    output_lines.append(
-        f"Number for {survey}: {len(next_visits)}/{total_visit_count} nextVisit, "
-        f"{len(raw_exposures):d} raws ({raw_counts} images)"
-    )
-    if groups_without_events:
-        output_lines.append(
-            f"{len(groups_without_events)} raws had no nextVisit: {",".join(groups_without_events)}"
-        )
-    if len(raw_exposures) == 0:
-        return "\n".join(output_lines)
-
-    try:
-        collections = butler_nocollection.collections.query(
-            f"{instrument}/prompt/output-{day_obs:s}"
+    summary.next_visits = int(
+        ((ledger["next_visits"] > 0) & ~ledger["canceled"]).sum()
+    )
+    summary.total_next_visits = int(ledger["next_visits"].sum())
+    summary.raws = len(groups)
+    summary.groups_without_events = sorted(groups_without_events)
+    if progress is not None:
+        progress("headline", summary)
+    if len(groups) == 0:
+        return summary
+
+    def count_raws_by_group():
+        by_exposure = count_by_exposure(
+            butler_nocollection,
+            "raw",
+            f"{instrument}/raw/all",
+            instrument=instrument,
+            where=f"{survey_where} AND detector < 189",
+            bind=survey_bind,
         )
-        collection = list(collections)[0]
-    except dafButler.MissingCollectionError:
-        output_lines.append(f"No output collection was found for {day_obs:s}")
-        return "\n".join(output_lines)
-
-    isr_counts = count_datasets(
+        by_group = Counter()
+        for exposure, group in exposures:
+            by_group[group] += by_exposure.get(exposure, 0)
+        return {group: n for group, n in by_group.items() if n}
+
+    raws_by_group = checkpoint.section("raws_by_group", [survey], count_raws_by_group)
+
+    def find_collection():
+        try:
+            with get_limiter("butler").slot(expected=dafButler.MissingCollectionError):
+                collections = butler_nocollection.collections.query(
+                    f"{instrument}/prompt/output-{day_obs:s}"
+                )
+            return list(collections)[0]
+        except dafButler.MissingCollectionError:
+            return None
+
+    collection = checkpoint.section("output_collection", [], find_collection)
+    if collection is None:
+        return summary
+    summary.output_collection = collection
+
+    pipeline = PipelineCounts()
+    summary.pipeline = pipeline
+    preprocessed_groups = None
+    pipeline.isr = count(
+        "isr",
         butler_nocollection,
         "isr_log",
         f"{instrument}/prompt/output-{day_obs:s}/Isr/*",
         where=f"exposure.science_program IN (survey)",
         bind={"survey": survey},
     )
-    sfm_counts = count_datasets(
+    pipeline.single_frame = count(
+        "single_frame",
         butler_nocollection,
         "isr_log",
         f"{instrument}/prompt/output-{day_obs:s}/SingleFrame*",
         where=f"exposure.science_program IN (survey)",
         bind={"survey": survey},
     )
-    dia_counts = count_datasets(
+    pipeline.ap_pipe = count(
+        "ap_pipe",
         butler_nocollection,
         "isr_log",
         f"{instrument}/prompt/output-{day_obs:s}/ApPipe*",
@@ -122,198 +260,98 @@ def make_summary_message(day_obs, instrument):
         butler_alias, collections=[collection, f"{instrument}/defaults"]
     )
 
-    log_visit_detector = set(
-        [
-            (x.dataId["exposure"], x.dataId["detector"])
-            for x in b.query_datasets(
-                "isr_log",
-                where=f"exposure.science_program IN (survey)",
-                bind={"survey": survey},
-                limit=None,
-                explain=False,
-            )
-        ]
-    )
-    missed = 0
-    counted = 0
-    # LSSTCam number of active detector is hard-coded here.
-    if instrument == "LSSTCam":
-        off_detector = 18
-        df = get_df_from_loki(
-            day_obs,
-            instrument=instrument,
-            match_string='|= "Preprocessing pipeline successfully run."',
-            match_string2="",
-        )
-        output_lines.append(
-            f"Number of expected preprocessing: {total_visit_count} nextVisits*(189-{off_detector} detectors)={total_visit_count * (189-off_detector)}. Successful: {len(df)}. "
-        )
-        expected = (len(raw_exposures) - len(groups_without_events)) * (
-            189 - off_detector
-        )
-        missed = expected - len(log_visit_detector)
-
-    df = get_df_from_loki(
-        day_obs, instrument=instrument, match_string='|= "Timed out waiting for image"'
-    )
-    count_total = len(df)
-    df = df[(df["instrument"] == instrument) & (df["group"].isin(groups))].set_index(
-        ["group", "detector"]
-    )
-    if count_total > 0:
-        counted += len(df)
-        output_lines.append(
-            f"- {len(df)} unexpected timeout ({count_total} total including raws not received)."
-        )
-    df = get_df_from_loki(
-        day_obs,
-        instrument=instrument,
-        match_string='|= "MiddlewareInterface(_get_central_butler()"',
-    )
-    count_total = len(df)
-    df = df[(df["instrument"] == instrument) & (df["group"].isin(groups))].set_index(
-        ["group", "detector"]
-    )
-    if count_total > 0:
-        counted += len(df)
-        output_lines.append(
-            f"- {len(df)} failure in instantiating MWI central butler connection ({count_total} total including raws not received)."
-        )
-    df = get_df_from_loki(
-        day_obs, instrument=instrument, match_string='|= "prep_butler"'
-    )
-    count_total = len(df)
-    df = df[(df["instrument"] == instrument) & (df["group"].isin(groups))].set_index(
-        ["group", "detector"]
-    )
-    if count_total > 0:
-        counted += len(df)
-        output_lines.append(
-            f"- {len(df)} failure in prep_butler ({count_total} total including raws not received)."
-        )
-        lines = _count_messages(
-            df,
-            [
-                "botocore.exceptions.ClientError",
-                "SSL SYSCALL error: EOF detected",
-                "SSL connection has been closed unexpectedly",
-                "server closed the connection unexpectedly",
-            ],
-        )
-        if lines:
-            output_lines.extend(lines)
-
-    df = get_df_from_loki(
-        day_obs,
-        instrument=instrument,
-        match_string='|= "loadDiaCatalogs" |= "cassandra"',
-        match_string2='| json | level="ERROR"',
-    )
-    count_total = len(df)
-    df = df[(df["instrument"] == instrument) & (df["group"].isin(groups))].set_index(
-        ["group", "detector"]
-    )
-    if count_total > 0:
-        output_lines.append(
-            f"- {len(df)} loadDiaCatalogs errors from cassandra ({count_total} total including raws not received)."
-        )
-        lines = _count_messages(
-            df,
-            [
-                "cassandra.cluster.NoHostAvailable",
-                "Error from server",
-            ],
-        )
-        if lines:
-            output_lines.extend(lines)
-
-    df = get_df_from_loki(
-        day_obs,
-        instrument=instrument,
-        match_string='|= "Timed out connecting to raw microservice"',
-        match_string2='| json | level="ERROR"',
-    )
-    df = df[(df["instrument"] == instrument) & (df["group"].isin(groups))].set_index(
-        ["group", "detector"]
-    )
-    if len(df) > 0:
-        output_lines.append(f"- {len(df)} Timed out connecting to raw microservice.")
-
-    output_lines.append(
-        f"Number of expected processing: ({len(raw_exposures)}-{len(groups_without_events)}) raws*(189-{off_detector} detectors)={expected:d}. Missed {missed}"
-    )
-    df = get_df_from_loki(
-        day_obs,
-        instrument=instrument,
-        match_string='|= "RuntimeError: Unable to retrieve JSON sidecar"',
-    )
-    df = df[(df["instrument"] == instrument) & (df["group"].isin(groups))].set_index(
-        ["group", "detector"]
-    )
-    if not df.empty:
-        counted += len(df)
-        output_lines.append(f"- {len(df)} failure in retrieving json sidecar.")
-
-    df = get_df_from_loki(
-        day_obs,
-        instrument=instrument,
-        match_string='|= "NoGoodPipelinesError: No main pipeline graph could be built"',
-    )
-    df = df[(df["instrument"] == instrument) & (df["group"].isin(groups))].set_index(
-        ["group", "detector"]
-    )
-    if not df.empty:
-        counted += len(df)
-        output_lines.append(
-            f"- {len(df)} NoGoodPipelinesError: {df.reset_index()['group'].unique().tolist()}"
-        )
-
-    if missed > 0:
-        output_lines.append(f"- {missed - counted} unspecified")
-
-    output_lines.append(
-        "Number of main pipeline runs with outputs: {:d} total, {:d} Isr, {:d} SingleFrame, {:d} ApPipe".format(
-            len(log_visit_detector), isr_counts, sfm_counts, dia_counts
-        )
+    pipeline.runs = count(
+        "runs",
+        b,
+        "isr_log",
+        [collection, f"{instrument}/defaults"],
+        find_first=True,
+        where=f"exposure.science_program IN (survey)",
+        bind={"survey": survey},
     )
-
-    isr_outputs = count_datasets(
+    if instrument in DETECTOR_COUNTS:
+        summary.detectors = DETECTOR_COUNTS[instrument]
+        inactive = None
+        if health is not None:
+            inactive = health.inactive_detectors(before=day_obs)
+        if inactive is None:
+            summary.off_detector = DEFAULT_INACTIVE_DETECTORS[instrument]
+        else:
+            summary.off_detector = len(inactive)
+        if counters is not None:
+            preprocessed, preprocessed_groups = counters.get_preprocessed(groups)
+        else:
+
+            def count_preprocessed():
+                # Only the survey raws of the instrument are expected to be
+                # preprocessed, so "Successful:" counts only those; it used to
+                # count every preprocessing line of the container's night.
+                detectors = Counter()
+                by_group = Counter()
+                for df in iter_loki_frames(
+                    day_obs,
+                    instrument=instrument,
+                    match_string=PREPROCESSING_SUCCESS.match_string,
+                    match_string2=PREPROCESSING_SUCCESS.match_string2,
+                    columns=["instrument", "group", "detector"],
+                ):
+                    df = df[(df["instrument"] == instrument) & (df["group"].isin(groups))]
+                    detectors.update(_known_detectors(df))
+                    by_group.update(df["group"].astype(str))
+                return _count_by_detector(detectors.elements()), dict(by_group)
+
+            preprocessed, preprocessed_groups = checkpoint.section(
+                "loki_preprocessed", [groups], count_preprocessed
+            )
+        summary.successful_preprocessing = sum(preprocessed.values())
+        summary.expected_processing = (
+            len(groups) - len(groups_without_events)
+        ) * (summary.detectors - summary.off_detector)
+        summary.missed = summary.expected_processing - pipeline.runs
+
+    failures = summary.failures
+    for key in LOKI_FAILURES:
+        failures[key] = get_failure(key)
+    failed_groups = Counter()
+    for failure in failures.values():
+        failed_groups.update(failure.by_group)
+    ledger = build_ledger(
+        next_visit_groups,
+        canceled_groups,
+        groups,
+        raws=raws_by_group,
+        preprocessed=preprocessed_groups,
+        loki_failures=failed_groups,
+        detectors=(
+            summary.detectors - summary.off_detector
+            if summary.detectors is not None
+            else None
+        ),
+    )
+    summary.ledger = ledger_to_dict(ledger)
+
+    pipeline.isr_passed = count(
+        "isr_passed",
         b,
         "calibrateImage_log",  # this misses ISR-only
         collection,
         where=f"exposure.science_program IN (survey)",
         bind={"survey": survey},
     )
-    output_lines.append(
-        "- isr: {:d} attempts with outputs, {:d} passed not including ISR-only attempts.".format(
-            isr_counts + sfm_counts + dia_counts, isr_outputs
-        )
-    )
-
-    sfm_outputs = count_datasets(
+    pipeline.calibrate_passed = count(
+        "calibrate_passed",
         b,
         "analyzePreliminarySummaryStats_log",
         collection,
         where=f"exposure.science_program IN (survey)",
         bind={"survey": survey},
     )
-    output_lines.append(
-        "- calibrateImage: {:d} attempts with outputs, {:d} passed, {:d} failed.".format(
-            sfm_counts + dia_counts, sfm_outputs, sfm_counts + dia_counts - sfm_outputs
-        )
-    )
-    output_lines.extend(
-        count_recurrent_pipeline_errors(
-            b,
-            f"visit.science_program='{survey}'AND instrument='{instrument}'",
-            "calibrateImage",
-        )
-    )
+    if progress is not None:
+        progress("processing", summary)
 
-    sfm_output_subset_visit_detector = set(
-        [
-            (x.dataId["visit"], x.dataId["detector"])
-            for x in butler_nocollection.query_datasets(
+    def query_sfm_outputs():
+        with get_limiter("butler").slot():
+            refs = butler_nocollection.query_datasets(
                 "analyzePreliminarySummaryStats_log",
                 collections=f"{instrument}/prompt/output-{day_obs:s}/ApPipe*",
                 where=f"exposure.science_program IN (survey)",
@@ -322,123 +360,320 @@ def make_summary_message(day_obs, instrument):
                 explain=False,
                 limit=None,
             )
-        ]
-    )
+        record_fetched("butler_refs", len(refs))
+        return sorted(set((x.dataId["visit"], x.dataId["detector"]) for x in refs))
 
-    dia_visit_detector = set(
-        [
-            (x.dataId["visit"], x.dataId["detector"])
-            for x in b.query_datasets(
-                "dia_source_apdb",
-                where=f"exposure.science_program IN (survey)",
-                bind={"survey": survey},
-                explain=False,
-                limit=None,
-            )
-        ]
-    )
-    count_no_work1, count_no_work2 = get_no_work_count_from_loki(
-        day_obs, "associateApdb", visit_detector=sfm_output_subset_visit_detector
-    )
-    count_no_apdb = count_no_work1 + count_no_work2
-    output_lines.append(
-        "- associateApdb: {:d} attempts with outputs, {:d}+{:d}+{:d}={:d} passed, {:d} failed".format(
-            dia_counts,
-            len(dia_visit_detector),
-            count_no_work1,
-            count_no_work2,
-            len(dia_visit_detector) + count_no_apdb,
-            dia_counts - len(dia_visit_detector) - count_no_apdb,
-        )
+    sfm_output_subset_visit_detector = set(
+        tuple(vd)
+        for vd in checkpoint.section("ap_pipe_sfm_outputs", [survey], query_sfm_outputs)
     )
-    if sfm_output_subset_visit_detector:
-        output_lines.append(
-            f"  - {dia_counts - len(sfm_output_subset_visit_detector)} failed at single frame stage"
-        )
+    pipeline.ap_pipe_calibrate_passed = len(sfm_output_subset_visit_detector)
 
-    if dia_counts > 0 and (dia_counts - len(dia_visit_detector) - count_no_apdb) > 0:
-        output_lines.extend(
-            count_recurrent_pipeline_errors(
-                b,
-                f"visit.science_program='{survey}'AND instrument='{instrument}'",
-                "subtractImages",
-            )
+    pipeline.associate_passed = count(
+        "associate_passed",
+        b,
+        "dia_source_apdb",
+        [collection, f"{instrument}/defaults"],
+        find_first=True,
+        where=f"exposure.science_program IN (survey)",
+        bind={"survey": survey},
+    )
+    if counters is not None:
+        count_no_work1, count_no_work2 = counters.get_no_work_count(
+            "associateApdb", visit_detector=sfm_output_subset_visit_detector
         )
-        output_lines.extend(
-            count_recurrent_pipeline_errors(
-                b,
-                f"visit.science_program='{survey}'AND instrument='{instrument}'",
+    else:
+        count_no_work1, count_no_work2 = checkpoint.section(
+            "loki_no_work_associateApdb",
+            [sorted(sfm_output_subset_visit_detector)],
+            lambda: get_no_work_count_from_loki(
+                day_obs,
                 "associateApdb",
-            )
+                visit_detector=sfm_output_subset_visit_detector,
+            ),
         )
+    pipeline.associate_no_work = count_no_work1
+    pipeline.associate_dropped = count_no_work2
+    count_no_apdb = count_no_work1 + count_no_work2
+    if progress is not None:
+        progress("associateApdb", summary)
 
-    output_lines.append(
-        f"<https://usdf-rsp.slac.stanford.edu/times-square/github/lsst-dm/vv-team-notebooks/PREOPS-prompt-error-msgs?day_obs={day_obs}&instrument={instrument}&ts_hide_code=1&survey={survey}|Full Error Log>"
-    )
+    # The slowest sections: they read the log of every failed task.
+    templates = []
+    if summary.unspecified > 0:
 
-    output_lines.append(
-        f"<https://usdf-rsp.slac.stanford.edu/times-square/github/lsst-sqre/times-square-usdf/prompt-processing/groups?date={day_obs}&instrument={instrument}&survey={survey}&mode=DEBUG&ts_hide_code=1|Timing plots>"
-    )
+        def mine():
+            miner = TemplateMiner()
+            mine_loki_errors(day_obs, instrument, groups, miner)
+            return [asdict(t) for t in miner.top(UNRECOGNIZED_TEMPLATES)]
 
-    df = get_df_from_loki(
-        day_obs,
-        instrument=instrument,
-        match_string='|= "export_outputs"',
-        match_string2='|= "Central repo export failed"',
-    )
-    df = df[(df["instrument"] == instrument) & (df["group"].isin(groups))].set_index(
-        ["group", "detector"]
-    )
-    if not df.empty:
-        output_lines.append(f"- {len(df)} failure in export_outputs.")
-        output_lines.append(f"  (Partial export may be incorrectly counted as success)")
-
-        lines = _count_messages(
-            df,
-            [
-                "botocore.exceptions.ClientError",
-                "SSL SYSCALL error: EOF detected",
-                "SSL connection has been closed unexpectedly",
-                "server closed the connection unexpectedly",
-                "psycopg2.errors.UniqueViolation",
-            ],
-        )
-        if lines:
-            output_lines.extend(lines)
+        templates += [
+            ErrorTemplate(**t)
+            for t in checkpoint.section("loki_unrecognized", [groups], mine)
+        ]
+    tasks = ["calibrateImage"]
+    dia_counts = pipeline.ap_pipe
+    if dia_counts > 0 and (dia_counts - pipeline.associate_passed - count_no_apdb) > 0:
+        tasks += ["subtractImages", "associateApdb"]
+    for task in tasks:
+        counts, task_templates = recurrent_errors(task)
+        pipeline.recurrent_errors[task] = counts
+        templates += task_templates
+    summary.unrecognized_errors = sorted(templates, key=lambda t: -t.count)[
+        :UNRECOGNIZED_TEMPLATES
+    ]
+    if progress is not None:
+        progress("errors", summary)
+
+    if summary.detectors is not None:
+        columns = {
+            "expected": [len(groups) - len(groups_without_events)] * summary.detectors,
+            "preprocessed": preprocessed,
+            "sfm_outputs": _count_by_detector(
+                d for _, d in sfm_output_subset_visit_detector
+            ),
+        }
+        columns.update({key: failure.detectors for key, failure in failures.items()})
+        summary.detector_counts = {
+            column: _detector_list(values, summary.detectors)
+            if isinstance(values, dict)
+            else values
+            for column, values in columns.items()
+        }
+
+    return summary
+
+
+def make_summary_message(day_obs, instrument):
+    """Make Prompt Processing summary message for a night
+
+    Parameters
+    ----------
+    day_obs : `str`
+        day_obs in the format of YYYY-MM-DD.
+    instrument : `str`
+        The instrument name.
+
+    Returns
+    -------
+    message : `str` or `None`
+        The report body, or `None` if there were no on-sky exposures.
+    """
+    summary = compute_night_summary(day_obs, instrument)
+    if summary.on_sky_exposures == 0:
+        return None
+    return "\n".join(render_summary_lines(summary))
 
-    df = get_df_from_loki(
+
+def _get_loki_failure(day_obs, instrument, groups, category):
+    """Count the survey raws reporting a failure in Loki.
+
+    Parameters
+    ----------
+    day_obs : `str`
+        day_obs in the format of YYYY-MM-DD.
+    instrument : `str`
+        The instrument name.
+    groups : `list` [`str`]
+        Groups of the survey raws.
+    category : `night_summary.LokiCategory`
+        What to query and how to break it down.
+
+    Returns
+    -------
+    failure : `night_summary.LokiFailure`
+    """
+    failure = LokiFailure()
+    by_group = Counter()
+    detectors = Counter()
+    # One frame, or one spilled partition at a time.
+    for df in iter_loki_frames(
         day_obs,
         instrument=instrument,
-        match_string='|= "Signal SIGTERM detected, cleaning up and shutting down."',
-        match_string2="",
-    )
-    count_total = len(df)
-    df = df[(df["instrument"] == instrument) & (df["group"].isin(groups))].set_index(
-        ["group", "detector"]
-    )
-    if count_total > 0:
-        output_lines.append(
-            f"- At least {len(df)} had SIGTERM ({count_total} total including raws not received)."
-        )
+        match_string=category.match_string,
+        match_string2=category.match_string2,
+        columns=["instrument", "group", "detector", "message"],
+    ):
+        failure.total += len(df)
+        df = df[(df["instrument"] == instrument) & (df["group"].isin(groups))]
+        failure.count += len(df)
+        if category.messages and not df.empty:
+            counts = _count_messages(df, category.messages)
+            failure.breakdown = {
+                msg: failure.breakdown.get(msg, 0) + n for msg, n in counts.items()
+            }
+        by_group.update(df["group"].astype(str))
+        detectors.update(_known_detectors(df))
+    if category.list_groups:
+        failure.groups = list(by_group)
+    failure.by_group = dict(by_group)
+    failure.detectors = _count_by_detector(detectors.elements())
+    return failure
+
+
+def _known_detectors(df):
+    """Return the detectors of Loki lines that have one.
+
+    A line without a detector is NaN in a frame and -1 once spilled.
+    """
+    detector = df["detector"].dropna()
+    return [int(d) for d in detector[detector >= 0]]
+
+
+def _count_by_detector(detectors):
+    counts = Counter(int(d) for d in detectors)
+    return {str(d): n for d, n in sorted(counts.items())}
 
-    return "\n".join(output_lines)
 
+def _detector_list(counts, detectors):
+    values = [0] * detectors
+    for detector, count in counts.items():
+        if 0 <= int(detector) < detectors:
+            values[int(detector)] = count
+    return values
 
-def count_datasets(butler, dataset_type, collection, **kwargs):
+
+def count_datasets(butler, dataset_type, collection, find_first=False, **kwargs):
+    """Count datasets without fetching their refs.
+
+    The count is done by the registry. Butlers without the query system
+    fall back to counting the refs of `lsst.daf.butler.Butler.query_datasets`.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+    dataset_type : `str`
+        The dataset type name.
+    collection : `str` or `list` [`str`]
+        Collections to search; may contain wildcards if not ``find_first``.
+    find_first : `bool`, optional
+        Whether to count only the first dataset of each data ID in the
+        ordered collections.
+    **kwargs
+        ``where``, ``bind`` and data ID values to constrain with.
+
+    Returns
+    -------
+    count : `int`
+        The number of datasets, or 0 if a collection does not exist.
+    """
     try:
-        refs = butler.query_datasets(
-            dataset_type,
-            collections=collection,
-            find_first=False,
-            explain=False,
-            limit=None,
-            **kwargs,
-        )
+        if not hasattr(butler, "query"):
+            return _count_refs(butler, dataset_type, collection, find_first, **kwargs)
+        collections = []
+        for expression in [collection] if isinstance(collection, str) else collection:
+            if any(c in expression for c in "*?["):
+                collections.extend(butler.collections.query(expression))
+            else:
+                collections.append(expression)
+        if not collections:
+            return 0
+        # kwargs are left whole for the fallback below.
+        where = kwargs.get("where", "")
+        constraints = {key: value for key, value in kwargs.items() if key != "where"}
+        with (
+            get_limiter("butler").slot(expected=dafButler.MissingCollectionError),
+            butler.query() as query,
+        ):
+            results = query.datasets(
+                dataset_type, collections=collections, find_first=find_first
+            )
+            if where:
+                results = results.where(where, **constraints)
+            elif constraints:
+                results = results.where(**constraints)
+            return results.count(exact=True, discard=False)
+    except NotImplementedError:
+        return _count_refs(butler, dataset_type, collection, find_first, **kwargs)
     except dafButler.MissingCollectionError:
         return 0
+
+
+def count_by_exposure(butler, dataset_type, collection, **kwargs):
+    """Count datasets by exposure without fetching their refs.
+
+    Only the exposure and detector of each dataset are returned by the
+    registry. Butlers without the query system fall back to the refs of
+    `lsst.daf.butler.Butler.query_datasets`.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+    dataset_type : `str`
+        The name of a dataset type with an ``exposure`` dimension.
+    collection : `str` or `list` [`str`]
+        Collections to search; no wildcards.
+    **kwargs
+        ``where``, ``bind`` and data ID values to constrain with.
+
+    Returns
+    -------
+    counts : `dict` [`int`, `int`]
+        The number of datasets by exposure ID, or empty if a collection
+        does not exist.
+    """
+    where = kwargs.get("where", "")
+    constraints = {key: value for key, value in kwargs.items() if key != "where"}
+    try:
+        if not hasattr(butler, "query"):
+            raise NotImplementedError()
+        with (
+            get_limiter("butler").slot(expected=dafButler.MissingCollectionError),
+            butler.query() as query,
+        ):
+            results = query.join_dataset_search(
+                dataset_type, collections=collection
+            ).data_ids(["exposure", "detector"])
+            if where:
+                results = results.where(where, **constraints)
+            elif constraints:
+                results = results.where(**constraints)
+            counts = Counter(data_id["exposure"] for data_id in results)
+        record_fetched("butler_data_ids", sum(counts.values()))
+        return dict(counts)
+    except NotImplementedError:
+        pass
+    except dafButler.MissingCollectionError:
+        return {}
+    try:
+        with get_limiter("butler").slot(expected=dafButler.MissingCollectionError):
+            refs = butler.query_datasets(
+                dataset_type,
+                collections=collection,
+                find_first=False,
+                explain=False,
+                limit=None,
+                **kwargs,
+            )
+    except dafButler.MissingCollectionError:
+        return {}
+    record_fetched("butler_refs", len(refs))
+    return dict(Counter(ref.dataId["exposure"] for ref in refs))
+
+
+def _count_refs(butler, dataset_type, collection, find_first, **kwargs):
+    try:
+        with get_limiter("butler").slot(expected=dafButler.MissingCollectionError):
+            refs = butler.query_datasets(
+                dataset_type,
+                collections=collection,
+                find_first=find_first,
+                explain=False,
+                limit=None,
+                **kwargs,
+            )
+    except dafButler.MissingCollectionError:
+        return 0
+    record_fetched("butler_refs", len(refs))
     return len(refs)
 
 
+# Inactive detectors assumed without a detector health history.
+DEFAULT_INACTIVE_DETECTORS = {"LSSTCam": 18}
+
+# Number of templates of unrecognized errors to report.
+UNRECOGNIZED_TEMPLATES = 5
+
 RECURRENT_ERRORS_BY_TASK = {
     "calibrateImage": [
         "Exception AllCentroidsFlaggedError",
@@ -477,71 +712,145 @@ RECURRENT_ERRORS_BY_TASK = {
 }
 
 
-def count_recurrent_pipeline_errors(butler, where, task):
+def count_recurrent_pipeline_errors(butler, where, task, miner=None):
     # with open("error_config.yaml") as f:
     #    RECURRENT_ERRORS_BY_TASK = yaml.safe_load(f)
     recurrent_errors = RECURRENT_ERRORS_BY_TASK.get(task, [])
-    refs = butler.query_datasets(
-        f"{task}_log",
-        where=where,
-        explain=False,
-        limit=None,
-    )
+    with get_limiter("butler").slot():
+        refs = butler.query_datasets(
+            f"{task}_log",
+            where=where,
+            explain=False,
+            limit=None,
+        )
+    record_fetched("butler_refs", len(refs))
     visit_errors = []
     for ref in refs:
-        log_messages = butler.get(ref)
+        with get_limiter("butler").slot():
+            log_messages = butler.get(ref)
+        record_fetched("log_records", len(log_messages))
         errors = [msg for msg in log_messages if msg.levelno > 30]
         visit_errors.extend(errors)
-    lines = []
-    total_count = 0
-    for err in recurrent_errors:
-        count = _count_error(err, visit_errors)
-        if count:
-            lines.append(f"    - {count} {err}")
-            total_count += count
-    if lines:
-        lines.insert(0, f"    Among {task} errors, {total_count} were")
-    return lines
+        if miner is not None:
+            _mine_unmatched(miner, recurrent_errors, errors, ref)
+    counts = _count_errors(recurrent_errors, visit_errors)
+    return dict(zip(recurrent_errors, counts))
+
 
+def _count_errors(errMsgs, visit_errors):
+    matcher = get_matcher(tuple(errMsgs))
+    return matcher.count(_.message for _ in visit_errors)
 
-def _count_error(errMsg, visit_errors):
-    return len([_.message for _ in visit_errors if errMsg in _.message])
+
+def _mine_unmatched(miner, errMsgs, errors, ref):
+    matcher = get_matcher(tuple(errMsgs))
+    example = f"{ref.dataId['visit']}/{ref.dataId['detector']}"
+    for error in errors:
+        if not matcher.search(error.message):
+            miner.add(error.message, example=example)
 
 
 def _count_messages(df, messages):
-    lines = []
-    for msg in messages:
-        sub_df = df[df["message"].str.contains(msg, na=False)]
-        if not sub_df.empty:
-            lines.append(f"  - {len(sub_df)}: {msg}.")
-    return lines
+    matcher = get_matcher(tuple(messages))
+    return dict(zip(messages, matcher.count(df["message"])))
 
 
 if __name__ == "__main__":
+    start_time = time.monotonic()
     instrument = os.getenv("INSTRUMENT")
     if not instrument:
         instrument = "LSSTCam"
     webhook = "SLACK_WEBHOOK_URL_" + instrument.upper()
     url = os.getenv(webhook)
+    summary_root = os.getenv("SUMMARY_ROOT")
 
     day_obs = date.today() - timedelta(days=1)
     day_obs_string = day_obs.strftime("%Y-%m-%d")
-    summary = make_summary_message(day_obs_string, instrument)
-    output_message = (
-        f":clamps: *{instrument} {day_obs.strftime('%A %Y-%m-%d')}* :clamps: \n"
-        + summary
-    )
-
-    if not url:
-        print(f"Must set environment variable {webhook} in order to post")
-        print("Message: ")
-        print(output_message)
-        sys.exit(1)
-
-    res = requests.post(
-        url, headers={"Content-Type": "application/json"}, json={"text": output_message}
-    )
-
-    if res.status_code != 200:
-        print("Failed to send message")
-        print(res)
+    counters = None
+    checkpoint_dir = os.getenv("LIVE_CHECKPOINT_DIR")
+    if checkpoint_dir:
+        counters = load_finished_counters(checkpoint_dir, instrument, day_obs_string)
+    checkpoint = SectionCheckpoint(
+        os.getenv("REPORT_CHECKPOINT_DIR"), instrument, day_obs_string
+    )
+    if checkpoint.posted():
+        print(f"Already posted the report of {day_obs_string}")
+        sys.exit(0)
+    report = None
+    token = os.getenv("SLACK_BOT_TOKEN_" + instrument.upper())
+    channel = os.getenv("SLACK_CHANNEL_" + instrument.upper())
+    if os.getenv("PROGRESSIVE_REPORT") and (url or (token and channel)):
+        report = ProgressiveReport(
+            webhook=url,
+            token=token,
+            channel=channel,
+            api_url=os.getenv("SLACK_API_URL") or SLACK_API_URL,
+            checkpoint=checkpoint,
+        )
+    health = None
+    health_dir = os.getenv("DETECTOR_HEALTH_DIR")
+    if health_dir and instrument in DETECTOR_COUNTS:
+        health = DetectorHealth(health_dir, instrument)
+    summary = compute_night_summary(
+        day_obs_string,
+        instrument,
+        counters=counters,
+        checkpoint=checkpoint,
+        health=health,
+        progress=report,
+    )
+    # Post first: the by-products below must not keep the report from
+    # Slack, so their failures are only logged.
+    status = 0
+    if summary.on_sky_exposures == 0:
+        # Do not send message if there are no on-sky exposures.
+        pass
+    elif report is not None:
+        if report.finish(summary):
+            checkpoint.mark_posted()
+        else:
+            print("Failed to send message")
+            status = 1
+    else:
+        output_message = render_slack(summary)
+        if not url:
+            print(f"Must set environment variable {webhook} in order to post")
+            print("Message: ")
+            print(output_message)
+            status = 1
+        elif not post_webhook(url, output_message):
+            print("Failed to send message")
+            status = 1
+        else:
+            checkpoint.mark_posted()
+
+    def record(what, func, *args):
+        try:
+            func(*args)
+        except Exception:
+            logging.exception(f"Failed to {what}")
+
+    if health is not None and summary.detector_counts:
+        record(
+            "record the detector health",
+            health.append,
+            day_obs_string,
+            summary.detector_counts,
+        )
+    log_limiter_stats()
+    metrics_file = os.getenv("METRICS_FILE")
+    pushgateway = os.getenv("PUSHGATEWAY_URL")
+    if metrics_file or pushgateway:
+        metrics = render_metrics(summary, time.monotonic() - start_time)
+        if metrics_file:
+            record("write the metrics", write_metrics, metrics, metrics_file)
+        if pushgateway:
+            record("push the metrics", push_metrics, metrics, pushgateway, instrument)
+    if summary_root:
+        record(
+            "write the summary",
+            lambda: ResourcePath(
+                summary_path(summary_root, instrument, day_obs_string)
+            ).write(summary.to_json().encode(), overwrite=True),
+        )
+    sys.exit(status)
@@ -20,21 +20,41 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 __all__ = [
+    "LOKI_LIMIT",
+    "SURVEY_OUTCOMES",
     "get_next_visit_events",
     "get_no_work_count_from_loki",
     "get_status_code_from_loki",
+    "get_survey_outcomes_from_loki",
     "get_df_from_loki",
+    "iter_loki",
+    "iter_loki_frames",
+    "iter_loki_window",
+    "query_loki_window",
+    "stream_loki",
+    "tail_loki",
 ]
 import logging
 import json
+import os
 import re
+import shutil
 import subprocess
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
 
 from astropy.time import Time, TimeDelta
 import pandas
 
 from lsst_efd_client import EfdClient
 
+from limiter import get_limiter
+from loki_archive import LokiArchive, archive_path
+from loki_spill import SPILL_COLUMNS, LokiPartitions
+from matching import get_matcher
+from metrics import record_fetched
+
 logging.basicConfig(
     format="{levelname} {asctime} {name} - {message}",
     style="{",
@@ -42,6 +62,12 @@ logging.basicConfig(
 _log = logging.getLogger(__name__)
 _log.setLevel(logging.DEBUG)
 
+# Maximum number of lines returned by one Loki query.
+LOKI_LIMIT = 200000
+# Maximum number of past lines a Loki tail starts with; Loki caps it at its
+# max_entries_limit_per_query, 5000 by default, and logcli's default is 30.
+TAIL_BACKFILL_LIMIT = 5000
+
 
 def get_start_end(day_obs):
     """Return start time and end time of a day_obs
@@ -84,10 +110,12 @@ async def get_next_visit_events(day_obs, instrument, survey=None):
 
     topic = "lsst.sal.ScriptQueue.logevent_nextVisit"
     start, end = get_start_end(day_obs)
-    df = await client.select_time_series(topic, ["*"], start.utc, end.utc)
-    canceled = await client.select_time_series(
-        topic + "Canceled", ["*"], start.utc, end.utc
-    )
+    async with get_limiter("efd").async_slot():
+        df = await client.select_time_series(topic, ["*"], start.utc, end.utc)
+    async with get_limiter("efd").async_slot():
+        canceled = await client.select_time_series(
+            topic + "Canceled", ["*"], start.utc, end.utc
+        )
 
     if df.empty:
         _log.info(f"No events on {day_obs}")
@@ -113,9 +141,182 @@ def query_loki(day_obs, container_name, search_string):
     ----------
     day_obs : `str`
         day_obs in the format of YYYY-MM-DD.
+    container_name : `str`
+        The container whose logs to query.
+    search_string : `str`
+        LogQL pipeline to filter with.
+
+    Notes
+    -----
+    If ``LOKI_ARCHIVE_DIR`` is set and holds a `loki_archive.LokiArchive`
+    of the container and night, the query is answered from it instead.
     """
+    archive_root = os.getenv("LOKI_ARCHIVE_DIR")
+    if archive_root:
+        directory = archive_path(archive_root, container_name, day_obs)
+        if os.path.exists(directory):
+            with LokiArchive(directory) as archive:
+                return archive.query(search_string, limit=LOKI_LIMIT)
     start, end = get_start_end(day_obs)
-    command = [
+    return query_loki_window(container_name, search_string, start, end)
+
+
+def query_loki_window(container_name, search_string, start, end):
+    """Query Grafana Loki for the log records of a time window.
+
+    Unlike `query_loki`, this always asks Loki, never an archive.
+
+    Parameters
+    ----------
+    container_name : `str`
+        The container whose logs to query.
+    search_string : `str`
+        LogQL pipeline to filter with.
+    start, end : `astropy.time.Time` or `datetime.datetime`
+        The window, from ``start`` included to ``end`` excluded, to the
+        second.
+
+    Returns
+    -------
+    results : `str` or `None`
+        Newest first, at most `LOKI_LIMIT` records, or `None` if the query
+        failed.
+    """
+    command = _query_command(container_name, search_string, start, end)
+
+    with get_limiter("loki").slot() as slot:
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            slot.fail()
+    if result.returncode != 0:
+        _log.error("Loki query failed")
+        _log.error(result.stderr)
+        return
+
+    record_fetched("loki_lines", result.stdout.count("\n"))
+    return result.stdout
+
+
+def iter_loki_window(container_name, search_string, start, end):
+    """Yield the log records of a time window, oldest first.
+
+    The window is halved while Loki returns as many records as its limit,
+    as when archiving a night, so no record is cut off.
+
+    Parameters
+    ----------
+    container_name : `str`
+        The container whose logs to query.
+    search_string : `str`
+        LogQL pipeline to filter with.
+    start, end : `datetime.datetime`
+        The window, from ``start`` included to ``end`` excluded, to the
+        second.
+
+    Yields
+    ------
+    line : `str`
+        One record in the ``logcli --output=jsonl`` format.
+
+    Raises
+    ------
+    RuntimeError
+        Raised if a query fails, or if one second has more than
+        `LOKI_LIMIT` records.
+    """
+    results = query_loki_window(container_name, search_string, start, end)
+    if results is None:
+        raise RuntimeError(f"Failed to query Loki from {start} to {end}")
+    records = results.splitlines()
+    if len(records) < LOKI_LIMIT:
+        yield from reversed(records)
+        return
+    if end - start <= timedelta(seconds=1):
+        raise RuntimeError(f"Loki has over {LOKI_LIMIT} lines from {start} to {end}")
+    middle = start + timedelta(seconds=(end - start).total_seconds() // 2)
+    yield from iter_loki_window(container_name, search_string, start, middle)
+    yield from iter_loki_window(container_name, search_string, middle, end)
+
+
+def stream_loki(day_obs, container_name, search_string):
+    """Query Grafana Loki for log records, as they are received.
+
+    Unlike `query_loki`, the output is never held in memory as a whole.
+
+    Parameters
+    ----------
+    day_obs : `str`
+        day_obs in the format of YYYY-MM-DD.
+    container_name : `str`
+        The container whose logs to query.
+    search_string : `str`
+        LogQL pipeline to filter with.
+
+    Yields
+    ------
+    line : `str`
+        One record in the ``logcli --output=jsonl`` format. If the query
+        fails, the error is logged and the records stop.
+    """
+    archive_root = os.getenv("LOKI_ARCHIVE_DIR")
+    if archive_root:
+        directory = archive_path(archive_root, container_name, day_obs)
+        if os.path.exists(directory):
+            with LokiArchive(directory) as archive:
+                for n, line in enumerate(archive.iter_query(search_string)):
+                    if n >= LOKI_LIMIT:
+                        break
+                    yield line
+            return
+    command = _query_command(container_name, search_string, *get_start_end(day_obs))
+    lines = 0
+    # stderr goes to a file, so that a chatty logcli cannot block on it
+    # while stdout is read.
+    with tempfile.TemporaryFile("w+") as stderr, get_limiter("loki").slot() as slot:
+        with subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=stderr, text=True
+        ) as process:
+            for line in process.stdout:
+                lines += 1
+                yield line.rstrip("\n")
+            process.wait()
+        if process.returncode != 0:
+            slot.fail()
+            stderr.seek(0)
+            _log.error("Loki query failed")
+            _log.error(stderr.read())
+    record_fetched("loki_lines", lines)
+
+
+def iter_loki(day_obs, container_name, search_string):
+    """Yield the records of a Loki query.
+
+    They are streamed with `stream_loki` if ``LOKI_SPILL_DIR`` is set, and
+    split from the result of `query_loki` otherwise.
+    """
+    if os.getenv("LOKI_SPILL_DIR"):
+        yield from stream_loki(day_obs, container_name, search_string)
+        return
+    results = query_loki(day_obs, container_name, search_string)
+    if results:
+        yield from results.splitlines()
+
+
+def _spilled_frames(day_obs, container_name, search_string, columns):
+    spill_root = os.getenv("LOKI_SPILL_DIR")
+    os.makedirs(spill_root, exist_ok=True)
+    directory = tempfile.mkdtemp(prefix=f"{container_name}-", dir=spill_root)
+    try:
+        partitions = LokiPartitions.write(
+            directory, stream_loki(day_obs, container_name, search_string)
+        )
+        yield from partitions.frames(columns)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _query_command(container_name, search_string, start, end):
+    return [
         "logcli",
         "query",
         "--output=jsonl",
@@ -123,20 +324,88 @@ def query_loki(day_obs, container_name, search_string):
         "--addr=http://sdfloki.slac.stanford.edu:80",
         "--timezone=UTC",
         "-q",
-        "--limit=200000",
+        f"--limit={LOKI_LIMIT}",
         "--proxy-url=http://sdfproxy.sdf.slac.stanford.edu:3128",
         f'--from={start.strftime("%Y-%m-%dT%H:%M:%SZ")}',
         f'--to={end.strftime("%Y-%m-%dT%H:%M:%SZ")}',
         f'{{namespace="vcluster--usdf-prompt-processing",container="{container_name}"}} {search_string}',
     ]
 
-    result = subprocess.run(command, capture_output=True, text=True)
-    if result.returncode != 0:
-        _log.error("Loki query failed")
-        _log.error(result.stderr)
-        return
 
-    return result.stdout
+def tail_loki(container_name, search_string, start, until=None):
+    """Follow Grafana Loki log records as they arrive.
+
+    Unlike `query_loki`, this does not take a slot of the shared Loki
+    limiter, as the connection is held for the whole night. At most
+    `TAIL_BACKFILL_LIMIT` records from before the tail was opened are
+    returned, so a ``start`` far in the past should first be caught up on
+    with `iter_loki_window`.
+
+    Parameters
+    ----------
+    container_name : `str`
+        The container whose logs to follow.
+    search_string : `str`
+        LogQL pipeline to filter with.
+    start : `str`
+        Time to start from, in the format of YYYY-MM-DDTHH:MM:SSZ.
+    until : `datetime.datetime`, optional
+        Wall-clock time at which to stop following. If not given, follow
+        until logcli exits.
+
+    Yields
+    ------
+    line : `str`
+        One record in the ``logcli --output=jsonl`` format.
+
+    Raises
+    ------
+    RuntimeError
+        Raised if logcli exits with an error.
+    """
+    command = [
+        "logcli",
+        "query",
+        "--tail",
+        "--output=jsonl",
+        "--tls-skip-verify",
+        "--addr=http://sdfloki.slac.stanford.edu:80",
+        "--timezone=UTC",
+        "-q",
+        f"--limit={TAIL_BACKFILL_LIMIT}",
+        "--proxy-url=http://sdfproxy.sdf.slac.stanford.edu:3128",
+        f"--from={start}",
+        f'{{namespace="vcluster--usdf-prompt-processing",container="{container_name}"}} {search_string}',
+    ]
+    # As in stream_loki, stderr goes to a file so that logcli cannot block
+    # on it for the whole night.
+    with (
+        tempfile.TemporaryFile("w+") as stderr,
+        subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=stderr, text=True
+        ) as process,
+    ):
+        timer = None
+        if until is not None:
+            delay = (until - datetime.now(timezone.utc)).total_seconds()
+            timer = threading.Timer(max(delay, 0), process.terminate)
+            timer.start()
+        try:
+            for line in process.stdout:
+                yield line.rstrip("\n")
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if process.poll() is None:
+                process.terminate()
+        process.wait()
+        if until is not None and datetime.now(timezone.utc) >= until:
+            return
+        if process.returncode != 0:
+            stderr.seek(0)
+            _log.error("Loki tail failed")
+            _log.error(stderr.read())
+            raise RuntimeError(f"logcli exited with {process.returncode}")
 
 
 def get_status_code_from_loki(day_obs):
@@ -230,6 +499,39 @@ def get_df_from_loki(
     return df
 
 
+def iter_loki_frames(
+    day_obs,
+    instrument="LSSTCam",
+    match_string="",
+    match_string2='|= "Processing failed"',
+    columns=SPILL_COLUMNS,
+):
+    """Yield the records of `get_df_from_loki` in frames of bounded size.
+
+    If ``LOKI_SPILL_DIR`` is set, the records are streamed to
+    `loki_spill.LokiPartitions` under it, yielded a partition at a time
+    and deleted afterwards. Otherwise the only frame is the result of
+    `get_df_from_loki`.
+
+    Parameters
+    ----------
+    day_obs, instrument, match_string, match_string2
+        As for `get_df_from_loki`.
+    columns : iterable [`str`], optional
+        The `loki_spill.SPILL_COLUMNS` needed, when spilled.
+
+    Yields
+    ------
+    df : `pandas.DataFrame`
+    """
+    if not os.getenv("LOKI_SPILL_DIR"):
+        yield get_df_from_loki(day_obs, instrument, match_string, match_string2)
+        return
+    yield from _spilled_frames(
+        day_obs, instrument.lower(), f"{match_string} {match_string2}", columns
+    )
+
+
 def get_no_work_count_from_loki(
     day_obs, task_name, instrument="LSSTCam", visit_detector=None
 ):
@@ -241,6 +543,10 @@ def get_no_work_count_from_loki(
         A set of (visit, detector) tuples to filter with. If given,
         only count numbers overlapping this set.
     """
+    if os.getenv("LOKI_SPILL_DIR"):
+        return _get_spilled_no_work_count(
+            day_obs, task_name, instrument.lower(), visit_detector
+        )
     results = query_loki(
         day_obs,
         container_name=instrument.lower(),
@@ -264,38 +570,113 @@ def get_no_work_count_from_loki(
     return count1, count2
 
 
-def get_skipped_surveys_from_loki(day_obs, instrument="LSSTCam"):
-    results = query_loki(
-        day_obs,
-        container_name=instrument.lower(),
-        search_string='|= "Skipping visit: No pipeline configured for"',
+def _get_spilled_no_work_count(day_obs, task_name, container_name, visit_detector):
+    count1 = sum(
+        1
+        for _ in stream_loki(
+            day_obs, container_name, f'|= "Nothing to do for task \'{task_name}"'
+        )
     )
+    search_string = f'|= "Dropping task {task_name} because no quanta remain (1 had no work to do)"'
+    if visit_detector is None:
+        return count1, sum(1 for _ in stream_loki(day_obs, container_name, search_string))
+    keys = list(visit_detector)
+    count2 = 0
+    for df in _spilled_frames(
+        day_obs, container_name, search_string, ["exposure", "detector"]
+    ):
+        if len(df) and keys:
+            count2 += int(
+                pandas.MultiIndex.from_arrays([df["exposure"], df["detector"]])
+                .isin(keys)
+                .sum()
+            )
+    return count1, count2
 
-    pattern = re.compile(
-        r".*Skipping visit: No pipeline configured for.*survey=(?P<survey>[-\w]*),"
-    )
-    skipped_surveys = set()
-    for line in results.splitlines():
-        m = pattern.match(line)
-        if m:
-            skipped_surveys |= {m["survey"]}
-    return skipped_surveys
 
+# Outcomes of a (group, detector) in the instrument container, from the most
+# to the least decisive, with a substring of the lines reporting each.
+SURVEY_OUTCOMES = {
+    "unsupported": "Unsupported survey",
+    "skipped": "Skipping visit: No pipeline configured for",
+    "failed": "Processing failed",
+    "preprocessed": "Preprocessing pipeline successfully run.",
+}
+_OUTCOME_SURVEY = {
+    "unsupported": re.compile(r"RuntimeError: Unsupported survey: (?P<survey>[-\w]*)"),
+    "skipped": re.compile(
+        r"Skipping visit: No pipeline configured for.*survey=(?P<survey>[-\w]*),"
+    ),
+}
 
-def get_unsupported_surveys_from_loki(day_obs, instrument="LSSTCam"):
-    results = query_loki(
-        day_obs,
-        container_name=instrument.lower(),
-        search_string='|= "Unsupported survey"',
-    )
 
-    pattern = re.compile(r".*RuntimeError: Unsupported survey: (?P<survey>[-\w]*)")
-    unsupported_surveys = set()
-    for line in results.splitlines():
-        m = pattern.match(line)
-        if m:
-            unsupported_surveys |= {m["survey"]}
-    return unsupported_surveys
+def get_survey_outcomes_from_loki(day_obs, instrument="LSSTCam"):
+    """Get the outcome of every (group, detector) for all surveys at once.
+
+    All of `SURVEY_OUTCOMES` are fetched with one query. If it returns
+    `LOKI_LIMIT` lines, the night is fetched again in time windows small
+    enough for none to be cut off.
+
+    Parameters
+    ----------
+    day_obs : `str`
+        day_obs in the format of YYYY-MM-DD.
+    instrument : `str`
+        Instrument name.
+
+    Returns
+    -------
+    df : `pandas.DataFrame`
+        One row per (group, detector), with its most decisive ``outcome``
+        and, for skipped and unsupported visits, the ``survey`` named in
+        the line; empty otherwise.
+    """
+    names = list(SURVEY_OUTCOMES)
+    needles = tuple(SURVEY_OUTCOMES.values())
+    matcher = get_matcher(needles)
+    container_name = instrument.lower()
+    search_string = "|~ `" + "|".join(re.escape(n) for n in needles) + "`"
+
+    def classify(records):
+        outcomes = {}
+        lines = 0
+        for raw in records:
+            lines += 1
+            try:
+                fields = json.loads(json.loads(raw)["line"])
+            except (json.JSONDecodeError, KeyError, TypeError) as e:
+                _log.error(f"Failed to parse \n{raw}\n JSON decode error: {e}")
+                continue
+            if not isinstance(fields, dict) or fields.get("instrument", instrument) != instrument:
+                continue
+            message = fields.get("message") or ""
+            found = matcher.search(message)
+            if not found:
+                continue
+            # The most decisive outcome of a (group, detector) is kept.
+            rank = min(found)
+            key = (fields.get("group"), fields.get("detector"))
+            if key in outcomes and outcomes[key][0] <= rank:
+                continue
+            pattern = _OUTCOME_SURVEY.get(names[rank])
+            m = pattern.search(message) if pattern else None
+            outcomes[key] = (rank, m["survey"] if m else "")
+        return outcomes, lines
+
+    outcomes, lines = classify(iter_loki(day_obs, container_name, search_string))
+    if lines >= LOKI_LIMIT:
+        _log.warning(f"Loki returned {lines} outcome lines, the limit; querying by window.")
+        start, end = (t.to_datetime(timezone=timezone.utc) for t in get_start_end(day_obs))
+        outcomes, _ = classify(
+            iter_loki_window(container_name, search_string, start, end)
+        )
+    return pandas.DataFrame.from_records(
+        [
+            (group, detector, names[rank], survey)
+            for (group, detector), (rank, survey) in outcomes.items()
+        ],
+        columns=["group", "detector", "outcome", "survey"],
+    )
 
 
 def parse_loki_results(results):
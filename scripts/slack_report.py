@@ -0,0 +1,214 @@
+# This file is part of nightly-reporting-jobs.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Post the nightly report to Slack, section by section if asked.
+
+An incoming webhook posts every section as a message of its own. With a
+bot token and a channel, the sections after the headline are threaded
+replies to it instead, posted with ``chat.postMessage``.
+"""
+
+__all__ = [
+    "SLACK_API_URL",
+    "ProgressiveReport",
+    "post_chat",
+    "post_webhook",
+]
+import logging
+
+import requests
+
+from night_summary import REPORT_SECTIONS, render_slack
+
+logging.basicConfig(
+    format="{levelname} {asctime} {name} - {message}",
+    style="{",
+)
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.DEBUG)
+
+SLACK_API_URL = "https://slack.com/api"
+
+
+def post_webhook(url, text):
+    """Post a message to a Slack incoming webhook.
+
+    Parameters
+    ----------
+    url : `str`
+        The webhook URL.
+    text : `str`
+
+    Returns
+    -------
+    posted : `bool`
+    """
+    try:
+        res = requests.post(
+            url,
+            headers={"Content-Type": "application/json"},
+            json={"text": text},
+            timeout=30,
+        )
+    except requests.RequestException as e:
+        _log.error(f"Failed to post to Slack: {e}")
+        return False
+    if res.status_code != 200:
+        _log.error(f"Failed to post to Slack: {res.status_code} {res.text}")
+        return False
+    return True
+
+
+def post_chat(token, channel, text, thread_ts=None, api_url=SLACK_API_URL):
+    """Post a message with the Slack Web API.
+
+    Parameters
+    ----------
+    token : `str`
+        A bot token allowed to ``chat:write`` in ``channel``.
+    channel : `str`
+        The channel ID.
+    text : `str`
+    thread_ts : `str`, optional
+        Timestamp of the message to reply to.
+    api_url : `str`, optional
+        Base URL of the Web API.
+
+    Returns
+    -------
+    ts : `str` or `None`
+        Timestamp of the new message, or `None` if it was not posted.
+    """
+    payload = {"channel": channel, "text": text}
+    if thread_ts is not None:
+        payload["thread_ts"] = thread_ts
+    try:
+        res = requests.post(
+            f"{api_url.rstrip('/')}/chat.postMessage",
+            headers={"Authorization": f"Bearer {token}"},
+            json=payload,
+            timeout=30,
+        )
+        reply = res.json()
+    except (requests.RequestException, ValueError) as e:
+        _log.error(f"Failed to post to Slack: {e}")
+        return None
+    # The Web API answers errors with a 200 and ``"ok": false``.
+    if res.status_code != 200 or not reply.get("ok"):
+        _log.error(f"Failed to post to Slack: {res.status_code} {reply.get('error')}")
+        return None
+    return reply["ts"]
+
+
+class ProgressiveReport:
+    """Deliver the sections of a report as soon as they are computed.
+
+    Pass as the ``progress`` of
+    `prompt_processing_summary.compute_night_summary`, then call `finish`
+    with the summary it returns.
+
+    Parameters
+    ----------
+    webhook : `str`, optional
+        An incoming webhook URL.
+    token, channel : `str`, optional
+        A bot token and channel ID; if both are given they are used
+        instead of ``webhook``, and the sections are threaded.
+    api_url : `str`, optional
+        Base URL of the Web API.
+    checkpoint : `checkpoint.SectionCheckpoint`, optional
+        Where to record the sections posted, so that a rerun after a
+        failure posts only the others.
+    """
+
+    def __init__(
+        self, webhook=None, token=None, channel=None, api_url=SLACK_API_URL, checkpoint=None
+    ):
+        self.threaded = bool(token and channel)
+        if not self.threaded and not webhook:
+            raise ValueError("Either a webhook or a token and channel are needed")
+        self.webhook = webhook
+        self.token = token
+        self.channel = channel
+        self.api_url = api_url
+        self.checkpoint = checkpoint
+        self.posted = checkpoint.posted_sections() if checkpoint is not None else {}
+
+    def __call__(self, section, summary):
+        """Post one section, unless it was posted already or is empty.
+
+        Parameters
+        ----------
+        section : `str`
+            One of `night_summary.REPORT_SECTIONS`.
+        summary : `night_summary.NightSummary`
+
+        Returns
+        -------
+        posted : `bool`
+            Whether the section is posted or has nothing to post.
+        """
+        if section in self.posted:
+            return True
+        text = render_slack(summary, section)
+        if not text:
+            return True
+        if section != "headline" and not self.threaded:
+            text = f"_{summary.instrument} {summary.day_obs}, continued_\n{text}"
+        if self.threaded:
+            ts = post_chat(
+                self.token,
+                self.channel,
+                text,
+                thread_ts=self.posted.get("headline"),
+                api_url=self.api_url,
+            )
+            if ts is None:
+                return False
+        else:
+            if not post_webhook(self.webhook, text):
+                return False
+            ts = None
+        _log.info(f"Posted the {section} of {summary.day_obs}")
+        self.posted[section] = ts
+        if self.checkpoint is not None:
+            self.checkpoint.mark_section_posted(section, ts)
+        return True
+
+    def finish(self, summary):
+        """Post the sections not posted yet.
+
+        These are the sections after an early return of the computation,
+        and those that failed to post.
+
+        Parameters
+        ----------
+        summary : `night_summary.NightSummary`
+            The complete summary.
+
+        Returns
+        -------
+        posted : `bool`
+            Whether every section is posted.
+        """
+        if summary.on_sky_exposures == 0:
+            return True
+        return all([self(section, summary) for section in REPORT_SECTIONS])
@@ -0,0 +1,497 @@
+# This file is part of nightly-reporting-jobs.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Local stand-ins for Loki, the EFD and the Butler.
+
+They serve a `synthetic_night.SyntheticNight` through the same calls the
+report makes, so the report code can be run and timed offline.
+"""
+
+__all__ = [
+    "LocalButler",
+    "LocalEfdClient",
+    "LocalLoki",
+    "LocalPushgateway",
+    "LocalSlack",
+    "install_stand_ins",
+]
+import contextlib
+import fnmatch
+import functools
+import http.server
+import json
+import operator
+import os
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from unittest import mock
+
+import lsst.daf.butler as dafButler
+
+import queries
+from logql import parse_pipeline
+
+
+class LocalLoki:
+    """Serve Loki queries from the JSONL files written by
+    `synthetic_night.write_night`.
+
+    Parameters
+    ----------
+    directory : `str`
+        Directory containing ``loki/<container>.jsonl``.
+    limit : `int`, optional
+        Maximum number of lines returned, as ``logcli --limit``.
+    tail_limit : `int`, optional
+        Maximum number of lines a tail starts with, as
+        `queries.TAIL_BACKFILL_LIMIT`.
+    clock : callable, optional
+        Returns the present as an aware `datetime.datetime`; lines after it
+        are streamed by a tail as if they arrived live.
+    """
+
+    def __init__(self, directory, limit=200000, tail_limit=30, clock=None):
+        self.directory = directory
+        self.limit = limit
+        self.tail_limit = tail_limit
+        self.clock = clock or (lambda: datetime.now(timezone.utc))
+
+    def iter_entries(self, container_name, search_string=""):
+        """Yield matching raw ``logcli --output=jsonl`` lines.
+
+        Parameters
+        ----------
+        container_name : `str`
+            The container whose logs to read.
+        search_string : `str`
+            LogQL pipeline to filter with.
+        """
+        pipeline = parse_pipeline(search_string)
+        # A literal that needs no escaping appears verbatim in the outer
+        # JSON, so most lines can be rejected without decoding them.
+        prefilters = [
+            lit for lit in pipeline.literals if json.dumps(json.dumps(lit)) == f'"\\"{lit}\\""'
+        ]
+        path = os.path.join(self.directory, "loki", f"{container_name}.jsonl")
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            for raw in f:
+                if not all(lit in raw for lit in prefilters):
+                    continue
+                if pipeline.match(json.loads(raw)["line"]):
+                    yield raw.rstrip("\n")
+
+    def query(self, day_obs, container_name, search_string):
+        """Drop-in replacement for `queries.query_loki`."""
+        lines = []
+        for raw in self.iter_entries(container_name, search_string):
+            lines.append(raw)
+            if len(lines) >= self.limit:
+                break
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def stream(self, day_obs, container_name, search_string):
+        """Drop-in replacement for `queries.stream_loki`."""
+        for n, raw in enumerate(self.iter_entries(container_name, search_string)):
+            if n >= self.limit:
+                break
+            yield raw
+
+    def window(self, container_name, search_string, start, end):
+        """Drop-in replacement for `queries.query_loki_window`."""
+        start = start.strftime("%Y-%m-%dT%H:%M:%S")
+        end = end.strftime("%Y-%m-%dT%H:%M:%S")
+        lines = deque(maxlen=self.limit)
+        for raw in self.iter_entries(container_name, search_string):
+            if start <= json.loads(raw)["timestamp"] < end:
+                lines.append(raw)
+        return "".join(raw + "\n" for raw in reversed(lines))
+
+    def tail(self, container_name, search_string, start, until=None):
+        """Drop-in replacement for `queries.tail_loki`.
+
+        Like Loki, starts with at most ``tail_limit`` of the latest lines
+        between ``start`` and the present of ``clock``, then streams the
+        later lines and stops at the end of the file instead of waiting for
+        more. The files are in timestamp order, so the lines are streamed
+        as they are read.
+        """
+        start = start.rstrip("Z")
+        now = self.clock().strftime("%Y-%m-%dT%H:%M:%S.%f")
+        backfill = deque(maxlen=self.tail_limit)
+        for raw in self.iter_entries(container_name, search_string):
+            timestamp = json.loads(raw)["timestamp"]
+            if timestamp < start:
+                continue
+            if timestamp <= now:
+                backfill.append(raw)
+                continue
+            while backfill:
+                yield backfill.popleft()
+            yield raw
+        yield from backfill
+
+
+class LocalEfdClient:
+    """Stand-in for `lsst_efd_client.EfdClient`.
+
+    Parameters
+    ----------
+    night : `synthetic_night.SyntheticNight`
+    """
+
+    def __init__(self, night):
+        self._topics = dict(
+            zip(
+                (
+                    "lsst.sal.ScriptQueue.logevent_nextVisit",
+                    "lsst.sal.ScriptQueue.logevent_nextVisitCanceled",
+                ),
+                night.next_visit_events(),
+            )
+        )
+
+    async def select_time_series(self, topic, fields, start, end):
+        return self._topics[topic].copy()
+
+
+_CLAUSE = re.compile(
+    r"^(?:(?P<element>\w+)\.)?(?P<key>\w+)\s*(?P<op>!=|<=|>=|=|<|>|\bIN\b)\s*(?P<value>.+)$",
+    re.IGNORECASE,
+)
+_OPS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def _parse_value(text, bind):
+    text = text.strip()
+    if text.startswith("(") and text.endswith(")"):
+        values = []
+        for item in text[1:-1].split(","):
+            value = _parse_value(item, bind)
+            values.extend(value if isinstance(value, (list, tuple, set)) else [value])
+        return values
+    if text[0] in "'\"":
+        return text[1:-1]
+    if re.fullmatch(r"-?\d+", text):
+        return int(text)
+    return bind[text]
+
+
+def _where_predicate(where, bind):
+    """Compile the simple ``AND`` of comparisons used by the report."""
+    clauses = []
+    for text in re.split(r"\s*\bAND\b\s*", where or "", flags=re.IGNORECASE):
+        text = text.strip()
+        if not text or re.search(r"\bOR\b", text, re.IGNORECASE):
+            # Only "can_see_sky or can_see_sky=NULL" is used, always true here.
+            continue
+        while text.startswith("(") and text.count("(") > text.count(")"):
+            text = text[1:].strip()
+        while text.endswith(")") and text.count(")") > text.count("("):
+            text = text[:-1].strip()
+        m = _CLAUSE.match(text)
+        if not m:
+            raise ValueError(f"Unsupported where clause: {text!r}")
+        value = _parse_value(m["value"], bind or {})
+        op = m["op"].upper()
+        compare = (lambda a, b: a in b) if op == "IN" else _OPS[op]
+        clauses.append((m["key"], compare, value))
+
+    def predicate(lookup):
+        return all(compare(lookup(key), value) for key, compare, value in clauses)
+
+    return predicate
+
+
+class _LocalCollections:
+    def __init__(self, names):
+        self._names = names
+
+    def query(self, expression):
+        return [name for name in self._names if fnmatch.fnmatchcase(name, expression)]
+
+
+class LocalButler:
+    """Stand-in for `lsst.daf.butler.Butler` over a synthetic night.
+
+    Parameters
+    ----------
+    night : `synthetic_night.SyntheticNight`
+    config : `str`, optional
+        The repository alias; ignored.
+    collections : `list` [`str`], optional
+        Default collections to search.
+    """
+
+    def __init__(self, night, config=None, collections=None, **kwargs):
+        self._night = night
+        self._default_collections = collections or []
+        self._records = {r.id: r for r in night.exposure_records()}
+        instrument = night.params.instrument
+        self._chains = {
+            night.output_chain: [night.run_name(p) for p in ("ApPipe", "SingleFrame", "Isr")],
+            f"{instrument}/defaults": [],
+        }
+        runs = [f"{instrument}/raw/all"] + self._chains[night.output_chain]
+        self.collections = _LocalCollections(runs + list(self._chains))
+
+    def _resolve_runs(self, collections):
+        if isinstance(collections, str):
+            collections = [collections]
+        runs = set()
+        for expression in collections:
+            matches = self.collections.query(expression)
+            if not matches and not any(c in expression for c in "*?["):
+                raise dafButler.MissingCollectionError(
+                    f"Collection {expression!r} not found."
+                )
+            for name in matches:
+                runs.update(self._chains.get(name, [name]))
+        return runs
+
+    def _lookup(self, data_id):
+        record = self._records.get(data_id.get("exposure"))
+
+        def lookup(key):
+            if key in data_id:
+                return data_id[key]
+            return getattr(record, key)
+
+        return lookup
+
+    def query_dimension_records(
+        self, element, instrument=None, where="", bind=None, limit=None, **kwargs
+    ):
+        predicate = _where_predicate(where, bind)
+        records = [
+            r
+            for r in self._records.values()
+            if predicate(functools.partial(getattr, r))
+            and (instrument is None or r.instrument == instrument)
+        ]
+        return records[:limit] if limit and limit > 0 else records
+
+    def query_datasets(
+        self,
+        dataset_type,
+        collections=None,
+        where="",
+        bind=None,
+        limit=None,
+        instrument=None,
+        **kwargs,
+    ):
+        runs = self._resolve_runs(collections or self._default_collections)
+        predicate = _where_predicate(where, bind)
+        refs = []
+        for ref in self._night.iter_datasets(dataset_type):
+            if ref.run in runs and predicate(self._lookup(ref.dataId)):
+                refs.append(ref)
+                if limit and limit > 0 and len(refs) >= limit:
+                    break
+        return refs
+
+    @contextlib.contextmanager
+    def query(self):
+        yield _LocalQuery(self)
+
+    def get(self, ref):
+        return self._night.task_log(ref)
+
+
+class _LocalQuery:
+    def __init__(self, butler, dataset_search=None):
+        self._butler = butler
+        self._dataset_search = dataset_search
+
+    def datasets(self, dataset_type, collections=None, find_first=True):
+        return _LocalDatasetQueryResults(self._butler, dataset_type, collections)
+
+    def join_dataset_search(self, dataset_type, collections=None):
+        return _LocalQuery(self._butler, (dataset_type, collections))
+
+    def data_ids(self, dimensions=None):
+        return _LocalDataIdQueryResults(self._butler, *self._dataset_search)
+
+
+class _LocalDatasetQueryResults:
+    def __init__(self, butler, dataset_type, collections, where="", kwargs=None):
+        self._butler = butler
+        self._dataset_type = dataset_type
+        self._collections = collections
+        self._where = where
+        self._kwargs = kwargs or {}
+
+    def where(self, *args, **kwargs):
+        where = " AND ".join(w for w in (self._where, *args) if w)
+        return type(self)(
+            self._butler,
+            self._dataset_type,
+            self._collections,
+            where,
+            self._kwargs | kwargs,
+        )
+
+    def _refs(self):
+        return self._butler.query_datasets(
+            self._dataset_type,
+            collections=self._collections,
+            where=self._where,
+            **self._kwargs,
+        )
+
+    def count(self, exact=True, discard=False):
+        return len(self._refs())
+
+
+class _LocalDataIdQueryResults(_LocalDatasetQueryResults):
+    def __iter__(self):
+        return (ref.dataId for ref in self._refs())
+
+
+class LocalPushgateway:
+    """Stand-in for a Prometheus Pushgateway on a local port.
+
+    Use as a context manager; ``url`` is the base URL to push to, and
+    ``pushed`` maps each grouping key path to the last text pushed to it.
+    """
+
+    def __init__(self):
+        self.pushed = {}
+        gateway = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_PUT(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                gateway.pushed[self.path] = body.decode()
+                self.send_response(200)
+                self.end_headers()
+
+            do_POST = do_PUT
+
+            def do_GET(self):
+                body = "".join(gateway.pushed.values()).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        host, port = self._server.server_address
+        self.url = f"http://{host}:{port}"
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class LocalSlack:
+    """Stand-in for Slack on a local port.
+
+    Use as a context manager. ``webhook`` is an incoming webhook URL and
+    ``api_url`` the base URL of the Web API, accepting any token.
+    ``messages`` lists every message posted, in order, as a `dict` of its
+    ``text``, its ``ts``, the ``thread_ts`` it replies to if any, and the
+    ``time.monotonic`` it was received at.
+    """
+
+    def __init__(self):
+        self.messages = []
+        slack = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                ts = f"{1000000000 + len(slack.messages)}.000100"
+                slack.messages.append(
+                    {
+                        "text": payload["text"],
+                        "ts": ts,
+                        "thread_ts": payload.get("thread_ts"),
+                        "time": time.monotonic(),
+                    }
+                )
+                if self.path.endswith("/chat.postMessage"):
+                    body = json.dumps({"ok": True, "channel": payload["channel"], "ts": ts})
+                    content_type = "application/json"
+                else:
+                    body, content_type = "ok", "text/plain"
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        host, port = self._server.server_address
+        self.webhook = f"http://{host}:{port}/services/webhook"
+        self.api_url = f"http://{host}:{port}/api"
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@contextlib.contextmanager
+def install_stand_ins(night, directory):
+    """Route the report's Loki, EFD and Butler calls to local stand-ins.
+
+    Parameters
+    ----------
+    night : `synthetic_night.SyntheticNight`
+        The night to serve.
+    directory : `str`
+        Where ``night`` was written by `synthetic_night.write_night`.
+    """
+    loki = LocalLoki(directory)
+    with (
+        mock.patch.object(queries, "query_loki", loki.query),
+        mock.patch.object(queries, "query_loki_window", loki.window),
+        mock.patch.object(queries, "stream_loki", loki.stream),
+        mock.patch.object(queries, "tail_loki", loki.tail),
+        mock.patch.object(queries, "EfdClient", lambda *args: LocalEfdClient(night)),
+        mock.patch.object(dafButler, "Butler", functools.partial(LocalButler, night)),
+    ):
+        yield
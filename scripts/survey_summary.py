@@ -1,72 +1,173 @@
 import asyncio
-import requests
 import sys
 import os
-from lsst.daf.butler import Butler
+import numpy as np
+import pandas
+import lsst.daf.butler as dafButler
 from datetime import date, timedelta
 
+from limiter import get_limiter
+from metrics import record_fetched
 from queries import (
+    SURVEY_OUTCOMES,
     get_next_visit_events,
-    get_skipped_surveys_from_loki,
-    get_unsupported_surveys_from_loki,
+    get_survey_outcomes_from_loki,
 )
+from slack_report import post_webhook
 
 
-if __name__ == "__main__":
-    instrument = "LSSTCam"
-    webhook = "SLACK_WEBHOOK_URL_" + instrument.upper()
-    url = os.getenv(webhook)
+def query_exposures(day_obs, instrument):
+    """Get the exposure records of a night.
 
-    day_obs = date.today() - timedelta(days=1)
-    day_obs_string = day_obs.strftime("%Y-%m-%d")
-    day_obs_int = int(day_obs_string.replace("-", ""))
+    Parameters
+    ----------
+    day_obs : `str`
+        day_obs in the format of YYYY-MM-DD.
+    instrument : `str`
+        The instrument name.
 
-    df, canceled = asyncio.run(get_next_visit_events(day_obs_string, instrument))
-    df = df[df["survey"] != ""]
+    Returns
+    -------
+    df : `pandas.DataFrame`
+        The ``group``, ``science_program`` and whether each exposure is an
+        ``on_sky`` science exposure.
+    """
+    butler_nocollection = dafButler.Butler("embargo")
+    with get_limiter("butler").slot():
+        records = butler_nocollection.query_dimension_records(
+            "exposure",
+            instrument=instrument,
+            where="day_obs=day_obs_int",
+            bind={"day_obs_int": int(day_obs.replace("-", ""))},
+            explain=False,
+            limit=None,
+        )
+    record_fetched("butler_records", len(records))
+    return pandas.DataFrame.from_records(
+        [
+            (
+                r.group,
+                r.science_program,
+                r.observation_type == "science" and r.can_see_sky in (True, None),
+            )
+            for r in records
+        ],
+        columns=["group", "science_program", "on_sky"],
+    )
 
-    output_lines = []
 
-    butler_alias = "embargo"
-    butler_nocollection = Butler(butler_alias)
-    raw_exposures = butler_nocollection.query_dimension_records(
-        "exposure",
-        instrument=instrument,
-        where=f"day_obs={day_obs_int} AND (exposure.can_see_sky or exposure.can_see_sky=NULL) AND exposure.observation_type='science'",
-        explain=False,
-    )
-    output_lines.append(
-        "Number of on-sky science exposures: {:d}".format(len(raw_exposures))
+async def fetch_sources(day_obs, instrument):
+    """Query the EFD, the Butler and Loki concurrently, once each."""
+    (events, canceled), exposures, outcomes = await asyncio.gather(
+        get_next_visit_events(day_obs, instrument),
+        asyncio.to_thread(query_exposures, day_obs, instrument),
+        asyncio.to_thread(get_survey_outcomes_from_loki, day_obs, instrument),
     )
+    return events, canceled, exposures, outcomes
 
-    for block in df["survey"].unique():
-        canceled_list = (
-            df[df["survey"] == block]
-            .index.intersection(canceled.set_index("groupId").index)
-            .tolist()
-        )
-        count_canceled = len(canceled_list)
-        df = df.drop(canceled_list)
-        count_events = len(df[df["survey"] == block])
-        filters = df[df["survey"] == block]["filters"].unique()
 
-        raw_exposures = butler_nocollection.query_dimension_records(
-            "exposure",
-            instrument=instrument,
-            where=f"day_obs=day_obs_int AND exposure.science_program IN (survey)",
-            bind={"day_obs_int": day_obs_int, "survey": block},
-            explain=False,
+def compute_survey_summary(events, canceled, exposures, outcomes):
+    """Break the night down by survey.
+
+    Parameters
+    ----------
+    events, canceled : `pandas.DataFrame`
+        nextVisit and canceled events, from `queries.get_next_visit_events`.
+    exposures : `pandas.DataFrame`
+        From `query_exposures`.
+    outcomes : `pandas.DataFrame`
+        From `queries.get_survey_outcomes_from_loki`.
+
+    Returns
+    -------
+    surveys : `pandas.DataFrame`
+        Indexed by survey, in the order of their first nextVisit event and
+        then of the surveys only Loki knows of, with the counts of
+        ``next_visits`` not canceled, ``canceled`` events, the ``filters``
+        of the former, ``raws`` exposures, and of the (group, detector)
+        ``received`` by Prompt Processing and with each of
+        `queries.SURVEY_OUTCOMES`.
+    """
+    events = events[events["survey"] != ""]
+    is_canceled = events.index.isin(canceled["groupId"])
+    live = events[~is_canceled]
+    # Outcomes of groups with a nextVisit are those of its survey; the
+    # lines of skipped and unsupported visits also name it.
+    group_surveys = events.groupby(level=0)["survey"].first()
+    outcomes = outcomes.assign(
+        survey=outcomes["survey"].where(
+            outcomes["survey"] != "", outcomes["group"].map(group_surveys)
         )
-        output_lines.append(
-            f"{block}: {count_events} uncanceled nextVisit events ({count_canceled} canceled) with filters {filters}. {len(raw_exposures)} raw exposures."
+    ).dropna(subset=["survey"])
+    outcomes = outcomes[outcomes["survey"] != ""]
+
+    index = pandas.Index(events["survey"].unique(), name="survey")
+    index = index.append(pandas.Index(outcomes["survey"].unique()).difference(index))
+    surveys = pandas.DataFrame(index=index)
+    surveys["next_visits"] = live.groupby("survey").size()
+    surveys["canceled"] = events[is_canceled].groupby("survey").size()
+    surveys["raws"] = exposures.groupby("science_program").size()
+    surveys["received"] = outcomes.groupby("survey").size()
+    per_outcome = outcomes.groupby(["survey", "outcome"]).size().unstack()
+    for outcome in SURVEY_OUTCOMES:
+        if outcome in per_outcome:
+            surveys[outcome] = per_outcome[outcome]
+        else:
+            surveys[outcome] = 0
+    surveys = surveys.fillna(0).astype("int64")
+    filters = live.groupby("survey")["filters"].unique()
+    surveys["filters"] = [
+        filters[s] if s in filters.index else np.array([], dtype=object)
+        for s in surveys.index
+    ]
+    return surveys
+
+
+def render_survey_lines(exposures, surveys):
+    """Render the body of the survey report.
+
+    Parameters
+    ----------
+    exposures : `pandas.DataFrame`
+        From `query_exposures`.
+    surveys : `pandas.DataFrame`
+        From `compute_survey_summary`.
+
+    Returns
+    -------
+    lines : `list` [`str`]
+    """
+    lines = [
+        "Number of on-sky science exposures: {:d}".format(int(exposures["on_sky"].sum()))
+    ]
+    for block, row in surveys.iterrows():
+        lines.append(
+            f"{block}: {row['next_visits']} uncanceled nextVisit events ({row['canceled']} canceled) with filters {row['filters']}. {row['raws']} raw exposures. "
+            f"Prompt Processing: {row['received']} received, {row['preprocessed']} preprocessed, "
+            f"{row['failed']} failed, {row['skipped']} skipped, {row['unsupported']} unsupported."
         )
+    unsupported_surveys = surveys.index[surveys["unsupported"] > 0]
+    if len(unsupported_surveys):
+        lines.append(f"Unknown survey: {', '.join(unsupported_surveys)}")
+    skipped_surveys = surveys.index[surveys["skipped"] > 0]
+    if len(skipped_surveys):
+        lines.append(f"Skipped survey: {', '.join(skipped_surveys)}")
+    return lines
 
-    unsupported_surveys = get_unsupported_surveys_from_loki(day_obs_string)
-    if unsupported_surveys:
-        output_lines.append(f"Unknown survey: {', '.join(unsupported_surveys)}")
 
-    skipped_surveys = get_skipped_surveys_from_loki(day_obs_string)
-    if skipped_surveys:
-        output_lines.append(f"Skipped survey: {', '.join(skipped_surveys)}")
+if __name__ == "__main__":
+    instrument = "LSSTCam"
+    webhook = "SLACK_WEBHOOK_URL_" + instrument.upper()
+    url = os.getenv(webhook)
+
+    day_obs = date.today() - timedelta(days=1)
+    day_obs_string = day_obs.strftime("%Y-%m-%d")
+
+    events, canceled, exposures, outcomes = asyncio.run(
+        fetch_sources(day_obs_string, instrument)
+    )
+    surveys = compute_survey_summary(events, canceled, exposures, outcomes)
+    output_lines = render_survey_lines(exposures, surveys)
 
     output_message = (
         f":clamps: *{instrument} {day_obs.strftime('%A %Y-%m-%d')}* :clamps: \n"
@@ -79,10 +180,6 @@ if __name__ == "__main__":
         print(output_message)
         sys.exit(1)
 
-    res = requests.post(
-        url, headers={"Content-Type": "application/json"}, json={"text": output_message}
-    )
-
-    if res.status_code != 200:
+    if not post_webhook(url, output_message):
         print("Failed to send message")
-        print(res)
+        sys.exit(1)
@@ -0,0 +1,819 @@
+# This file is part of nightly-reporting-jobs.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Generate synthetic nights of Prompt Processing for scaling tests.
+
+A night is described by per-visit states and a (visit, detector) outcome
+array. The EFD frames, exposure records, dataset refs, task logs and Loki
+lines are all derived from those arrays, so they stay consistent by group
+and detector and can be regenerated lazily at any scale.
+
+Run as a script to write nights to disk and optionally time the report
+against the local stand-ins in `stand_ins`::
+
+    python synthetic_night.py --scale 1 10 100 --output /tmp/nights --run
+"""
+
+__all__ = [
+    "LOKI_FAILURE_MESSAGES",
+    "OUTCOMES",
+    "SURVEY_BY_INSTRUMENT",
+    "ExposureRecord",
+    "LocalDatasetRef",
+    "LogRecord",
+    "NightParameters",
+    "SyntheticNight",
+    "generate_night",
+    "load_night",
+    "write_night",
+]
+import argparse
+import dataclasses
+import heapq
+import itertools
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas
+
+logging.basicConfig(
+    format="{levelname} {asctime} {name} - {message}",
+    style="{",
+)
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.DEBUG)
+
+SURVEY_BY_INSTRUMENT = {
+    "LATISS": "BLOCK-306",
+    "LSSTComCam": "BLOCK-320",
+    "LSSTCam": "BLOCK-365",
+}
+
+# Per-detector outcomes. Everything before "isr_fail" leaves no pipeline
+# outputs; "inactive" marks detectors that are never processed.
+OUTCOMES = (
+    "success",
+    "no_work",
+    "isr_fail",
+    "calibrate_fail",
+    "subtract_fail",
+    "associate_fail",
+    "timeout",
+    "central_butler",
+    "prep_butler",
+    "sidecar",
+    "no_good_pipelines",
+    "unspecified",
+    "inactive",
+)
+_CODE = {name: code for code, name in enumerate(OUTCOMES)}
+
+# Loki-only conditions that can occur on top of any outcome, as bit flags.
+EXTRAS = ("cassandra", "raw_microservice", "export", "sigterm")
+_BIT = {name: 1 << bit for bit, name in enumerate(EXTRAS)}
+
+PIPELINES = ("ApPipe", "SingleFrame", "Isr")
+_PIPELINE_TASKS = {
+    "Isr": ("isr",),
+    "SingleFrame": ("isr", "calibrateImage", "analyzePreliminarySummaryStats"),
+    "ApPipe": (
+        "isr",
+        "calibrateImage",
+        "analyzePreliminarySummaryStats",
+        "subtractImages",
+        "associateApdb",
+    ),
+}
+_FAILED_TASK = {
+    "isr_fail": "isr",
+    "calibrate_fail": "calibrateImage",
+    "subtract_fail": "subtractImages",
+    "associate_fail": "associateApdb",
+}
+DATASET_TYPES = (
+    "raw",
+    "isr_log",
+    "calibrateImage_log",
+    "analyzePreliminarySummaryStats_log",
+    "subtractImages_log",
+    "associateApdb_log",
+    "dia_source_apdb",
+)
+_FILTERS = ("u_24", "g_6", "r_57", "i_39", "z_20", "y_10")
+# Exposure IDs are day_obs * _EXPOSURES_PER_DAY + sequence number; wide
+# enough for the sequence numbers of a night scaled up 1000 times.
+_EXPOSURES_PER_DAY = 10_000_000
+
+# Messages the report looks for in the instrument container logs.
+LOKI_FAILURE_MESSAGES = {
+    "timeout": "Timed out waiting for image",
+    "central_butler": "MiddlewareInterface(_get_central_butler()",
+    "prep_butler": "prep_butler",
+    "sidecar": "RuntimeError: Unable to retrieve JSON sidecar",
+    "no_good_pipelines": "NoGoodPipelinesError: No main pipeline graph could be built",
+    "cassandra": "loadDiaCatalogs",
+    "raw_microservice": "Timed out connecting to raw microservice",
+    "export": "Central repo export failed",
+    "sigterm": "Signal SIGTERM detected, cleaning up and shutting down.",
+}
+_BUTLER_ERRORS = (
+    "botocore.exceptions.ClientError: An error occurred (503) when calling the GetObject operation",
+    "psycopg2.OperationalError: SSL SYSCALL error: EOF detected",
+    "psycopg2.OperationalError: SSL connection has been closed unexpectedly",
+    "psycopg2.OperationalError: server closed the connection unexpectedly",
+)
+_EXPORT_ERRORS = _BUTLER_ERRORS + (
+    'psycopg2.errors.UniqueViolation: duplicate key value violates unique constraint "dataset_tags_pkey"',
+)
+_CASSANDRA_ERRORS = (
+    "cassandra.cluster.NoHostAvailable: ('Unable to complete the operation against any hosts', {})",
+    "Error from server: code=1100 [Coordinator node timed out waiting for replica nodes' responses]",
+)
+# Failures that none of the report's categories recognize.
+_UNSPECIFIED_ERRORS = (
+    "OSError: [Errno 28] No space left on device: '/tmp/butler-{group}'",
+    "KeyError: 'detector {detector} not found in camera'",
+    "MemoryError: Unable to allocate {size} MiB for an array",
+    "ValueError: Visit {exposure} has inconsistent exposure time",
+    "TimeoutError: Redis stream read timed out after {size} s",
+)
+
+
+@dataclass(frozen=True)
+class ExposureRecord:
+    """Stand-in for an ``exposure`` dimension record."""
+
+    instrument: str
+    id: int
+    group: str
+    day_obs: int
+    science_program: str
+    physical_filter: str
+    observation_type: str = "science"
+    can_see_sky: bool = True
+
+
+@dataclass(frozen=True)
+class LocalDatasetRef:
+    """Stand-in for `lsst.daf.butler.DatasetRef`."""
+
+    datasetType: str
+    run: str
+    dataId: dict
+    id: int
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+@dataclass(frozen=True)
+class LogRecord:
+    """Stand-in for `lsst.daf.butler.logging.ButlerLogRecord`."""
+
+    name: str
+    levelno: int
+    message: str
+
+
+@dataclass
+class NightParameters:
+    """Knobs of a synthetic night.
+
+    Rates in ``failure_rates`` are per (visit, detector) and exclusive;
+    the remainder succeed. Rates in ``extra_rates`` are independent.
+    """
+
+    day_obs: str = "2025-06-01"
+    instrument: str = "LSSTCam"
+    n_visits: int = 1000
+    n_detectors: int = 189
+    inactive_detectors: list | None = None
+    surveys: dict | None = None
+    skipped_surveys: list = field(default_factory=list)
+    unsupported_surveys: list = field(default_factory=list)
+    canceled_rate: float = 0.02
+    no_raw_rate: float = 0.01
+    no_next_visit_rate: float = 0.005
+    pipeline_fractions: dict = field(
+        default_factory=lambda: {"ApPipe": 0.9, "SingleFrame": 0.07, "Isr": 0.03}
+    )
+    failure_rates: dict = field(
+        default_factory=lambda: {
+            "no_work": 0.01,
+            "isr_fail": 0.002,
+            "calibrate_fail": 0.03,
+            "subtract_fail": 0.01,
+            "associate_fail": 0.005,
+            "timeout": 0.002,
+            "central_butler": 0.0005,
+            "prep_butler": 0.001,
+            "sidecar": 0.0005,
+            "no_good_pipelines": 0.0005,
+            "unspecified": 0.001,
+        }
+    )
+    extra_rates: dict = field(
+        default_factory=lambda: {
+            "cassandra": 0.002,
+            "raw_microservice": 0.0005,
+            "export": 0.001,
+            "sigterm": 0.0005,
+        }
+    )
+    seed: int = 0
+
+    def __post_init__(self):
+        if self.surveys is None:
+            self.surveys = {SURVEY_BY_INSTRUMENT.get(self.instrument, "BLOCK-365"): 1.0}
+        if self.inactive_detectors is None:
+            if self.instrument == "LSSTCam" and self.n_detectors >= 189:
+                # Matches the 18 inactive detectors assumed by the report.
+                self.inactive_detectors = list(range(0, 189, 11))[:18]
+            else:
+                self.inactive_detectors = []
+
+    def scaled(self, factor):
+        """Return a copy with ``factor`` times as many visits."""
+        return dataclasses.replace(self, n_visits=int(self.n_visits * factor))
+
+
+@dataclass
+class SyntheticNight:
+    """A generated night.
+
+    Attributes
+    ----------
+    params : `NightParameters`
+    visits : `pandas.DataFrame`
+        One row per visit with ``groupId``, ``exposure``, ``survey``,
+        ``filters``, ``state``, ``pipeline`` and ``time`` columns. ``state``
+        is one of ``ok``, ``canceled``, ``no_raw`` (nextVisit but no
+        exposure), ``no_next_visit`` (exposure but no nextVisit),
+        ``skipped`` or ``unsupported``.
+    outcome : `numpy.ndarray`
+        (visit, detector) codes indexing `OUTCOMES`.
+    extra : `numpy.ndarray`
+        (visit, detector) bit flags of `EXTRAS`.
+    detail : `numpy.ndarray`
+        (visit, detector) random integers choosing message variants.
+    """
+
+    params: NightParameters
+    visits: pandas.DataFrame
+    outcome: np.ndarray
+    extra: np.ndarray
+    detail: np.ndarray
+
+    @property
+    def day_obs_int(self):
+        return int(self.params.day_obs.replace("-", ""))
+
+    @property
+    def output_chain(self):
+        return f"{self.params.instrument}/prompt/output-{self.params.day_obs}"
+
+    def run_name(self, pipeline):
+        """Return the output RUN collection of a pipeline."""
+        return f"{self.output_chain}/{pipeline}/prompt-proc-release-synthetic"
+
+    @property
+    def containers(self):
+        return (self.params.instrument.lower(), "next-visit-fan-out")
+
+    def next_visit_events(self):
+        """Return frames shaped like the EFD nextVisit topics.
+
+        Returns
+        -------
+        df : `pandas.DataFrame`
+            ``lsst.sal.ScriptQueue.logevent_nextVisit`` events.
+        canceled : `pandas.DataFrame`
+            ``lsst.sal.ScriptQueue.logevent_nextVisitCanceled`` events.
+        """
+        visits = self.visits[self.visits["state"] != "no_next_visit"]
+        index = pandas.to_datetime(visits["time"], utc=True)
+        df = pandas.DataFrame(
+            {
+                "groupId": visits["groupId"].to_numpy(),
+                "instrument": self.params.instrument,
+                "survey": visits["survey"].to_numpy(),
+                "filters": visits["filters"].to_numpy(),
+                "private_efdStamp": index.astype("int64").to_numpy() / 1e9,
+            },
+            index=index.to_numpy(),
+        )
+        canceled = df[(visits["state"] == "canceled").to_numpy()][
+            ["groupId", "private_efdStamp"]
+        ]
+        return df, canceled
+
+    def _has_exposure(self):
+        return ~self.visits["state"].isin(["canceled", "no_raw"]).to_numpy()
+
+    def exposure_records(self):
+        """Return the ``exposure`` dimension records of the night."""
+        visits = self.visits[self._has_exposure()]
+        return [
+            ExposureRecord(
+                instrument=self.params.instrument,
+                id=int(row.exposure),
+                group=row.groupId,
+                day_obs=self.day_obs_int,
+                science_program=row.survey,
+                physical_filter=row.filters,
+            )
+            for row in visits.itertuples()
+        ]
+
+    def visit_index(self, exposure):
+        """Return the row in ``visits`` of an exposure ID."""
+        return int(exposure) - self.day_obs_int * _EXPOSURES_PER_DAY - 1
+
+    def _dataset_mask(self, dataset_type):
+        """Return a (visit, detector) mask of cells having a dataset."""
+        outcome = self.outcome
+        state = self.visits["state"].to_numpy()[:, None]
+        if dataset_type == "raw":
+            return (
+                self._has_exposure()[:, None]
+                & (outcome != _CODE["timeout"])
+            )
+        processed = (state == "ok") & (outcome <= _CODE["associate_fail"])
+        pipeline = self.visits["pipeline"].to_numpy()[:, None]
+        task = dataset_type.removesuffix("_log")
+        if dataset_type == "dia_source_apdb":
+            return processed & (pipeline == "ApPipe") & (outcome == _CODE["success"])
+        mask = np.zeros_like(processed)
+        for label, tasks in _PIPELINE_TASKS.items():
+            if task in tasks:
+                mask |= pipeline == label
+        mask &= processed
+        # Tasks after a failure, or dropped for lack of work, leave no log.
+        order = _PIPELINE_TASKS["ApPipe"]
+        for failure, failed_task in _FAILED_TASK.items():
+            if order.index(task) > order.index(failed_task):
+                mask &= outcome != _CODE[failure]
+        if task == "associateApdb":
+            mask &= outcome != _CODE["no_work"]
+        if task == "analyzePreliminarySummaryStats":
+            mask &= outcome != _CODE["calibrate_fail"]
+        return mask
+
+    def iter_datasets(self, dataset_type):
+        """Yield the refs of one dataset type.
+
+        Parameters
+        ----------
+        dataset_type : `str`
+            One of `DATASET_TYPES`.
+        """
+        type_index = DATASET_TYPES.index(dataset_type)
+        n, m = self.outcome.shape
+        visits, detectors = np.nonzero(self._dataset_mask(dataset_type))
+        exposures = self.visits["exposure"].to_numpy()
+        pipelines = self.visits["pipeline"].to_numpy()
+        raw_run = f"{self.params.instrument}/raw/all"
+        runs = {label: self.run_name(label) for label in PIPELINES}
+        for i, d in zip(visits.tolist(), detectors.tolist()):
+            data_id = {
+                "instrument": self.params.instrument,
+                "exposure": int(exposures[i]),
+                "detector": d,
+            }
+            if dataset_type != "raw":
+                data_id["visit"] = int(exposures[i])
+            yield LocalDatasetRef(
+                datasetType=dataset_type,
+                run=raw_run if dataset_type == "raw" else runs[pipelines[i]],
+                dataId=data_id,
+                id=(type_index * n + i) * m + d,
+            )
+
+    def task_log(self, ref):
+        """Return the log records stored in a ``*_log`` dataset.
+
+        Parameters
+        ----------
+        ref : `LocalDatasetRef`
+        """
+        from prompt_processing_summary import RECURRENT_ERRORS_BY_TASK
+
+        task = ref.datasetType.removesuffix("_log")
+        i = self.visit_index(ref.dataId["exposure"])
+        d = ref.dataId["detector"]
+        name = f"lsst.{task}"
+        records = [LogRecord(name, 20, f"Processing {ref.dataId}")]
+        outcome = OUTCOMES[self.outcome[i, d]]
+        if _FAILED_TASK.get(outcome) == task:
+            options = RECURRENT_ERRORS_BY_TASK.get(task, []) + [
+                f"Exception RuntimeError: Unexpected failure in {task}"
+            ]
+            message = options[int(self.detail[i, d]) % len(options)]
+            records.append(LogRecord(name, 40, f"{message} on detector {d}"))
+        return records
+
+    def _loki_messages(self, row, i, d):
+        """Return ``(level, message)`` pairs logged by one pod."""
+        state = row.state
+        detail = int(self.detail[i, d])
+        code = OUTCOMES[self.outcome[i, d]]
+        if state in ("canceled", "no_next_visit") or code == "inactive":
+            return []
+        if state == "skipped":
+            return [
+                (
+                    "INFO",
+                    f"Skipping visit: No pipeline configured for instrument={self.params.instrument}, "
+                    f"survey={row.survey}, filter={row.filters}",
+                )
+            ]
+        if state == "unsupported":
+            return [
+                (
+                    "ERROR",
+                    f"Processing failed:\nRuntimeError: Unsupported survey: {row.survey}",
+                )
+            ]
+        messages = []
+        if code not in ("central_butler", "prep_butler"):
+            messages.append(("INFO", "Preprocessing pipeline successfully run."))
+        if state == "no_raw" or code == "timeout":
+            messages.append(
+                (
+                    "ERROR",
+                    "Processing failed:\nactivator.exception.TimeoutError: "
+                    f"Timed out waiting for image after receiving exposures {[]}.",
+                )
+            )
+            return messages
+        if code == "central_butler":
+            messages.append(
+                (
+                    "ERROR",
+                    "Processing failed:\n  File \"activator.py\", line 412, in create_local_worker\n"
+                    "    mwi = MiddlewareInterface(_get_central_butler(), ...)\n"
+                    + _BUTLER_ERRORS[detail % len(_BUTLER_ERRORS)],
+                )
+            )
+        elif code == "prep_butler":
+            messages.append(
+                (
+                    "ERROR",
+                    "Processing failed:\n  File \"middleware_interface.py\", line 530, in prep_butler\n"
+                    + _BUTLER_ERRORS[detail % len(_BUTLER_ERRORS)],
+                )
+            )
+        elif code == "sidecar":
+            messages.append(
+                (
+                    "ERROR",
+                    "Processing failed:\nRuntimeError: Unable to retrieve JSON sidecar "
+                    f"for {row.groupId} detector {d}",
+                )
+            )
+        elif code == "no_good_pipelines":
+            messages.append(
+                (
+                    "ERROR",
+                    "Processing failed:\nactivator.exception.NoGoodPipelinesError: "
+                    "No main pipeline graph could be built.",
+                )
+            )
+        elif code == "unspecified":
+            template = _UNSPECIFIED_ERRORS[detail % len(_UNSPECIFIED_ERRORS)]
+            messages.append(
+                (
+                    "ERROR",
+                    "Processing failed:\n"
+                    + template.format(
+                        group=row.groupId,
+                        detector=d,
+                        exposure=row.exposure,
+                        size=64 + detail % 4096,
+                    ),
+                )
+            )
+        elif code == "no_work":
+            if detail % 2:
+                messages.append(
+                    (
+                        "INFO",
+                        "Dropping task associateApdb because no quanta remain (1 had no work to do)",
+                    )
+                )
+            else:
+                messages.append(
+                    (
+                        "INFO",
+                        "Nothing to do for task 'associateApdb:lsst.ap.association.DiaPipelineTask'",
+                    )
+                )
+        extra = int(self.extra[i, d])
+        if extra & _BIT["cassandra"]:
+            messages.append(
+                (
+                    "ERROR",
+                    "Execution of task 'loadDiaCatalogs' failed; cassandra query error:\n"
+                    + _CASSANDRA_ERRORS[detail % len(_CASSANDRA_ERRORS)],
+                )
+            )
+        if extra & _BIT["raw_microservice"]:
+            messages.append(("ERROR", "Timed out connecting to raw microservice."))
+        if extra & _BIT["export"]:
+            messages.append(
+                (
+                    "ERROR",
+                    "Central repo export failed. Partial export may have occurred.\n"
+                    '  File "middleware_interface.py", line 1203, in export_outputs\n'
+                    + _EXPORT_ERRORS[detail % len(_EXPORT_ERRORS)],
+                )
+            )
+        if extra & _BIT["sigterm"]:
+            messages.append(
+                ("WARNING", "Signal SIGTERM detected, cleaning up and shutting down.")
+            )
+        return messages
+
+    def iter_loki_entries(self, container):
+        """Yield log entries in the ``logcli --output=jsonl`` format.
+
+        Parameters
+        ----------
+        container : `str`
+            The container name, one of ``containers``.
+
+        Yields
+        ------
+        entry : `dict`
+            With ``labels``, ``line`` and ``timestamp`` keys, in timestamp
+            order.
+        """
+        instrument = self.params.instrument
+        labels = {
+            "namespace": "vcluster--usdf-prompt-processing",
+            "container": container,
+        }
+        n, m = self.outcome.shape
+        times = pandas.to_datetime(self.visits["time"], utc=True)
+        pending = []
+        order = itertools.count()
+        for i in range(n):
+            row = self.visits.iloc[i]
+            if container == "next-visit-fan-out":
+                if row.state == "no_next_visit":
+                    continue
+                for d in range(m):
+                    if self.outcome[i, d] == _CODE["inactive"]:
+                        continue
+                    failed = _CODE["timeout"] <= self.outcome[i, d] < _CODE["inactive"]
+                    line = (
+                        f"nextVisit {{'instrument': '{instrument}', 'groupId': '{row.groupId}', "
+                        f"'detector': {d}}} status code {500 if failed else 200} for initial request"
+                    )
+                    yield {
+                        "labels": labels,
+                        "line": line,
+                        "timestamp": _isoformat(times.iat[i]),
+                    }
+                continue
+            if container != instrument.lower():
+                return
+            # The pods of a visit log for longer than the visits are apart,
+            # so hold its lines until no later visit can log before them.
+            earliest = _isoformat(times.iat[i] + timedelta(seconds=5))
+            while pending and pending[0][0] < earliest:
+                yield heapq.heappop(pending)[2]
+            exposures = [] if row.state == "no_raw" else [int(row.exposure)]
+            for d in range(m):
+                for k, (level, message) in enumerate(self._loki_messages(row, i, d)):
+                    stamp = _isoformat(
+                        times.iat[i] + timedelta(seconds=5 + 20 * k, microseconds=d)
+                    )
+                    inner = {
+                        "name": "lsst.activator.activator",
+                        "asctime": stamp,
+                        "level": level,
+                        "message": message,
+                        "instrument": instrument,
+                        "group": row.groupId,
+                        "detector": d,
+                        "exposures": exposures,
+                    }
+                    entry = {"labels": labels, "line": json.dumps(inner), "timestamp": stamp}
+                    heapq.heappush(pending, (stamp, next(order), entry))
+        while pending:
+            yield heapq.heappop(pending)[2]
+
+
+def _isoformat(t):
+    return t.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def generate_night(params):
+    """Generate a synthetic night.
+
+    Parameters
+    ----------
+    params : `NightParameters`
+
+    Returns
+    -------
+    night : `SyntheticNight`
+    """
+    rng = np.random.default_rng(params.seed)
+    n, m = params.n_visits, params.n_detectors
+    day_obs_int = int(params.day_obs.replace("-", ""))
+
+    start = datetime.fromisoformat(params.day_obs).replace(tzinfo=timezone.utc)
+    # Observing runs from ~23:00 to ~10:00 UTC on the next calendar day.
+    first = start + timedelta(hours=23)
+    spacing = timedelta(hours=11) / max(n, 1)
+    times = [first + spacing * i for i in range(n)]
+
+    names = list(params.surveys)
+    weights = np.array([params.surveys[s] for s in names], dtype=float)
+    surveys = np.array(names, dtype=object)[
+        rng.choice(len(names), size=n, p=weights / weights.sum())
+    ]
+    state = np.full(n, "ok", dtype=object)
+    u = rng.random(n)
+    cuts = np.cumsum(
+        [params.canceled_rate, params.no_raw_rate, params.no_next_visit_rate]
+    )
+    state[u < cuts[2]] = "no_next_visit"
+    state[u < cuts[1]] = "no_raw"
+    state[u < cuts[0]] = "canceled"
+    ok = state == "ok"
+    state[ok & np.isin(surveys, list(params.skipped_surveys))] = "skipped"
+    state[ok & np.isin(surveys, list(params.unsupported_surveys))] = "unsupported"
+
+    labels = list(params.pipeline_fractions)
+    fractions = np.array([params.pipeline_fractions[p] for p in labels], dtype=float)
+    pipeline = np.array(labels, dtype=object)[
+        rng.choice(len(labels), size=n, p=fractions / fractions.sum())
+    ]
+
+    probs = np.zeros(len(OUTCOMES))
+    for name, rate in params.failure_rates.items():
+        probs[_CODE[name]] = rate
+    probs[_CODE["success"]] = 1.0 - probs.sum()
+    if probs[_CODE["success"]] < 0:
+        raise ValueError("Failure rates add up to more than 1.")
+    outcome = rng.choice(len(OUTCOMES), size=(n, m), p=probs).astype(np.int8)
+
+    # Failures of tasks a pipeline does not run cannot happen.
+    pipeline_col = pipeline[:, None]
+    for failure, task in _FAILED_TASK.items():
+        for label, tasks in _PIPELINE_TASKS.items():
+            if task not in tasks:
+                outcome[
+                    (pipeline_col == label) & (outcome == _CODE[failure])
+                ] = _CODE["success"]
+    outcome[(pipeline_col != "ApPipe") & (outcome == _CODE["no_work"])] = _CODE[
+        "success"
+    ]
+    inactive = [d for d in params.inactive_detectors if d < m]
+    outcome[:, inactive] = _CODE["inactive"]
+
+    extra = np.zeros((n, m), dtype=np.uint8)
+    for name, rate in params.extra_rates.items():
+        extra |= np.where(
+            rng.random((n, m), dtype=np.float32) < rate, _BIT[name], 0
+        ).astype(np.uint8)
+    detail = rng.integers(0, 1 << 15, size=(n, m), dtype=np.int16)
+
+    visits = pandas.DataFrame(
+        {
+            "groupId": [t.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] for t in times],
+            "exposure": day_obs_int * _EXPOSURES_PER_DAY + np.arange(1, n + 1),
+            "survey": surveys,
+            "filters": rng.choice(_FILTERS, size=n),
+            "state": state,
+            "pipeline": pipeline,
+            "time": [_isoformat(t) for t in times],
+        }
+    )
+    _log.info(
+        f"Generated {n} {params.instrument} visits x {m} detectors for {params.day_obs}"
+    )
+    return SyntheticNight(params, visits, outcome, extra, detail)
+
+
+def write_night(night, directory):
+    """Write a night to disk.
+
+    Only the arrays needed to regenerate the night are written, and one
+    Loki JSONL file per container for `stand_ins.LocalLoki` to read, in
+    timestamp order; `load_night` derives everything else from the arrays.
+
+    Parameters
+    ----------
+    night : `SyntheticNight`
+    directory : `str`
+    """
+    os.makedirs(os.path.join(directory, "loki"), exist_ok=True)
+    with open(os.path.join(directory, "params.json"), "w") as f:
+        json.dump(dataclasses.asdict(night.params), f, indent=2)
+    night.visits.to_csv(os.path.join(directory, "visits.csv"), index=False)
+    np.savez_compressed(
+        os.path.join(directory, "outcomes.npz"),
+        outcome=night.outcome,
+        extra=night.extra,
+        detail=night.detail,
+    )
+
+    for container in night.containers:
+        with open(os.path.join(directory, "loki", f"{container}.jsonl"), "w") as f:
+            for entry in night.iter_loki_entries(container):
+                f.write(json.dumps(entry) + "\n")
+    _log.info(f"Wrote {night.params.day_obs} to {directory}")
+
+
+def load_night(directory):
+    """Load a night written by `write_night`.
+
+    Parameters
+    ----------
+    directory : `str`
+
+    Returns
+    -------
+    night : `SyntheticNight`
+    """
+    with open(os.path.join(directory, "params.json")) as f:
+        params = NightParameters(**json.load(f))
+    visits = pandas.read_csv(
+        os.path.join(directory, "visits.csv"),
+        dtype={"groupId": str, "survey": str, "filters": str, "state": str},
+        keep_default_na=False,
+    )
+    arrays = np.load(os.path.join(directory, "outcomes.npz"))
+    return SyntheticNight(
+        params, visits, arrays["outcome"], arrays["extra"], arrays["detail"]
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--day-obs", default="2025-06-01")
+    parser.add_argument("--instrument", default="LSSTCam")
+    parser.add_argument("--visits", type=int, default=1000)
+    parser.add_argument("--detectors", type=int, default=189)
+    parser.add_argument(
+        "--scale", type=float, nargs="+", default=[1], help="Multiples of --visits."
+    )
+    parser.add_argument("--failure-scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", required=True)
+    parser.add_argument(
+        "--run", action="store_true", help="Time the report against stand-ins."
+    )
+    args = parser.parse_args()
+
+    base = NightParameters(
+        day_obs=args.day_obs,
+        instrument=args.instrument,
+        n_visits=args.visits,
+        n_detectors=args.detectors,
+        seed=args.seed,
+    )
+    base.failure_rates = {
+        k: v * args.failure_scale for k, v in base.failure_rates.items()
+    }
+    for scale in args.scale:
+        directory = os.path.join(args.output, f"scale-{scale:g}")
+        night = generate_night(base.scaled(scale))
+        write_night(night, directory)
+        if args.run:
+            from prompt_processing_summary import make_summary_message
+            from stand_ins import install_stand_ins
+
+            with install_stand_ins(night, directory):
+                t0 = time.perf_counter()
+                summary = make_summary_message(args.day_obs, args.instrument)
+                elapsed = time.perf_counter() - t0
+            print(summary)
+            _log.info(f"scale {scale:g}: report took {elapsed:.1f} s")
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "scripts"))
+
+
+@pytest.fixture(scope="session")
+def night_dir(tmp_path_factory):
+    """A small synthetic night written to disk, and the night itself."""
+    import synthetic_night
+
+    night = synthetic_night.generate_night(
+        synthetic_night.NightParameters(
+            day_obs="2025-06-01", instrument="LSSTCam", n_visits=40, n_detectors=12
+        )
+    )
+    directory = str(tmp_path_factory.mktemp("night"))
+    synthetic_night.write_night(night, directory)
+    return night, directory
@@ -0,0 +1,62 @@
+import pytest
+
+pytest.importorskip("lsst.daf.butler")
+
+from prompt_processing_summary import (  # noqa: E402
+    _count_refs,
+    count_by_exposure,
+    count_datasets,
+)
+from stand_ins import LocalButler  # noqa: E402
+
+
+class _NoQueryButler(LocalButler):
+    """A butler whose query system is not implemented."""
+
+    def query(self):
+        raise NotImplementedError()
+
+
+@pytest.mark.parametrize(
+    "dataset_type, collection",
+    [
+        ("raw", "LSSTCam/raw/all"),
+        ("isr_log", "LSSTCam/prompt/output-2025-06-01/ApPipe*"),
+    ],
+)
+def test_count_paths_agree(night_dir, dataset_type, collection):
+    night, _ = night_dir
+    butler = LocalButler(night)
+    kwargs = {
+        "where": "exposure.science_program IN (survey) AND detector < 6",
+        "bind": {"survey": "BLOCK-365"},
+    }
+    expected = _count_refs(butler, dataset_type, collection, False, **kwargs)
+    assert 0 < expected < _count_refs(butler, dataset_type, collection, False)
+    assert count_datasets(butler, dataset_type, collection, **kwargs) == expected
+    assert (
+        count_datasets(_NoQueryButler(night), dataset_type, collection, **kwargs)
+        == expected
+    )
+
+
+def test_count_missing_collection(night_dir):
+    night, _ = night_dir
+    assert count_datasets(LocalButler(night), "raw", "LSSTCam/no/such/run") == 0
+
+
+def test_count_by_exposure_paths_agree(night_dir):
+    night, _ = night_dir
+    kwargs = {
+        "where": "exposure.science_program IN (survey) AND detector < 6",
+        "bind": {"survey": "BLOCK-365"},
+    }
+    counts = count_by_exposure(LocalButler(night), "raw", "LSSTCam/raw/all", **kwargs)
+    assert counts
+    assert sum(counts.values()) == count_datasets(
+        LocalButler(night), "raw", "LSSTCam/raw/all", **kwargs
+    )
+    assert (
+        count_by_exposure(_NoQueryButler(night), "raw", "LSSTCam/raw/all", **kwargs)
+        == counts
+    )
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from detector_health import COLUMNS, DetectorHealth
+
+
+def _counts(expected, preprocessed):
+    return {"expected": expected, "preprocessed": preprocessed}
+
+
+def test_append_and_window(tmp_path):
+    health = DetectorHealth(str(tmp_path), "LSSTCam", detectors=4)
+    health.append("2025-06-01", _counts([10] * 4, [10, 9, 0, 10]))
+    health.append("2025-06-02", _counts([20] * 4, [20, 20, 0, 18]))
+    health.append("2025-06-03", _counts([5] * 4, [5, 5, 0, 5]))
+
+    nights, counts = health.window(2)
+    assert nights.tolist() == [20250602, 20250603]
+    assert counts.shape == (2, 4, len(COLUMNS))
+    assert counts[0, :, COLUMNS.index("preprocessed")].tolist() == [20, 20, 0, 18]
+    assert not counts[:, :, COLUMNS.index("sfm_outputs")].any()
+
+    nights, _ = health.window(30, before="2025-06-03")
+    assert nights.tolist() == [20250601, 20250602]
+    np.testing.assert_allclose(
+        health.rates("preprocessed", before="2025-06-03"), [1.0, 29 / 30, 0.0, 28 / 30]
+    )
+    assert health.inactive_detectors() == [2]
+
+
+def test_append_replaces_a_recorded_night(tmp_path):
+    health = DetectorHealth(str(tmp_path), "LSSTCam", detectors=2)
+    health.append("2025-06-01", _counts([1, 1], [0, 0]))
+    health.append("2025-06-02", _counts([2, 2], [2, 2]))
+    health.append("2025-06-01", _counts([3, 3], [3, 1]))
+
+    # A new instance reads the history from disk.
+    health = DetectorHealth(str(tmp_path), "LSSTCam")
+    nights, counts = health.window()
+    assert nights.tolist() == [20250601, 20250602]
+    assert counts[0, :, COLUMNS.index("preprocessed")].tolist() == [3, 1]
+
+
+def test_interrupted_append_is_dropped(tmp_path):
+    health = DetectorHealth(str(tmp_path), "LSSTCam", detectors=2)
+    health.append("2025-06-01", _counts([1, 1], [1, 1]))
+    # As if the job died between writing the counts and the night.
+    with open(health._counts_path, "ab") as f:
+        np.ones((2, len(COLUMNS)), dtype=np.int32).tofile(f)
+
+    health = DetectorHealth(str(tmp_path), "LSSTCam")
+    health.append("2025-06-02", _counts([2, 2], [2, 0]))
+    nights, counts = health.window()
+    assert nights.tolist() == [20250601, 20250602]
+    assert counts[1, :, COLUMNS.index("preprocessed")].tolist() == [2, 0]
+
+
+def test_no_history(tmp_path):
+    health = DetectorHealth(str(tmp_path), "LSSTCam")
+    assert health.detectors == 189
+    nights, counts = health.window()
+    assert len(nights) == 0 and counts.shape == (0, 189, len(COLUMNS))
+    assert health.inactive_detectors() is None
+    with pytest.raises(ValueError):
+        health.append("2025-06-01", {"unknown": [0] * 189})
@@ -0,0 +1,32 @@
+import asyncio
+
+from limiter import AdaptiveLimiter
+
+
+def test_cancelled_wait_returns_slot():
+    limiter = AdaptiveLimiter("test", initial=1, min_limit=1, max_limit=1)
+
+    async def hold(started, done):
+        async with limiter.async_slot():
+            started.set()
+            await done.wait()
+
+    async def main():
+        started, done = asyncio.Event(), asyncio.Event()
+        holder = asyncio.create_task(hold(started, done))
+        await started.wait()
+        waiter = asyncio.create_task(hold(asyncio.Event(), asyncio.Event()))
+        await asyncio.sleep(0.1)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        done.set()
+        await holder
+        # The cancelled waiter may only get its slot now; let it give it back.
+        for _ in range(50):
+            if limiter.stats()["in_flight"] == 0:
+                break
+            await asyncio.sleep(0.02)
+
+    asyncio.run(main())
+    assert limiter.stats()["in_flight"] == 0
+    assert limiter.acquire(blocking=False)
@@ -0,0 +1,124 @@
+import itertools
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("lsst.daf.butler")
+pytest.importorskip("lsst_efd_client")
+
+import live_tail  # noqa: E402
+import prompt_processing_summary  # noqa: E402
+import queries  # noqa: E402
+from night_summary import render_summary_lines  # noqa: E402
+from queries import get_start_end  # noqa: E402
+from stand_ins import LocalEfdClient, LocalLoki, install_stand_ins  # noqa: E402
+
+
+def _follow(night, directory, checkpoint_dir, **kwargs):
+    day_obs = night.params.day_obs
+    with install_stand_ins(night, directory):
+        live_tail.run_live_tail(
+            day_obs,
+            night.params.instrument,
+            checkpoint_dir,
+            efd_client_factory=lambda: LocalEfdClient(night),
+            efd_interval=0.05,
+            **kwargs,
+        )
+        counters = live_tail.load_finished_counters(
+            checkpoint_dir, night.params.instrument, day_obs
+        )
+        batch = prompt_processing_summary.compute_night_summary(
+            day_obs, night.params.instrument
+        )
+        live = prompt_processing_summary.compute_night_summary(
+            day_obs, night.params.instrument, counters=counters
+        )
+    return render_summary_lines(batch), render_summary_lines(live)
+
+
+def test_live_counters_match_batch_report(night_dir, tmp_path):
+    night, directory = night_dir
+    batch, live = _follow(night, directory, str(tmp_path))
+    assert live == batch
+
+
+def _timestamp(raw):
+    return datetime.fromisoformat(json.loads(raw)["timestamp"].rstrip("Z")).replace(
+        tzinfo=timezone.utc
+    )
+
+
+def test_early_end_of_tail_is_reopened(night_dir, tmp_path, monkeypatch):
+    night, directory = night_dir
+    _, end = get_start_end(night.params.day_obs)
+    # Start following in the middle of the night; the tailed lines arrive
+    # live, and the night is over once they run out.
+    clock = [min(_timestamp(raw) for raw in _lines(directory)) + timedelta(minutes=30)]
+    until = end.to_datetime(timezone=timezone.utc) + live_tail.GRACE
+    loki = LocalLoki(directory, clock=lambda: clock[0])
+    starts = []
+
+    def tail(container_name, search_string, start, until=None):
+        starts.append(start)
+        lines = loki.tail(container_name, search_string, start, until)
+        if len(starts) == 1:
+            # As if logcli exited partway through the night.
+            lines = itertools.islice(lines, 200)
+        for raw in lines:
+            clock[0] = max(clock[0], _timestamp(raw))
+            yield raw
+        if len(starts) > 1:
+            clock[0] = until
+
+    monkeypatch.setattr(live_tail, "_now", lambda: clock[0])
+    monkeypatch.setattr(live_tail, "REOPEN_DELAY", 0)
+    batch, live = _follow(night, directory, str(tmp_path), tail=tail)
+    assert len(starts) == 2
+    assert live == batch
+
+
+def test_resume_catches_up_past_the_tail_backfill(night_dir, tmp_path):
+    night, directory = night_dir
+    assert len(_lines(directory)) > 200 + 60
+
+    def crash(container_name, search_string, start, end):
+        yield from itertools.islice(
+            queries.iter_loki_window(container_name, search_string, start, end), 200
+        )
+        raise RuntimeError("Loki went away")
+
+    with install_stand_ins(night, directory), pytest.raises(RuntimeError):
+        live_tail.run_live_tail(
+            night.params.day_obs,
+            night.params.instrument,
+            str(tmp_path),
+            efd_client_factory=lambda: LocalEfdClient(night),
+            backfill=crash,
+        )
+    # More lines remain than a Loki tail starts with.
+    batch, live = _follow(night, directory, str(tmp_path))
+    assert live == batch
+
+
+def test_dropped_quanta_are_counted_by_exposure_and_detector():
+    counters = live_tail.RollingCounters("2025-06-01", "LSSTCam")
+    message = "Dropping task associateApdb because no quanta remain (1 had no work to do)"
+    lines = [
+        json.dumps({"message": message, "detector": 3, "exposures": [7]}),
+        json.dumps({"message": message, "detector": 3, "exposures": [7]}),
+        json.dumps({"message": message, "detector": 4, "exposures": [7]}),
+        f"Not JSON: {message}",
+    ]
+    for second, line in enumerate(lines):
+        timestamp = f"2025-06-02T01:00:{second:02}.000000Z"
+        counters.add_loki_line(json.dumps({"timestamp": timestamp, "line": line}))
+    counters = live_tail.RollingCounters.from_json(counters.to_json())
+    assert counters.get_no_work_count("associateApdb") == (0, 4)
+    assert counters.get_no_work_count("associateApdb", {(7, 3)}) == (0, 2)
+
+
+def _lines(directory):
+    search_string = live_tail.RollingCounters.search_string()
+    return LocalLoki(directory).query(None, "lsstcam", search_string).splitlines()
@@ -0,0 +1,45 @@
+import pytest
+
+pytest.importorskip("lsst_efd_client")
+
+from log_templates import WILDCARD, TemplateMiner  # noqa: E402
+
+
+def test_messages_of_one_shape_share_a_template():
+    miner = TemplateMiner()
+    for n in range(5):
+        miner.add(f"Timed out waiting for quantum {n} after {n}0 s", example=f"g{n % 2}")
+    for key, group in (("visit", "g3"), ("band", "g4")):
+        miner.add(
+            f"Traceback (most recent call last):\n  ...\nKeyError: no {key} in data ID",
+            example=group,
+        )
+
+    templates = miner.top(10)
+    assert [(t.template, t.count) for t in templates] == [
+        (f"Timed out waiting for quantum {WILDCARD} after {WILDCARD} s", 5),
+        (f"KeyError: no {WILDCARD} in data ID", 2),
+    ]
+    assert templates[0].examples == ["g0", "g1"]
+    assert miner.top(1) == templates[:1]
+    assert miner.lines == 7
+
+
+def test_memory_is_bounded_by_max_clusters():
+    miner = TemplateMiner(max_clusters=4, max_examples=2)
+    for n in range(100):
+        # Distinct leading tokens, so that every message is a new template.
+        miner.add(f"{chr(65 + n % 26)}{chr(65 + n // 26)}Error: failed", example=str(n))
+    miner.add("AAError: failed", example="again")
+
+    assert len(miner._clusters) == 4
+    assert sum(t.count for t in miner.top(10)) + miner.evicted == miner.lines == 101
+    assert all(len(t.examples) <= 2 for t in miner.top(10))
+
+
+def test_empty_messages_are_ignored():
+    miner = TemplateMiner()
+    miner.add("")
+    miner.add("\n  \n")
+    assert miner.lines == 0
+    assert miner.top(3) == []
@@ -0,0 +1,93 @@
+import json
+import random
+
+import pytest
+
+from logql import parse_pipeline
+from loki_archive import LokiArchive, archive_path
+
+_MESSAGES = [
+    "Preprocessing pipeline successfully run.",
+    "Processing failed: Timed out after 600 s",
+    "Processing failed: Error from server (Timeout): etcdserver: request timed out",
+    "Processing failed: cassandra.cluster.NoHostAvailable: ('Unable to connect', {})",
+    'Nothing to do for task \'associateApdb:{"instrument": "LSSTCam"}\'',
+    "Dropping task associateApdb because no quanta remain (1 had no work to do)",
+    "Loaded 12345 refcat shards in 3.2 s",
+]
+
+
+def _records(n=1000, seed=2):
+    rng = random.Random(seed)
+    for i in range(n):
+        if i % 97 == 0:
+            line = f"plain text line {i} without JSON"
+        else:
+            line = json.dumps(
+                {
+                    "name": "lsst.activator",
+                    "level": rng.choice(["INFO", "WARNING", "ERROR"]),
+                    "message": rng.choice(_MESSAGES),
+                    "instrument": rng.choice(["LSSTCam", "LSSTComCam"]),
+                    "group": f"2025-06-02T0{i % 5}:00:00.000",
+                    "detector": rng.randrange(8) if i % 13 else None,
+                }
+            )
+        yield json.dumps({"line": line, "timestamp": f"2025-06-02T01:00:00.{i:06}Z"})
+
+
+@pytest.fixture(scope="module")
+def archive(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp("archive"))
+    directory = archive_path(root, "lsstcam", "2025-06-01")
+    with LokiArchive.build(directory, _records(), block_size=64) as archive:
+        yield archive
+
+
+@pytest.mark.parametrize(
+    "search_string",
+    [
+        "",
+        '|= "Processing failed"',
+        '|= "ailed: Tim"',
+        '|= "out after 9"',
+        '|= "NoHostAvailable" |= "Unable"',
+        '|= "Processing failed" != "Timeout"',
+        '|~ "timed? out"',
+        '|= "associateApdb" | json | instrument="LSSTCam"',
+        '| json | level="ERROR" | detector="3"',
+        '| json | detector=""',
+        '| json | group="2025-06-02T03:00:00.000" | level!="INFO"',
+        '|= "plain text"',
+        '|= "no such words here"',
+    ],
+)
+def test_index_lookups_match_a_linear_scan(archive, search_string):
+    pipeline = parse_pipeline(search_string)
+    expected = [raw for raw in _records() if pipeline.match(json.loads(raw)["line"])]
+    assert list(archive.iter_query(search_string)) == expected
+
+
+def test_literals_and_fields_narrow_the_candidates(archive):
+    failed = archive.candidates(parse_pipeline('|= "Processing failed"'))
+    assert 0 < len(failed) < archive.n_lines
+    errors = archive.candidates(
+        parse_pipeline('|= "Processing failed" | json | level="ERROR"')
+    )
+    assert 0 < len(errors) < len(failed)
+    assert archive.candidates(parse_pipeline('|~ "failed"')) is None
+
+
+def test_query_is_limited_like_logcli(archive):
+    results = archive.query('|= "Processing failed"', limit=10)
+    assert len(results.splitlines()) == 10
+    assert results.endswith("\n")
+    assert archive.query('|= "no such words here"') == ""
+
+
+def test_records_round_trip(archive):
+    assert archive.n_lines == 1000
+    assert list(archive.records()) == list(_records())
+    assert list(archive.records([0, 63, 64, 999])) == [
+        r for i, r in enumerate(_records()) if i in (0, 63, 64, 999)
+    ]
@@ -0,0 +1,89 @@
+import json
+import os
+import shutil
+
+import pandas
+import pytest
+
+from loki_spill import SPILL_COLUMNS, LokiPartitions
+
+
+def _record(**fields):
+    timestamp = "2025-06-02T01:00:00Z"
+    return json.dumps({"line": json.dumps(fields), "timestamp": timestamp})
+
+
+def test_partitions_round_trip(tmp_path):
+    records = [
+        _record(
+            instrument="LSSTCam",
+            group=f"g{i % 3}",
+            detector=i,
+            exposures=[100 + i],
+            message=f"Processing failed: déjà vu {i}",
+        )
+        for i in range(7)
+    ]
+    records += [
+        _record(instrument="LSSTCam", group="g0", message="no detector"),
+        _record(detector="not a number", exposures=[]),
+        "not JSON",
+        json.dumps({"line": "[1, 2]"}),
+    ]
+    partitions = LokiPartitions.write(str(tmp_path / "spill"), records, chunk_lines=3)
+    assert len(partitions) == 9
+    assert partitions.partitions == 3
+
+    frames = list(LokiPartitions(partitions.directory).frames())
+    assert [len(f) for f in frames] == [3, 3, 3]
+    df = pandas.concat(frames, ignore_index=True).astype(
+        {"group": str, "instrument": str}
+    )
+    assert list(df.columns) == list(SPILL_COLUMNS)
+    assert df["instrument"].tolist() == ["LSSTCam"] * 8 + [""]
+    assert df["group"].tolist() == ["g0", "g1", "g2"] * 2 + ["g0", "g0", ""]
+    assert df["detector"].tolist() == list(range(7)) + [-1, -1]
+    assert df["exposure"].tolist() == [100 + i for i in range(7)] + [-1, -1]
+    assert df["message"][0] == "Processing failed: déjà vu 0"
+    assert df["message"].tolist()[7:] == ["no detector", ""]
+
+    (only,) = {tuple(f.columns) for f in partitions.frames(["group", "detector"])}
+    assert only == ("group", "detector")
+    partitions.remove()
+    assert not os.path.exists(partitions.directory)
+
+
+def test_spilled_report_matches_the_in_memory_one(night_dir, tmp_path, monkeypatch):
+    pytest.importorskip("lsst.daf.butler")
+    import prompt_processing_summary
+    from logql import parse_pipeline
+    from night_summary import LOKI_FAILURES, PREPROCESSING_SUCCESS
+    from stand_ins import install_stand_ins
+
+    night, directory = night_dir
+    # Add survey lines without a detector, which the spill stores as -1.
+    directory = shutil.copytree(directory, tmp_path / "night")
+    path = os.path.join(directory, "loki", "lsstcam.jsonl")
+    with open(path) as f:
+        records = [json.loads(raw) for raw in f]
+    extra = []
+    for category in (PREPROCESSING_SUCCESS, *LOKI_FAILURES.values()):
+        pipeline = parse_pipeline(category.search_string)
+        entry = next((e for e in records if pipeline.match(e["line"])), None)
+        if entry is None:
+            continue
+        fields = json.loads(entry["line"])
+        del fields["detector"]
+        extra.append(json.dumps({**entry, "line": json.dumps(fields)}))
+    with open(path, "a") as f:
+        f.write("\n".join(extra) + "\n")
+
+    day_obs, instrument = night.params.day_obs, night.params.instrument
+    with install_stand_ins(night, directory):
+        in_memory = prompt_processing_summary.compute_night_summary(day_obs, instrument)
+        monkeypatch.setenv("LOKI_SPILL_DIR", str(tmp_path / "spill"))
+        spilled = prompt_processing_summary.compute_night_summary(day_obs, instrument)
+    assert spilled == in_memory
+    assert os.listdir(tmp_path / "spill") == []
+    preprocessed = in_memory.detector_counts["preprocessed"]
+    assert sum(preprocessed) == in_memory.successful_preprocessing > 0
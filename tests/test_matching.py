@@ -0,0 +1,30 @@
+import re
+
+from matching import SubstringMatcher, get_matcher
+
+
+def test_search_finds_every_pattern_in_a_message():
+    matcher = SubstringMatcher(["timed out", "Error from server", "out"])
+    assert matcher.search("Read timed out. Error from server") == {0, 1, 2}
+    assert matcher.search("Nothing to see") == set()
+
+
+def test_count_matches_a_regex_scan():
+    patterns = ("NoHostAvailable", "Error from server", "UniqueViolation", "a")
+    messages = [
+        "cassandra.cluster.NoHostAvailable: ('Unable to connect')",
+        "Error from server (Timeout)",
+        "psycopg2.errors.UniqueViolation: duplicate key",
+        "cassandra.cluster.NoHostAvailable: ('Unable to connect')",
+        None,
+        "",
+    ]
+    expected = [
+        sum(1 for m in messages if isinstance(m, str) and re.search(re.escape(p), m))
+        for p in patterns
+    ]
+    assert SubstringMatcher(patterns).count(messages) == expected
+
+
+def test_get_matcher_is_cached():
+    assert get_matcher(("a", "b")) is get_matcher(("a", "b"))
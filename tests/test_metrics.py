@@ -0,0 +1,103 @@
+import re
+
+from metrics import record_fetched, render_metrics, write_metrics
+from night_summary import LokiFailure, NightSummary, PipelineCounts
+
+_SAMPLE = re.compile(r"^(?P<name>\w+)(?:\{(?P<labels>.*)\})? (?P<value>\S+)$")
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def _key(name, **labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _parse(text):
+    """Parse the text exposition format into families and samples."""
+    families = {}
+    samples = {}
+    for line in text.splitlines():
+        if line.startswith("# HELP "):
+            name, description = line[len("# HELP "):].split(" ", 1)
+            families[name] = [description, None]
+        elif line.startswith("# TYPE "):
+            name, kind = line[len("# TYPE "):].split(" ")
+            families[name][1] = kind
+        else:
+            m = _SAMPLE.match(line)
+            assert m, line
+            labels = {
+                k: re.sub(r"\\(.)", lambda e: {"n": "\n"}.get(e[1], e[1]), v)
+                for k, v in _LABEL.findall(m["labels"] or "")
+            }
+            key = _key(m["name"], **labels)
+            assert key not in samples, key
+            samples[key] = float(m["value"])
+    return families, samples
+
+
+def _summary():
+    return NightSummary(
+        day_obs="2025-06-01",
+        instrument="LSSTCam",
+        survey="BLOCK-365",
+        on_sky_exposures=12,
+        next_visits=10,
+        total_next_visits=11,
+        raws=10,
+        raw_images=1890,
+        groups_without_events=["2025-06-02T01:00:00.000"],
+        successful_preprocessing=1700,
+        expected_processing=1710,
+        missed=10,
+        failures={"timeout": LokiFailure(count=4, total=6)},
+        pipeline=PipelineCounts(
+            runs=1700,
+            recurrent_errors={"calibrateImage": {'Failed "fit"\nretrying': 3}},
+        ),
+    )
+
+
+def test_rendered_metrics_parse_back():
+    record_fetched("loki_lines", 5)
+    families, samples = _parse(render_metrics(_summary(), runtime=12.5))
+
+    night = dict(instrument="LSSTCam", survey="BLOCK-365")
+    assert samples[_key("prompt_processing_report_day_obs", **night)] == 20250601
+    assert samples[_key("prompt_processing_raws", **night)] == 10
+    assert samples[_key("prompt_processing_raws_without_next_visit", **night)] == 1
+    assert samples[_key("prompt_processing_missed_processing", **night)] == 10
+    assert samples[_key("prompt_processing_unspecified_failures", **night)] == 10 - 4
+    assert samples[_key("prompt_processing_failures", category="timeout", **night)] == 4
+    recurrent = _key(
+        "prompt_processing_recurrent_errors",
+        task="calibrateImage",
+        message='Failed "fit"\nretrying',
+        **night,
+    )
+    assert samples[recurrent] == 3
+    assert samples[_key("nightly_report_runtime_seconds", instrument="LSSTCam")] == 12.5
+    fetched = _key("nightly_report_fetched_total", instrument="LSSTCam", kind="loki_lines")
+    assert samples[fetched] >= 5
+
+    assert families["prompt_processing_raws"] == ["Raw exposures of the survey.", "gauge"]
+    assert families["nightly_report_fetched_total"][1] == "counter"
+    assert {name for name, _ in samples} == families.keys()
+
+
+def test_metrics_without_detectors_skip_detector_counts():
+    summary = _summary()
+    summary.expected_processing = None
+    _, samples = _parse(render_metrics(summary, runtime=1.0))
+    names = {name for name, _ in samples}
+    assert "prompt_processing_raws" in names
+    assert "prompt_processing_missed_processing" not in names
+    assert "prompt_processing_unspecified_failures" not in names
+
+
+def test_write_metrics_replaces_the_file(tmp_path):
+    path = str(tmp_path / "nightly.prom")
+    write_metrics("a 1.0\n", path)
+    write_metrics("b 2.0\n", path)
+    with open(path) as f:
+        assert f.read() == "b 2.0\n"
+    assert [p.name for p in tmp_path.iterdir()] == ["nightly.prom"]
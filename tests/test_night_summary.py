@@ -0,0 +1,76 @@
+from night_summary import (
+    REPORT_SECTIONS,
+    ErrorTemplate,
+    LokiFailure,
+    NightSummary,
+    PipelineCounts,
+    render_section,
+    render_slack,
+    render_summary_lines,
+    summary_path,
+)
+
+
+def _summary():
+    return NightSummary(
+        day_obs="2025-06-01",
+        instrument="LSSTCam",
+        survey="BLOCK-365",
+        on_sky_exposures=12,
+        next_visits=10,
+        total_next_visits=11,
+        raws=10,
+        raw_images=1890,
+        groups_without_events=["2025-06-02T01:00:00.000"],
+        output_collection="LSSTCam/prompt/output-2025-06-01",
+        detectors=189,
+        off_detector=18,
+        successful_preprocessing=1700,
+        expected_processing=1710,
+        missed=10,
+        failures={
+            "timeout": LokiFailure(count=4, total=6, by_group={"g1": 4}),
+            "prep_butler": LokiFailure(
+                count=2, total=2, breakdown={"Error from server": 2}
+            ),
+        },
+        pipeline=PipelineCounts(
+            runs=1700,
+            ap_pipe=1600,
+            recurrent_errors={"calibrateImage": {"Failed to fit": 3}},
+        ),
+        unrecognized_errors=[
+            ErrorTemplate("Disk <*> full", count=2, examples=["2025-06-02T01:00:00.000/3"])
+        ],
+    )
+
+
+def test_json_round_trip():
+    summary = _summary()
+    restored = NightSummary.from_json(summary.to_json())
+    assert restored == summary
+    assert render_slack(restored) == render_slack(summary)
+
+
+def test_unspecified_subtracts_known_failures():
+    assert _summary().unspecified == 10 - 4 - 2
+
+
+def test_sections_cover_the_report():
+    summary = _summary()
+    lines = [line for s in REPORT_SECTIONS for line in render_section(summary, s)]
+    assert sorted(lines) == sorted(render_summary_lines(summary))
+
+
+def test_early_stop_renders_headline_only():
+    summary = NightSummary(
+        day_obs="2025-06-01", instrument="LSSTCam", survey="BLOCK-365", on_sky_exposures=3
+    )
+    assert render_summary_lines(summary) == render_section(summary, "headline")
+    assert all(not render_section(summary, s) for s in REPORT_SECTIONS[1:])
+
+
+def test_summary_path():
+    assert summary_path("s3://bucket/summaries/", "LSSTCam", "2025-06-01") == (
+        "s3://bucket/summaries/LSSTCam/2025-06-01.json"
+    )
@@ -0,0 +1,58 @@
+import pytest
+
+pytest.importorskip("lsst.daf.butler")
+pytest.importorskip("lsst_efd_client")
+
+import prompt_processing_summary  # noqa: E402
+from checkpoint import SectionCheckpoint  # noqa: E402
+from night_summary import REPORT_SECTIONS, render_slack  # noqa: E402
+from slack_report import ProgressiveReport  # noqa: E402
+from stand_ins import LocalSlack, install_stand_ins  # noqa: E402
+
+
+class _Interrupted(Exception):
+    pass
+
+
+@pytest.mark.parametrize("threaded", [False, True])
+def test_headline_first_and_no_duplicates_on_resume(night_dir, tmp_path, threaded):
+    night, directory = night_dir
+    day_obs, instrument = night.params.day_obs, night.params.instrument
+    with install_stand_ins(night, directory), LocalSlack() as slack:
+        if threaded:
+            kwargs = dict(token="xoxb-test", channel="C1", api_url=slack.api_url)
+        else:
+            kwargs = dict(webhook=slack.webhook)
+
+        def run(progress):
+            checkpoint = SectionCheckpoint(str(tmp_path), instrument, day_obs)
+            report = ProgressiveReport(checkpoint=checkpoint, **kwargs)
+            return report, prompt_processing_summary.compute_night_summary(
+                day_obs, instrument, checkpoint=checkpoint, progress=progress(report)
+            )
+
+        def stop_after_headline(report):
+            def progress(section, summary):
+                report(section, summary)
+                if section == "headline":
+                    raise _Interrupted()
+
+            return progress
+
+        with pytest.raises(_Interrupted):
+            run(stop_after_headline)
+        assert len(slack.messages) == 1
+        headline = slack.messages[0]
+
+        report, summary = run(lambda report: report)
+        assert report.finish(summary)
+
+    assert headline["text"] == render_slack(summary, "headline")
+    texts = [m["text"] for m in slack.messages]
+    sections = [s for s in REPORT_SECTIONS if render_slack(summary, s)]
+    assert len(sections) > 1
+    assert len(texts) == len(sections)
+    for section, text in zip(sections, texts):
+        assert text.endswith(render_slack(summary, section))
+    if threaded:
+        assert all(m["thread_ts"] == headline["ts"] for m in slack.messages[1:])
@@ -0,0 +1,103 @@
+import asyncio
+import json
+import os
+from collections import Counter
+from unittest import mock
+
+import pytest
+
+pytest.importorskip("lsst.daf.butler")
+pytest.importorskip("lsst_efd_client")
+
+import queries  # noqa: E402
+import synthetic_night  # noqa: E402
+from queries import SURVEY_OUTCOMES  # noqa: E402
+from stand_ins import LocalLoki, install_stand_ins  # noqa: E402
+from survey_summary import (  # noqa: E402
+    compute_survey_summary,
+    fetch_sources,
+    render_survey_lines,
+)
+
+
+@pytest.fixture(scope="module")
+def survey_night(tmp_path_factory):
+    """A small night split between a supported, a skipped and an
+    unsupported survey.
+    """
+    night = synthetic_night.generate_night(
+        synthetic_night.NightParameters(
+            n_visits=30,
+            n_detectors=6,
+            surveys={"BLOCK-365": 0.6, "BLOCK-T99": 0.25, "BLOCK-T42": 0.15},
+            skipped_surveys=["BLOCK-T99"],
+            unsupported_surveys=["BLOCK-T42"],
+        )
+    )
+    directory = str(tmp_path_factory.mktemp("survey-night"))
+    synthetic_night.write_night(night, directory)
+    return night, directory
+
+
+def _expected_outcomes(night, directory):
+    """Count the outcomes by reading every line of the container log."""
+    surveys = dict(zip(night.visits["groupId"], night.visits["survey"]))
+    best = {}
+    with open(os.path.join(directory, "loki", "lsstcam.jsonl")) as f:
+        for raw in f:
+            fields = json.loads(json.loads(raw)["line"])
+            for rank, needle in enumerate(SURVEY_OUTCOMES.values()):
+                if needle in fields["message"]:
+                    key = (fields["group"], fields["detector"])
+                    best[key] = min(best.get(key, rank), rank)
+                    break
+    names = list(SURVEY_OUTCOMES)
+    return Counter((surveys[group], names[rank]) for (group, _), rank in best.items())
+
+
+def test_outcomes_by_survey(survey_night):
+    night, directory = survey_night
+    with install_stand_ins(night, directory):
+        with (
+            mock.patch.object(queries, "query_loki", wraps=queries.query_loki) as loki,
+            mock.patch.object(queries, "stream_loki", wraps=queries.stream_loki) as stream,
+        ):
+            events, canceled, exposures, outcomes = asyncio.run(
+                fetch_sources(night.params.day_obs, night.params.instrument)
+            )
+    assert loki.call_count + stream.call_count == 1
+    surveys = compute_survey_summary(events, canceled, exposures, outcomes)
+
+    expected = _expected_outcomes(night, directory)
+    assert set(surveys.index) == {"BLOCK-365", "BLOCK-T99", "BLOCK-T42"}
+    for survey, row in surveys.iterrows():
+        counts = {name: expected[(survey, name)] for name in SURVEY_OUTCOMES}
+        assert {name: row[name] for name in SURVEY_OUTCOMES} == counts
+        assert row["received"] == sum(counts.values())
+    assert surveys.loc["BLOCK-365", "preprocessed"] > 0
+    assert surveys.loc["BLOCK-365", "failed"] > 0
+    for survey, outcome in (("BLOCK-T99", "skipped"), ("BLOCK-T42", "unsupported")):
+        assert surveys.loc[survey, outcome] == surveys.loc[survey, "received"] > 0
+
+    lines = render_survey_lines(exposures, surveys)
+    assert "Unknown survey: BLOCK-T42" in lines
+    assert "Skipped survey: BLOCK-T99" in lines
+
+
+def test_outcomes_past_the_limit_are_queried_by_window(survey_night):
+    night, directory = survey_night
+
+    def get_outcomes(limit):
+        loki = LocalLoki(directory, limit=limit)
+        with (
+            mock.patch.object(queries, "LOKI_LIMIT", limit),
+            mock.patch.object(queries, "query_loki", loki.query),
+            mock.patch.object(queries, "query_loki_window", loki.window),
+        ):
+            outcomes = queries.get_survey_outcomes_from_loki(night.params.day_obs)
+        return outcomes.sort_values(["group", "detector"], ignore_index=True)
+
+    complete = get_outcomes(200000)
+    # Loki cuts every query off at 50 lines, but no window is cut off.
+    assert len(complete) > 50
+    assert get_outcomes(50).equals(complete)